@@ -1,73 +1,696 @@
-import urllib, urllib2, json, httplib
+import urllib, urlparse, json, httplib
 import arcpy
 import codecs, os, sys
 import shutil
 import errno
 import string
 import datetime, time
+import itertools
+import math
+import bisect
+import re
 import xml.dom.minidom as DOM
+from xml.parsers import expat
 import socket
 import tempfile
-import getpass
 import zipfile
+import hashlib
+import threading
+import Queue
+import multiprocessing
+import atexit
+import fnmatch
+import optparse
+import shlex
+from multiprocessing.pool import ThreadPool
+import zlib
+import stat
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+longErrorGlobal = False
+
+# Admin tokens are shared by every helper for the whole run, one per (server, port, user).
+# A token is renewed TOKEN_REFRESH_MARGIN seconds before the server says it expires. tokenCacheLock only guards the cache,
+# a token is generated holding the lock of its key (tokenLocks), so a slow server does not hold up the others.
+TOKEN_EXPIRATION = 300
+TOKEN_REFRESH_MARGIN = 60
+tokenCache = {}
+tokenCacheLock = threading.Lock()
+tokenLocks = {}
+tokenStats = {'requested': 0, 'served': 0}
+
+# Admin requests go over keep-alive connections, pooled per server and port
+HTTP_POOL_SIZE = 8
+HTTP_TIMEOUT = 120
+httpPools = {}
+httpPoolsLock = threading.Lock()
+httpStats = {'requests': 0, 'connections': 0}
+
+# Independent admin lookups of one step (the permissions of a service in both servers, the folders of a server, the
+# privilege, users and user details of a role...) are sent at the same time by up to ADMIN_WORKERS threads, and the helpers
+# return when all of them answered (see adminLookups). Each server still gets at most HTTP_POOL_SIZE requests at once.
+ADMIN_WORKERS = 8
+
+# Every admin request is counted per server and endpoint (the URL without the folder and service names), with its bytes,
+# failures and a histogram of its latency in HTTP_TRACE_BUCKETS (seconds). With HTTP_TRACE each request is also written
+# to HTTP_TRACE_FILE in the run workspace, without the HTTP_TRACE_SECRETS parameters, to replay it (see replayTrace).
+HTTP_TRACE = False
+HTTP_TRACE_FILE = "http_trace.jsonl"
+HTTP_TRACE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HTTP_TRACE_SECRETS = ('token', 'password')
+HTTP_ENDPOINT_PATTERNS = [(re.compile(r'^/services/[^/]+/[^/]+\.\w+Server'), '/services/{folder}/{service}'),
+                          (re.compile(r'^/services/[^/]+\.\w+Server'), '/services/{service}'),
+                          (re.compile(r'^/services/(?!createFolder$|types$)[^/]+$'), '/services/{folder}')]
+ADMIN_PATH = "/arcgis/admin"
+httpTrace = {'endpoints': {}, 'file': None, 'records': None, 'start': 0.0}
+httpTraceLock = threading.Lock()
+
+# Services go through the transfer stages concurrently. Each stage has its own worker threads and
+# a bounded queue in front of it: while one service uploads, the next is staging and another copying.
+PIPELINE_WORKERS = {'copy': 1, 'draft': 1, 'stage': 1, 'upload': 1, 'permissions': 1}
+PIPELINE_QUEUE_SIZE = 2
+
+# arcpy is not documented as thread-safe, so every arcpy call of a process (map documents, drafts, analysis, staging and
+# uploads) runs on one arcpy thread, one at a time, while the copies and admin requests go on in the pipeline threads.
+# PROCESS_WORKERS drafts and stages several services at once, each process with its own arcpy. ARCPY_THREADS = True
+# calls arcpy from the pipeline threads at the same time instead (see arcpyCall).
+ARCPY_THREADS = False
+arcpyThread = {'pool': None}
+arcpyThreadLock = threading.Lock()
+
+# Folders and services of the origin and destination servers, indexed once per run
+catalogIndex = {}
+catalogIndexLock = threading.Lock()
+
+# Threads used to list folders and read services when taking a snapshot of a server
+CRAWLER_WORKERS = 8
+
+# Folders of ArcGIS Server with its own services, skipped when the whole server is migrated
+CATALOG_SYSTEM_FOLDERS = ('System', 'Utilities')
+
+# Snapshot of the origin server the toolbox run reads the services from, "" to read them from the server
+SNAPSHOT_FILE = ""
+
+# Incremental copy: the sources are kept in sysTemp between runs (in a workspace without timestamp)
+# and only new or changed files are copied again. DELTA_HASH also compares the MD5 of unchanged-looking files.
+DELTA_COPY = False
+DELTA_HASH = False
+copyStats = {'copied': 0, 'skipped': 0}
+copyStatsLock = threading.Lock()
+
+# Sources are copied by COPY_WORKERS threads with COPY_BUFFER_SIZE reads. Files smaller than
+# COPY_SMALL_FILE are copied COPY_BATCH_SIZE at a time by the same thread.
+COPY_WORKERS = 8
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+COPY_SMALL_FILE = 256 * 1024
+COPY_BATCH_SIZE = 64
+MAX_PATH = 260
+
+# Files larger than COPY_CHUNK_SIZE are copied in blocks of that size. The progress is kept next to the
+# copy, so an interrupted copy goes on from the last block. A failed block is retried COPY_RETRIES times.
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_RETRIES = 3
+
+# Compression level of the ZIP backup of an overwritten service (1-9). 0 only stores the files,
+# for services whose data is already compressed.
+BACKUP_COMPRESSION = 6
+
+# Reading and writing the shares of the servers (\\server\...) is limited to THROTTLE_MB_PER_SECOND and THROTTLE_FILES
+# files at a time per server, so copying off a live server does not slow down its services. THROTTLE_SERVERS sets other
+# limits for some servers, {'server': (MB per second, files)}. 0 is no limit.
+THROTTLE_MB_PER_SECOND = 0
+THROTTLE_FILES = 0
+THROTTLE_SERVERS = {}
+throttles = {}
+throttlesLock = threading.Lock()
+
+# The stages completed by each service are appended to the journal in the run workspace. RESUME reuses the
+# workspace of the last interrupted run between the same servers and skips the stages already completed.
+RESUME = False
+JOURNAL_FILE = "journal.jsonl"
+JOURNAL_STAGES = ['properties', 'copied', 'draft', 'analysed', 'staged', 'uploaded', 'permissions']
+
+# Roles, privileges and users of each server are read once per run in pages of SECURITY_PAGE_SIZE, and the
+# roles already synchronised are remembered. Users are added to a role SECURITY_BATCH_SIZE at a time.
+# securityIndexLock only guards these dictionaries; the requests of an index, a role or a user are sent holding its own
+# lock (see securityKeyLock), so different roles are synchronised at the same time.
+SECURITY_PAGE_SIZE = 1000
+SECURITY_BATCH_SIZE = 100
+SECURITY_MAX_USERS = 100000
+securityIndex = {}
+securityIndexLock = threading.Lock()
+securityLocks = {}
+syncedRoles = set()
+
+# Principals that exist in every server and are never created
+SPECIAL_ROLES = ('esriAnonymous', 'esriAuthenticated', 'esriEveryone')
+
+# DEFERRED_PERMISSIONS sets the permissions of all the services after the last upload, grouped by role,
+# with PERMISSION_WORKERS threads, instead of in the last stage of each service.
+DEFERRED_PERMISSIONS = False
+PERMISSION_WORKERS = 8
+
+# sddraft keys of the ConfigurationProperties and their field in the "properties" of the admin JSON of the service.
+# The scales are only copied when they are set.
+SDDRAFT_CONFIGURATION_PROPERTIES = {'supportedImageReturnTypes': 'supportedImageReturnTypes', 'useLocalCacheDir': 'useLocalCacheDir', 'isCached': 'isCached',
+                                    'clientCachingAllowed': 'clientCachingAllowed', 'schemaLockingEnabled': 'schemaLockingEnabled', 'textAntialiasingMode': 'textAntialiasingMode',
+                                    'enableDynamicLayers': 'enableDynamicLayers', 'antialiasingMode': 'antialiasingMode', 'maxRecordCount': 'maxRecordCount',
+                                    'dynamicDataWorkspaces': 'dynamicDataWorkspaces', 'MaxImageHeight': 'maxImageHeight', 'cacheOnDemand': 'cacheOnDemand',
+                                    'maxBufferCount': 'maxBufferCount', 'disableIdentifyRelates': 'disableIdentifyRelates', 'MaxImageWidth': 'maxImageWidth',
+                                    'maxScale': 'maxScale', 'maxDomainCodeCount': 'maxDomainCodeCount', 'minScale': 'minScale', 'ignoreCache': 'ignoreCache'}
+SDDRAFT_SCALES = ('maxScale', 'minScale')
+
+# sddraft keys of the service Props and their field in the admin JSON of the service
+SDDRAFT_SERVICE_PROPS = {'MaxInstances': 'maxInstancesPerNode', 'keepAliveInterval': 'keepAliveInterval', 'StartupTimeout': 'maxStartupTime',
+                         'configuredState': 'configuredState', 'UsageTimeout': 'maxUsageTime', 'Isolation': 'isolationLevel', 'IdleTimeout': 'maxIdleTime',
+                         'MinInstances': 'minInstancesPerNode', 'WaitTimeout': 'maxWaitTime', 'InstancesPerContainer': 'instancesPerContainer',
+                         'recycleInterval': 'recycleInterval', 'recycleStartTime': 'recycleStartTime'}
+
+# Elements of the sddraft found while reading it (the first one of each name)
+SDDRAFT_INDEXED = ('ConfigurationProperties', 'Props', 'ItemInfo', 'XMin', 'YMin', 'XMax', 'YMax')
+
+# Nodes of the light tree the sddraft is read into that are not elements
+DRAFT_DOCUMENT = '#document'
+DRAFT_TEXT = '#text'
+DRAFT_COMMENT = '#comment'
+DRAFT_CDATA = '#cdata-section'
+DRAFT_PI = '#pi'
+DRAFT_NODES = (DRAFT_TEXT, DRAFT_CDATA, DRAFT_COMMENT, DRAFT_PI)
+
+# Service definitions staged by earlier runs are kept in the SD cache (SD_CACHE_FOLDER, "sdcache" in sysTemp when ""),
+# named by the hash of the sources, the sddraft and its analysis. A service whose hash is in the cache is not staged
+# again, and with SD_CACHE_ANALYSIS its draft is not analysed again either. The least recently used files are removed
+# when the cache is bigger than SD_CACHE_SIZE.
+SD_CACHE = False
+SD_CACHE_FOLDER = ""
+SD_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+SD_CACHE_ANALYSIS = True
+sdCacheLock = threading.Lock()
+sdCacheStats = {'reused': 0, 'stored': 0}
+
+# PROCESS_WORKERS processes create, analyse and stage the service definitions of different services at the same time,
+# each with its own connection file and scratch folder in the run workspace. 0 does it in the threads of the pipeline.
+PROCESS_WORKERS = 0
+workerRun = {}
+
+# With SCHEDULE_LONGEST_FIRST the services are transferred longest first, SCHEDULE_WINDOW at a time: SCHEDULE_WORKERS threads
+# read each service of the window and list its sources while the previous window is transferred, and its time is estimated
+# from their size and the times of the earlier runs, kept in SCHEDULE_HISTORY_FILE in sysTemp. Until the history has enough
+# services the SCHEDULE_* defaults below are used. The order is only longest first within each window: a large service
+# near the end of a list longer than SCHEDULE_WINDOW still goes near the end, so raise it to cover the whole list.
+SCHEDULE_LONGEST_FIRST = False
+SCHEDULE_HISTORY_FILE = "schedule.json"
+SCHEDULE_WORKERS = 8
+SCHEDULE_WINDOW = 32
+SCHEDULE_SERVICE_SECONDS = 30.0
+SCHEDULE_LAYER_SECONDS = 1.0
+SCHEDULE_BYTES_PER_SECOND = 50 * 1024 * 1024
+
+# Each service is written as a JSON line to METRICS_FILE in the run workspace: its size, the time of each stage, the admin
+# requests it sent and how it ended. The p50, p95 and max time of each stage are shown at the end of the run. "" to disable.
+# The admin requests are counted for the service of the thread that sends them (requestContext.job).
+METRICS_FILE = "metrics.jsonl"
+requestContext = threading.local()
+
+# Success.txt and Failure.txt are appended by one writer thread, which writes what was queued meanwhile together (see
+# openRunLog). What can not be written is tried again after LOG_RETRY_SECONDS, and reported at the end of the run.
+LOG_RETRY_SECONDS = 5
+runLog = {'queue': None, 'thread': None, 'lost': [], 'error': None}
+runLogLock = threading.Lock()
+
+
+
+def gentoken(server, port, adminUser, adminPass, expiration=None, expires=None):
+
+    #Re-usable function to get a token required for Admin changes (for TOKEN_EXPIRATION minutes by default)
+    if expiration is None: expiration = TOKEN_EXPIRATION
+    query_dict = {'username':adminUser,'password':adminPass,'client':'requestip','expiration':expiration,'f':'json'}
 
-longErrorGlobal = False   
+    query_string = urllib.urlencode(query_dict)
+    url = "/arcgis/admin/generateToken"
 
+    token = json.loads(postToServer(server, str(port), url, query_string)[1])
 
-def gentoken(server, port, adminUser, adminPass, expiration=300):
-    
-    #Re-usable function to get a token required for Admin changes
-    query_dict = {'username':adminUser,'password':adminPass,'client':'requestip'}
-    
-    query_string = urllib.urlencode(query_dict)
-    url = "http://{}:{}/arcgis/admin/generateToken".format(server, port)
-    
-    token = json.loads(urllib.urlopen(url + "?f=json", query_string).read())
-        
     if 'token' not in token:
-        arcpy.AddError(token['messages'])
-        quit()
+        raise ValueError("Unable to generate a token for server '" + server + ":" + str(port) + "': " + str(token.get('messages')))
     else:
+        # The server answers with the expiry time in milliseconds since epoch
+        if expires is not None:
+            if 'expires' in token: expires.append(float(token['expires']) / 1000)
+            else: expires.append(time.time() + expiration * 60)
         return token['token']
 
 
+def getToken(server, port, adminUser, adminPass):
+
+    ''' Function to get the run-wide token of a server.
+    A new token is only generated the first time or when the cached one is about to expire.
+    '''
+    key = (server, str(port), adminUser)
+
+    with tokenCacheLock:
+        tokenStats['served'] = tokenStats['served'] + 1
+        token = cachedToken(key)
+        if token is not None:
+            return token
+        keyLock = tokenLocks.setdefault(key, threading.Lock())
+
+    # Only one thread generates the token of a key, the others wait for it
+    with keyLock:
+        with tokenCacheLock:
+            token = cachedToken(key)
+        if token is not None:
+            return token
+
+        expires = []
+        token = gentoken(server, port, adminUser, adminPass, TOKEN_EXPIRATION, expires)
+
+        with tokenCacheLock:
+            tokenStats['requested'] = tokenStats['requested'] + 1
+            tokenCache[key] = (token, expires[0])
+        return token
+
+
+def cachedToken(key):
+
+    #Token of the cache that does not expire soon, or None (called with tokenCacheLock held)
+    if key in tokenCache:
+        token, expires = tokenCache[key]
+        if time.time() < expires - TOKEN_REFRESH_MARGIN:
+            return token
+    return None
+
+
+def invalidateToken(server, port, adminUser, token):
+
+    #Forget a token rejected by the server, unless another thread already renewed it
+    key = (server, str(port), adminUser)
+
+    with tokenCacheLock:
+        if key in tokenCache and tokenCache[key][0] == token:
+            del tokenCache[key]
+
+
+def tokenRequestsSaved():
+    return tokenStats['served'] - tokenStats['requested']
+
+
+# A function that checks if the server rejected the token of a request
+def isInvalidToken(data):
+
+    try:
+        obj = json.loads(data)
+    except ValueError:
+        return False
+
+    if not isinstance(obj, dict) or obj.get('status') != "error":
+        return False
+    if obj.get('code') in (498, 499):
+        return True
+    for message in obj.get('messages', []):
+        if 'invalid token' in message.lower() or 'token required' in message.lower():
+            return True
+    return False
+
+
+def postAdminRequest(server, port, adminUser, adminPass, url, params=None):
+
+    ''' Function to post an authenticated request to the Admin REST API.
+    The token comes from the run-wide cache; if the server rejects it the request is retried once with a new one.
+    params = Dictionary with the request parameters (token and f are added)
+    '''
+    if params is None:
+        params = {}
+
+    for attempt in range(2):
+        token = getToken(server, port, adminUser, adminPass)
+        query = dict(params)
+        query['token'] = token
+        query['f'] = 'json'
+
+        response, data = postToServer(server, str(port), url, urllib.urlencode(query))
+
+        if attempt == 0 and isInvalidToken(data):
+            invalidateToken(server, port, adminUser, token)
+        else:
+            break
+
+    return (response, data)
+
+
+def adminLookups(calls, workers=None):
+
+    ''' Function to send independent admin lookups at the same time and wait for all of them.
+    calls = List of (function, arguments) tuples, e.g. (getPermissions, (server, port, adminUser, adminPass, folder, service, type))
+    Returns the results in the order of the calls. If some lookups failed, the error of the first one is raised again
+    once all of them ended. The admin requests are counted for the service of the calling thread (requestContext.job).
+    workers = Number of lookups sent at the same time, ADMIN_WORKERS by default
+    '''
+    if workers is None: workers = ADMIN_WORKERS
+    if len(calls) <= 1 or workers <= 1:
+        return [function(*arguments) for function, arguments in calls]
+
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    pending = Queue.Queue()
+    for position in range(len(calls)):
+        pending.put(position)
+    job = getattr(requestContext, 'job', None)
+
+    def worker():
+        requestContext.job = job
+        while True:
+            try:
+                position = pending.get_nowait()
+            except Queue.Empty:
+                return
+            function, arguments = calls[position]
+            try:
+                results[position] = function(*arguments)
+            except:
+                errors[position] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(calls)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+
+def callCaught(function, arguments):
+
+    ''' Function to call a function in a pool thread and return (True, result), or (False, error) with the sys.exc_info()
+    of what it raised. A SystemExit would end the thread of the pool without a result and its caller would wait forever.
+    '''
+    try:
+        return (True, function(*arguments))
+    except BaseException:
+        return (False, sys.exc_info())
+
+
+def callResult(outcome):
+
+    #Result of callCaught, or its error raised again in the calling thread
+    success, result = outcome
+    if not success:
+        raise result[0], result[1], result[2]
+    return result
+
+
+def arcpyCall(function, *arguments):
+
+    ''' Function to call an arcpy function on the arcpy thread of the process and wait for its result (see ARCPY_THREADS).
+    Its errors (arcpy.ExecuteError...) are raised in the calling thread.
+    '''
+    if ARCPY_THREADS:
+        return function(*arguments)
+
+    with arcpyThreadLock:
+        if arcpyThread['pool'] is None: arcpyThread['pool'] = ThreadPool(1)
+        pool = arcpyThread['pool']
+    return callResult(pool.apply(callCaught, (function, arguments)))
+
+
+def closeArcpyThread():
+
+    #Stop the arcpy thread of the process once the last service is uploaded (the next run starts another one)
+    with arcpyThreadLock:
+        pool = arcpyThread['pool']
+        arcpyThread['pool'] = None
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
 def makeAGSconnection(server, port, adminUser, adminPass, workspace):
     
     ''' Function to create an ArcGIS Server connection file using the arcpy.Mapping function "CreateGISServerConnectionFile"    
     '''
     millis = int(round(time.time() * 1000))
     connectionType = 'ADMINISTER_GIS_SERVICES'
-    connectionName = 'ServerConnection' + str(millis)
+    connectionName = 'ServerConnection' + str(millis) + '_' + server + '_' + str(port)
     serverURL = 'http://' + server + ':' + port + '/arcgis/admin'
     serverType = 'ARCGIS_SERVER'
     saveUserName = 'SAVE_USERNAME'
         
     outputAGS = os.path.join(workspace, connectionName + ".ags")
     try:
-        arcpy.mapping.CreateGISServerConnectionFile(connectionType, workspace, connectionName, serverURL, serverType, True, '', adminUser, adminPass, saveUserName)
+        arcpyCall(arcpy.mapping.CreateGISServerConnectionFile, connectionType, workspace, connectionName, serverURL, serverType, True, '', adminUser, adminPass, saveUserName)
         return outputAGS
-    except:
-        arcpy.AddError("Could not create AGS connection file for: '" + server + ":" + port + "'")
-        sys.exit()
+    except Exception, e:
+        raise RuntimeError("Could not create AGS connection file for: '" + server + ":" + port + "': " + str(e))
         
 
 # A function that will post HTTP POST request to the server
 def postToServer(server, port, url, params):
 
-    httpConn = httplib.HTTPConnection(server, port)
-    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain", "Accept-Encoding": "gzip"}
 
     # URL encode the resoure URL
     url = urllib.quote(url.encode('utf-8'))
     
-    # Build the connection to add the roles to the server
-    httpConn.request("POST", url, params, headers)
+    # Send the request over a pooled keep-alive connection to the server
+    return sendRequest(server, port, "POST", url, params, headers)
 
-    response = httpConn.getresponse()
-    data = response.read()
-    httpConn.close()
-    
-    return (response, data)
+
+def getConnectionPool(server, port):
+
+    #Pool of idle keep-alive connections of a server, at most HTTP_POOL_SIZE of them in use at once
+    key = (server, str(port))
+
+    with httpPoolsLock:
+        if key not in httpPools:
+            httpPools[key] = {'idle': [], 'slots': threading.BoundedSemaphore(HTTP_POOL_SIZE), 'lock': threading.Lock()}
+        return httpPools[key]
+
+
+def closeIdleConnections(pool):
+
+    with pool['lock']:
+        idle = pool['idle']
+        pool['idle'] = []
+
+    for httpConn in idle:
+        httpConn.close()
+
+
+def closeConnections():
+
+    #Close every pooled connection, called at the end of the run
+    with httpPoolsLock:
+        pools = httpPools.values()
+
+    for pool in pools:
+        closeIdleConnections(pool)
+
+
+def sendRequest(server, port, method, url, body, headers):
+
+    ''' Function to send a request over a pooled keep-alive connection.
+    A reused socket closed by the server while idle is dropped together with the other idle connections
+    and the request is sent again on a new one, but only if no byte of the response was received: a request
+    the server may have carried out (an add or an edit) is not sent twice. Gzip responses are returned decompressed.
+    '''
+    pool = getConnectionPool(server, port)
+    pool['slots'].acquire()
+    start = time.time()
+
+    try:
+        while True:
+            with pool['lock']:
+                if pool['idle']: httpConn = pool['idle'].pop()
+                else: httpConn = None
+
+            reused = httpConn is not None
+            if not reused:
+                httpConn = httplib.HTTPConnection(server, port, timeout=HTTP_TIMEOUT)
+                with httpPoolsLock:
+                    httpStats['connections'] = httpStats['connections'] + 1
+
+            answered = False
+            try:
+                httpConn.request(method, url, body, headers)
+                # A connection the server had closed ends before the first byte of the response
+                answered = httpConn.sock.recv(1, socket.MSG_PEEK) != ""
+                if not answered: raise httplib.BadStatusLine("No status line received - the server has closed the connection")
+                response = httpConn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                httpConn.close()
+                if reused and not answered and not isinstance(e, socket.timeout):
+                    closeIdleConnections(pool)
+                    continue
+                traceRequest(server, port, method, url, body, None, 0, time.time() - start)
+                raise
+
+            traceRequest(server, port, method, url, body, response.status, len(data), time.time() - start)
+            job = getattr(requestContext, 'job', None)
+            with httpPoolsLock:
+                httpStats['requests'] = httpStats['requests'] + 1
+                if job is not None:
+                    job['requests'] = job.get('requests', 0) + 1
+
+            if (response.getheader('content-encoding') or '').lower() == 'gzip':
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+            if response.will_close:
+                httpConn.close()
+            else:
+                with pool['lock']:
+                    pool['idle'].append(httpConn)
+
+            return (response, data)
+    finally:
+        pool['slots'].release()
+
+
+def endpointTemplate(url):
+
+    #Endpoint of an admin URL, without the query and the names of the folders and services
+    path = urllib.unquote(url.split('?')[0]).rstrip('/')
+    if path.startswith(ADMIN_PATH): path = path[len(ADMIN_PATH):]
+    for pattern, template in HTTP_ENDPOINT_PATTERNS:
+        path, found = pattern.subn(template, path)
+        if found: break
+    return path
+
+
+def traceRequest(server, port, method, url, body, status, received, latency):
+
+    ''' Function to record an admin request sent by sendRequest.
+    The requests are counted per server and endpoint with their bytes, failures and a histogram of their latency
+    (see reportHttpTrace). While a trace file is open (see openHttpTrace) the request is also written to it, without
+    its token and credentials, to send it again later (see replayTrace).
+    status = HTTP status of the answer, None if none was received
+    '''
+    key = (server + ":" + str(port), endpointTemplate(url))
+    sent = len(body or "")
+    with httpTraceLock:
+        stats = httpTrace['endpoints'].get(key)
+        if stats is None:
+            stats = {'requests': 0, 'failed': 0, 'sent': 0, 'received': 0, 'seconds': 0.0, 'max': 0.0, 'histogram': [0] * (len(HTTP_TRACE_BUCKETS) + 1)}
+            httpTrace['endpoints'][key] = stats
+        stats['requests'] = stats['requests'] + 1
+        if status != 200: stats['failed'] = stats['failed'] + 1
+        stats['sent'] = stats['sent'] + sent
+        stats['received'] = stats['received'] + received
+        stats['seconds'] = stats['seconds'] + latency
+        stats['max'] = max(stats['max'], latency)
+        bucket = bisect.bisect_left(HTTP_TRACE_BUCKETS, latency)
+        stats['histogram'][bucket] = stats['histogram'][bucket] + 1
+
+        if httpTrace['file'] is None and httpTrace['records'] is None:
+            return
+        params = urlparse.parse_qsl(url.partition('?')[2], True) + urlparse.parse_qsl(body or "", True)
+        line = json.dumps({'offset': round(time.time() - latency - httpTrace['start'], 4), 'server': server, 'port': str(port), 'method': method,
+                           'url': url.split('?')[0], 'endpoint': key[1], 'params': dict([param for param in params if param[0] not in HTTP_TRACE_SECRETS]),
+                           'status': status, 'sent': sent, 'received': received, 'latency': round(latency, 4)})
+        # A worker process sends its requests to the main process (see processStageChain)
+        if httpTrace['file'] is None: httpTrace['records'].append(line)
+        else: httpTrace['file'].write(line + "\n")
+
+
+def openHttpTrace(traceFile):
+
+    #Write the admin requests to traceFile from now on, one JSON line per request (see traceRequest)
+    with httpTraceLock:
+        httpTrace['file'] = open(traceFile, "w")
+        httpTrace['start'] = time.time()
+
+
+def closeHttpTrace():
+
+    #Stop writing the admin requests to the trace file
+    with httpTraceLock:
+        if httpTrace['file'] is not None:
+            httpTrace['file'].close()
+            httpTrace['file'] = None
+
+
+def mergeHttpTrace(endpoints, records):
+
+    #Add the admin requests of a worker process to the counts and the trace file of the run
+    with httpTraceLock:
+        for key, workerStats in endpoints.items():
+            stats = httpTrace['endpoints'].setdefault(key, workerStats)
+            if stats is workerStats:
+                continue
+            for field in ('requests', 'failed', 'sent', 'received', 'seconds'):
+                stats[field] = stats[field] + workerStats[field]
+            stats['max'] = max(stats['max'], workerStats['max'])
+            stats['histogram'] = [count + workerCount for count, workerCount in zip(stats['histogram'], workerStats['histogram'])]
+        if httpTrace['file'] is not None:
+            for line in records:
+                httpTrace['file'].write(line + "\n")
+
+
+def reportHttpTrace():
+
+    #Show the requests, failures, bytes and latency histogram of each admin endpoint of each server
+    with httpTraceLock:
+        endpoints = dict((key, dict(stats)) for key, stats in httpTrace['endpoints'].items())
+    if endpoints == {}:
+        return
+
+    bounds = [str(int(bound * 1000)) + " ms" for bound in HTTP_TRACE_BUCKETS]
+    labels = ["<" + bound for bound in bounds] + [">" + bounds[-1]]
+    arcpy.AddMessage(" - Admin requests per endpoint (requests, failed, KB sent/received, mean/max latency and latency histogram):")
+    for key in sorted(endpoints):
+        stats = endpoints[key]
+        arcpy.AddMessage("     " + key[0] + " " + key[1] + ": " + str(stats['requests']) + ", " + str(stats['failed']) + " failed, " +
+                         "%.1f/%.1f KB, %d/%d ms" % (stats['sent'] / 1024.0, stats['received'] / 1024.0, 1000 * stats['seconds'] / stats['requests'], 1000 * stats['max']))
+        arcpy.AddMessage("         " + " | ".join([label + ": " + str(count) for label, count in zip(labels, stats['histogram']) if count > 0]))
+
+
+def replayTrace(traceFile, server, port, adminUser, adminPass, speed=1.0, workers=None):
+
+    ''' Function to send the admin requests of a trace file (see traceRequest) again, all of them to one server,
+    e.g. a local stand-in of the traced servers. The requests are sent in the same order and, divided by speed,
+    with the same time between them (speed 0 sends them as fast as possible), up to workers (HTTP_POOL_SIZE by default)
+    at a time. They get a token of the server, or adminUser and adminPass for generateToken.
+    Returns the number of requests sent; their counts and latencies are shown by reportHttpTrace.
+    '''
+    if workers is None: workers = HTTP_POOL_SIZE
+    records = []
+    traceData = open(traceFile, "r")
+    try:
+        for line in traceData:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    finally:
+        traceData.close()
+
+    with httpTraceLock:
+        httpTrace['endpoints'].clear()
+
+    def replay(record):
+        if speed > 0:
+            wait = start + record['offset'] / speed - time.time()
+            if wait > 0: time.sleep(wait)
+        params = dict((name, value.encode('utf8')) for name, value in record['params'].items())
+        if record['endpoint'] == "/generateToken": params.update({'username': adminUser, 'password': adminPass})
+        else: params['token'] = getToken(server, port, adminUser, adminPass)
+        postToServer(server, str(port), record['url'].encode('utf8'), urllib.urlencode(params))
+
+    start = time.time()
+    pool = ThreadPool(workers)
+    try:
+        pool.map(replay, records, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return len(records)
 
 
 def createFolder(server, port, adminUser, adminPass, folderName, folderDescription, token=None):
@@ -78,39 +701,45 @@ def createFolder(server, port, adminUser, adminPass, folderName, folderDescripti
     folderDescription = String with a description for the folder
     If a token exists, you can pass one in for use.  
     '''    
-    # Get and set the token
-    if token is None:
-        token = gentoken(server, port, adminUser, adminPass)    
-        
+    # Nothing to do if the run catalog already has the folder
+    if catalogHasFolder(server, port, folderName) == True:
+        return
+
     folderProp_dict = {"folderName": folderName,"description": folderDescription}
-    
-    folder_encode = urllib.urlencode(folderProp_dict)            
-    create = "http://{}:{}/arcgis/admin/services/createFolder?token={}&f=json".format(server, port, token)    
-    status = urllib2.urlopen(create, folder_encode).read()
+    url = "/arcgis/admin/services/createFolder"
+
+    # Use the given token or the run-wide one
+    if token is None:
+        response, status = postAdminRequest(server, port, adminUser, adminPass, url, folderProp_dict)
+    else:
+        folderProp_dict.update({'token': token, 'f': 'json'})
+        response, status = postToServer(server, str(port), url, urllib.urlencode(folderProp_dict))
 
     if 'success' in status:
         arcpy.AddMessage("     Folder '" + folderName + "' created successfully.")
+        catalogAddFolder(server, port, folderName)
 
     return
 
 
 #Check if a service exists
 def isServicePresent(server, port, adminUser, adminPass, serviceName, folderName, token=None):
-    
-    token = gentoken(server, port, adminUser, adminPass)
+
+    # Answer from the run catalog if the server is indexed
+    present = catalogHasService(server, port, folderName, serviceName)
+    if present is not None:
+        return present
      
     # If the folder itself is not present, we do not need to check for the service's presence in this folder.
-    if folderName != 'root' and folderName != '' and not isFolderPresent(folderName, server, port, token):
+    if folderName != 'root' and folderName != '' and not isFolderPresent(folderName, server, port, adminUser, adminPass):
         return False
-
-    params = urllib.urlencode({'token': token, 'f': 'json'})
         
     if  folderName == 'root' or folderName == '':
         URL = "/arcgis/admin/services/"       
     else:
         URL = "/arcgis/admin/services/" + folderName
     
-    response, data = postToServer(server, port, URL, params)
+    response, data = postAdminRequest(server, port, adminUser, adminPass, URL)
         
     if (response.status != 200 or not assertJsonSuccess(data)):
         arcpy.AddMessage("\n     Error while fetching the service information from the server.")
@@ -128,12 +757,15 @@ def isServicePresent(server, port, adminUser, adminPass, serviceName, folderName
 
 
 #Check if a folder is present
-def isFolderPresent(folderName, server, port, token):
+def isFolderPresent(folderName, server, port, adminUser, adminPass):
+
+    present = catalogHasFolder(server, port, folderName)
+    if present is not None:
+        return present
     
-    params = urllib.urlencode({'token': token, 'f': 'json'})    
     folderURL = "/arcgis/admin/services"
     
-    response, data = postToServer(server, port, folderURL, params)
+    response, data = postAdminRequest(server, port, adminUser, adminPass, folderURL)
         
     if (response.status != 200 or not assertJsonSuccess(data)):
         arcpy.AddMessage("\n     Error while fetching folders from the server.")
@@ -151,12 +783,15 @@ def isFolderPresent(folderName, server, port, token):
 def numberOfServices(server, port, adminUser, adminPass, serviceType):
     
     #Count all the services of "MapServer" type in a server
+    number = catalogCount(server, port, serviceType)
+    if number is not None:
+        return number
+
     number = 0
 
-    token = gentoken(server, port, adminUser, adminPass)    
     services = []    
-    baseUrl = "http://{}:{}/arcgis/admin/services".format(server, port)
-    catalog = json.load(urllib2.urlopen(baseUrl + "/" + "?f=json&token=" + token))
+    baseUrl = "/arcgis/admin/services"
+    catalog = json.loads(postAdminRequest(server, port, adminUser, adminPass, baseUrl + "/")[1])
     services = catalog['services']
     
     for service in services:
@@ -165,8 +800,10 @@ def numberOfServices(server, port, adminUser, adminPass, serviceType):
             
     folders = catalog['folders']
     
-    for folderName in folders:
-        catalog = json.load(urllib2.urlopen(baseUrl + "/" + folderName + "?f=json&token=" + token))
+    # The folders are listed at the same time
+    listings = adminLookups([(postAdminRequest, (server, port, adminUser, adminPass, baseUrl + "/" + folderName)) for folderName in folders])
+    for response, data in listings:
+        catalog = json.loads(data)
         services = catalog['services']
         for service in services:
             if service['type'] == serviceType:
@@ -175,6 +812,250 @@ def numberOfServices(server, port, adminUser, adminPass, serviceType):
     return number
 
 
+def buildCatalogIndex(server, port, adminUser, adminPass, workers=None):
+
+    ''' Function to index the folders and services of a server for the whole run.
+    The root and every folder are listed once; existence checks, folder creation and the service count
+    are then answered from memory. If a listing fails the server is not indexed and is asked directly.
+    workers = Number of folders listed at the same time, ADMIN_WORKERS by default (see adminLookups)
+    '''
+    baseUrl = "/arcgis/admin/services"
+    response, data = postAdminRequest(server, port, adminUser, adminPass, baseUrl + "/")
+
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        arcpy.AddMessage("     Could not index the services of '" + server + "'.")
+        return None
+
+    root = json.loads(data)
+    catalog = {'': root['services']}
+
+    def listFolder(folderName):
+        return (folderName, postAdminRequest(server, port, adminUser, adminPass, baseUrl + "/" + folderName))
+
+    listings = adminLookups([(listFolder, (folderName,)) for folderName in root['folders']], workers)
+    
+    for folderName, (response, data) in listings:
+
+        if (response.status != 200 or not assertJsonSuccess(data)):
+            arcpy.AddMessage("     Could not index the services of '" + server + "'.")
+            return None
+        catalog[folderName] = json.loads(data)['services']
+
+    with catalogIndexLock:
+        catalogIndex[(server, str(port))] = catalog
+
+    return catalog
+
+
+def catalogHasFolder(server, port, folderName):
+
+    #True/False if the server is indexed, None if it must be asked
+    if folderName == 'root': folderName = ''
+
+    with catalogIndexLock:
+        catalog = catalogIndex.get((server, str(port)))
+        if catalog is None:
+            return None
+        return folderName in catalog
+
+
+def catalogHasService(server, port, folderName, serviceName):
+
+    #True/False if the server is indexed, None if it must be asked
+    if folderName == 'root': folderName = ''
+
+    with catalogIndexLock:
+        catalog = catalogIndex.get((server, str(port)))
+        if catalog is None:
+            return None
+        for service in catalog.get(folderName, []):
+            if service['serviceName'] == serviceName: return True
+        return False
+
+
+def catalogAddFolder(server, port, folderName):
+
+    with catalogIndexLock:
+        catalog = catalogIndex.get((server, str(port)))
+        if catalog is not None and folderName not in catalog:
+            catalog[folderName] = []
+
+
+def catalogAddService(server, port, folderName, serviceName, serviceType):
+
+    #Keep the index up to date after a service is published
+    if folderName == 'root': folderName = ''
+
+    with catalogIndexLock:
+        catalog = catalogIndex.get((server, str(port)))
+        if catalog is None:
+            return
+        services = catalog.setdefault(folderName, [])
+        for service in services:
+            if service['serviceName'] == serviceName and service['type'] == serviceType: return
+        services.append({'folderName': folderName, 'serviceName': serviceName, 'type': serviceType})
+
+
+def catalogCount(server, port, serviceType):
+
+    with catalogIndexLock:
+        catalog = catalogIndex.get((server, str(port)))
+        if catalog is None:
+            return None
+        number = 0
+        for services in catalog.values():
+            for service in services:
+                if service['type'] == serviceType:
+                    number = number + 1
+        return number
+
+
+def streamServerServices(server, port, adminUser, adminPass, serviceType, include=None, exclude=None, shard=None, selection=None):
+
+    ''' Function to list the services of a whole server lazily, folder by folder, as the transfer takes them.
+    Yields the names (folder/service.type) of the services of serviceType that match an include pattern (any
+    service if there are none) and no exclude pattern (see matchesPatterns). The folders of CATALOG_SYSTEM_FOLDERS
+    are skipped.
+    shard = Optional (i, N): only the services of the shard i of N (see serviceShard), so N runs migrate the
+            server between them without overlapping
+    selection = Optional dictionary that counts the services 'listed' and 'selected'
+    '''
+    if selection is None: selection = {}
+    selection.update({'listed': 0, 'selected': 0})
+    baseUrl = "/arcgis/admin/services"
+
+    pending = [""]
+    while pending != []:
+        folderName = pending.pop(0)
+        response, data = postAdminRequest(server, port, adminUser, adminPass, baseUrl + "/" + urllib.quote(folderName.encode('utf8')))
+        if (response.status != 200 or not assertJsonSuccess(data)):
+            arcpy.AddWarning("     Could not list the services of the folder '" + (folderName or "root") + "' of '" + server + "'.")
+            continue
+
+        listing = json.loads(data)
+        if folderName == "":
+            pending = [folder for folder in listing.get('folders', []) if folder not in CATALOG_SYSTEM_FOLDERS]
+
+        for service in listing['services']:
+            if service['type'] != serviceType:
+                continue
+            serviceName = service['serviceName'] + "." + service['type']
+            if folderName != "": serviceName = folderName + "/" + serviceName
+            selection['listed'] = selection['listed'] + 1
+
+            if not matchesPatterns(serviceName, include, exclude):
+                continue
+            if shard is not None and serviceShard(serviceName, shard[1]) != shard[0]:
+                continue
+            selection['selected'] = selection['selected'] + 1
+            yield serviceName
+
+
+def matchesPatterns(serviceName, include=None, exclude=None):
+
+    #True if the service matches one of the include patterns (or there are none) and none of the exclude ones, e.g. "Water/*"
+    serviceName = serviceName.lower()
+    if include and not [pattern for pattern in include if fnmatch.fnmatchcase(serviceName, pattern.lower())]:
+        return False
+    if exclude and [pattern for pattern in exclude if fnmatch.fnmatchcase(serviceName, pattern.lower())]:
+        return False
+    return True
+
+
+def serviceShard(serviceName, shards):
+
+    #Shard (1 to shards) of a service, from the hash of its name. It does not depend on the run, the host or the other services.
+    return int(hashlib.md5(serviceName.lower().encode('utf8')).hexdigest()[:8], 16) % shards + 1
+
+
+def snapshotServer(server, port, adminUser, adminPass, snapshotFile, workers=None):
+
+    ''' Function to write the configuration of every service of a server to a JSONL snapshot.
+    Folders are listed and services read by a pool of threads; each line holds the service JSON,
+    its permissions and its item info. The snapshot can be given to transferMapServices instead of
+    reading the origin services one by one.
+    workers = Number of threads, CRAWLER_WORKERS by default
+    '''
+    if workers is None: workers = CRAWLER_WORKERS
+    start = time.time()
+    catalog = buildCatalogIndex(server, port, adminUser, adminPass, workers)
+    if catalog is None:
+        arcpy.AddError("Could not list the services of '" + server + ":" + str(port) + "'")
+        return False
+
+    services = []
+    for folderName in sorted(catalog.keys()):
+        for service in catalog[folderName]:
+            services.append((folderName, service['serviceName'] + "." + service['type']))
+
+    def readService(folderService):
+        return readServiceRecord(server, port, adminUser, adminPass, folderService[0], folderService[1])
+
+    number = 0
+    errors = 0
+    size = 0
+    pool = ThreadPool(workers)
+    snapshot = open(snapshotFile, "w")
+    try:
+        for record in pool.imap_unordered(readService, services):
+            line = json.dumps(record, separators=(',', ':')) + "\n"
+            snapshot.write(line)
+            number = number + 1
+            size = size + len(line)
+            if 'error' in record: errors = errors + 1
+    finally:
+        snapshot.close()
+        pool.close()
+
+    seconds = max(time.time() - start, 0.001)
+    arcpy.AddMessage(" - Snapshot of '" + server + "' written to: " + snapshotFile)
+    arcpy.AddMessage(" - Services: " + str(number) + " (" + str(errors) + " could not be read), " + str(size / 1024) + " KB in " + ("%.1f" % seconds) + " s, " + ("%.1f" % (number / seconds)) + " services/s")
+    return True
+
+
+def readServiceRecord(server, port, adminUser, adminPass, folderName, serviceName):
+
+    #Service JSON, permissions and item info of a service, as one snapshot record
+    record = {'error': None, 'folder': folderName, 'service': serviceName}
+
+    if folderName == '': url = "/arcgis/admin/services/" + serviceName
+    else: url = "/arcgis/admin/services/" + folderName + "/" + serviceName
+
+    for key, resource in (('properties', ''), ('permissions', '/permissions'), ('itemInfo', '/iteminfo')):
+        response, data = postAdminRequest(server, port, adminUser, adminPass, url + resource)
+        
+        if (response.status != 200 or not assertJsonSuccess(data)):
+            if key != 'itemInfo':
+                record['error'] = "Could not read the " + key + " of '" + url + "'"
+                return record
+            record[key] = None
+        elif key == 'permissions':
+            record[key] = json.loads(data)['permissions']
+        else:
+            record[key] = json.loads(data)
+
+    del record['error']
+    return record
+
+
+def loadSnapshot(snapshotFile):
+
+    #Records of a snapshot written by snapshotServer, by "folder/service" name quoted as the services of the transfer
+    records = {}
+    snapshot = open(snapshotFile, "r")
+    try:
+        for line in snapshot:
+            if line.strip() == "": continue
+            record = json.loads(line)
+            if 'error' in record: continue
+            if record['folder'] == '': key = record['service']
+            else: key = record['folder'] + "/" + record['service']
+            records[urllib.quote(key.encode('utf8'))] = record
+    finally:
+        snapshot.close()
+    return records
+
+
 # A function that checks that the input JSON object is not an error object.
 def assertJsonSuccess(data):
     
@@ -186,95 +1067,721 @@ def assertJsonSuccess(data):
         return True
 
 
-def copy(src, dest):
+def copy(src, dest, delta=False, errors=None, scan=None, written=None):
 
-    global longErrorGlobal
+    ''' Function to copy a service folder with parallelCopy.
+    The files that could not be copied are added to errors as (path, message, longPath) and False is returned.
+    delta = Only copy what changed since the last run (see deltaCopy)
+    scan = scanFolder of src, if it was already listed
+    written = dict whose 'bytes' are increased by the bytes written to dest
+    '''
+    if errors is None: errors = []
+    if written is None: written = {'bytes': 0}
+
+    #Only copy what changed since the last run
+    if delta and os.path.isdir(src):
+        try:
+            written['bytes'] = written['bytes'] + deltaCopy(src, dest, DELTA_HASH, errors, scan)[0]
+            return copyResult(errors)
+        except (IOError, OSError), e:
+            arcpy.AddMessage('     Incremental copy failed, copying the whole folder. Error: %s' % e)
+            del errors[:]
     
-    #Check if folder exists, if exists delete
-    if os.path.exists(dest): shutil.rmtree(dest)
+    #Check if folder exists, if exists delete (but the large files copied in part, to go on from their last block)
+    if os.path.isdir(dest): clearCopy(dest)
+    elif os.path.exists(dest): os.remove(dest)
+    if os.path.exists(dest + ".manifest"): os.remove(dest + ".manifest")
     
     #Copy folder
     try:
-        shutil.copytree(src, dest)
-        return True
-    except OSError as e:
+        written['bytes'] = written['bytes'] + parallelCopy(src, dest, errors, scan)
+        return copyResult(errors)
+    except (IOError, OSError), e:
         # If the error was caused because the source wasn't a directory
         if e.errno == errno.ENOTDIR:
             arcpy.AddMessage('src: ' +src)
-            arcpy.AddMessage('dst: ' + dst)
-            shutil.copy(src, dst)
+            arcpy.AddMessage('dst: ' + dest)
+            shutil.copy(src, dest)
+            written['bytes'] = written['bytes'] + os.path.getsize(dest)
             return True
         elif e.errno == errno.EEXIST:
             arcpy.AddMessage('     The folder already exists.')
             return False
         else:
+            # Reported with the files that could not be copied (a long path sets longErrorGlobal)
             arcpy.AddMessage('     Directory not copied. Error: %s' % e)
-            return True
-    except:
-        longErrorGlobal = True
-        return False
+            errors.append((src, str(e), isLongPath(dest, e)))
+            return copyResult(errors)
 
-def createZipFile(folder_path, output_path):
-    """Zip the contents of an entire folder (with that folder included
-    in the archive). Empty subfolders will be included in the archive
-    as well.
-    """
 
-    parent_folder = os.path.dirname(folder_path)
-    # Retrieve the paths of the folder contents.
-    contents = os.walk(folder_path)
-    try:
-        zip_file = zipfile.ZipFile(output_path, 'w', allowZip64 = True)
-        for root, folders, files in contents:
-            # Include all subfolders, including empty ones.
-            for folder_name in folders:
-                absolute_path = os.path.join(root, folder_name)
-                relative_path = absolute_path.replace(parent_folder + '\\','')
-                zip_file.write(absolute_path, relative_path)
-                #zipfile.ZipFile(absolute_path, relative_path, mode='w', allowZip64 = True)
-                
-            for file_name in files:
-                absolute_path = os.path.join(root, file_name)
-                relative_path = absolute_path.replace(parent_folder + '\\','')
-                zip_file.write(absolute_path, relative_path)
-                #zipfile.ZipFile(absolute_path, relative_path, mode='w', allowZip64 = True)
+def clearCopy(dest):
 
+    #Delete a former copy of a folder, except the files with a .progress file (see chunkedCopy) and the folders they are in
+    kept = False
+    for root, dirs, files in os.walk(dest, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(".progress") and os.path.isfile(path[:-len(".progress")]) or os.path.isfile(path + ".progress"):
+                kept = True
+            else:
+                os.remove(path)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.listdir(path) == []: os.rmdir(path)
+    if not kept: shutil.rmtree(dest)
 
-        zip_file.close()
-        return True
-    
-    except IOError, message:
-        zip_file.close()
-        
-        os.remove(output_path)
-        return False
-    except OSError, message:
-        zip_file.close()
-        
-        os.remove(output_path)
-        return False
-    except zipfile.BadZipfile, message:
-        zip_file.close()
-        
-        os.remove(output_path)
-        return False
-    
-    except Exception, e:
-        arcpy.AddMessage('     Failed: '+ str(e))
-        zip_file.close()
-        os.remove(output_path)
-        return False
 
-def get_size(start_path):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
-        
+def copyResult(errors):
 
-def deleteInfo(src):
+    #Report the files that could not be copied
+    global longErrorGlobal
+
+    if errors == []:
+        return True
+
+    for path, message, longPath in errors[:5]:
+        arcpy.AddMessage("     File not copied: " + path + " (" + message + ")")
+    if len(errors) > 5:
+        arcpy.AddMessage("     ... and " + str(len(errors) - 5) + " more files not copied.")
+
+    for path, message, longPath in errors:
+        if longPath: longErrorGlobal = True
+    return False
+
+
+def parallelCopy(src, dest, errors, scan=None):
+
+    ''' Function to copy a folder tree with COPY_WORKERS threads.
+    The folders are created first, then the files are copied with COPY_BUFFER_SIZE reads. Files smaller than
+    COPY_SMALL_FILE are grouped COPY_BATCH_SIZE at a time so a thread copies many of them in one task.
+    Returns the bytes written.
+    '''
+    if scan is None: scan = scanFolder(src)
+
+    # Same check as shutil.copytree: the source must be a folder. The destination only exists with the partial copies
+    # of large files left by an interrupted copy (see clearCopy)
+    if scan['error'] is not None: raise scan['error']
+    if not os.path.isdir(dest): os.makedirs(dest)
+    errors.extend(scan['errors'])
+
+    for folder in scan['folders']:
+        try:
+            if not os.path.isdir(os.path.join(dest, folder)): os.mkdir(os.path.join(dest, folder))
+        except OSError, e:
+            errors.append((os.path.join(src, folder), str(e), isLongPath(os.path.join(dest, folder), e)))
+
+    return copyFiles([(os.path.join(src, file), os.path.join(dest, file), size) for file, size, modified in scan['files']], errors)
+
+
+def copyFiles(files, errors):
+
+    #Copy a list of (source, destination, size) files with a pool of threads, adding the failures to errors. Returns the bytes written
+    tasks = []
+    batch = []
+    for srcFile, destFile, size in files:
+        if size < COPY_SMALL_FILE:
+            batch.append((srcFile, destFile, size))
+            if len(batch) == COPY_BATCH_SIZE:
+                tasks.append(batch)
+                batch = []
+        else:
+            tasks.append([(srcFile, destFile, size)])
+    if batch != []: tasks.append(batch)
+
+    if tasks == []:
+        return 0
+
+    written = 0
+    pool = ThreadPool(min(COPY_WORKERS, len(tasks)))
+    try:
+        for taskErrors, taskWritten in pool.imap_unordered(copyFileBatch, tasks):
+            errors.extend(taskErrors)
+            written = written + taskWritten
+    finally:
+        pool.close()
+        pool.join()
+    return written
+
+
+def copyFileBatch(batch):
+
+    #Copy a list of (source, destination, size) files. Returns the files that failed and the bytes written
+    taskErrors = []
+    written = 0
+    for srcFile, destFile, size in batch:
+        shareLimits = shareThrottles(srcFile, destFile)
+        acquireFiles(shareLimits)
+        try:
+            if size > COPY_CHUNK_SIZE:
+                written = written + chunkedCopy(srcFile, destFile, shareLimits)
+                continue
+            fsrc = open(srcFile, "rb")
+            try:
+                fdest = open(destFile, "wb")
+                try:
+                    copyData(fsrc, fdest, shareLimits)
+                    written = written + fdest.tell()
+                finally:
+                    fdest.close()
+            finally:
+                fsrc.close()
+            shutil.copystat(srcFile, destFile)
+        except (IOError, OSError), e:
+            taskErrors.append((srcFile, str(e), isLongPath(srcFile, e) or isLongPath(destFile, e)))
+        finally:
+            releaseFiles(shareLimits)
+    return (taskErrors, written)
+
+
+def chunkedCopy(srcFile, destFile, shareLimits=None):
+
+    ''' Function to copy a large file in COPY_CHUNK_SIZE blocks that can be resumed.
+    The blocks already copied are recorded in "<destFile>.progress" with the size and date of the source.
+    A copy that was interrupted, in this run or in a former one, goes on from the last complete block.
+    Returns the bytes written by this call, without the blocks of a former run.
+    shareLimits = Throttles of the servers of the source and destination (see shareThrottles)
+    '''
+    if shareLimits is None: shareLimits = []
+    info = os.stat(srcFile)
+    source = [info.st_size, int(info.st_mtime), COPY_CHUNK_SIZE]
+    progressFile = destFile + ".progress"
+
+    attempt = 0
+    resumed = None
+    while True:
+        blocks = readProgress(progressFile, destFile, source)
+        if resumed is None: resumed = blocks
+        try:
+            copyChunks(srcFile, destFile, progressFile, source, blocks, shareLimits)
+            break
+        except (IOError, OSError):
+            # Retry from the last complete block
+            attempt = attempt + 1
+            if attempt > COPY_RETRIES: raise
+            time.sleep(attempt)
+
+    shutil.copystat(srcFile, destFile)
+    os.remove(progressFile)
+    return max(info.st_size - resumed * COPY_CHUNK_SIZE, 0)
+
+
+def readProgress(progressFile, destFile, source):
+
+    #Number of blocks of the source already in destFile, 0 if the copy has to start again
+    if not os.path.isfile(progressFile) or not os.path.isfile(destFile):
+        return 0
+    try:
+        progressData = open(progressFile, "r")
+        try: progress = json.load(progressData)
+        finally: progressData.close()
+    except (IOError, ValueError):
+        return 0
+    if not isinstance(progress, dict) or progress.get('source') != source:
+        return 0
+    return min(progress.get('blocks', 0), os.path.getsize(destFile) // COPY_CHUNK_SIZE)
+
+
+def copyChunks(srcFile, destFile, progressFile, source, blocks, shareLimits):
+
+    blockSize = throttleBlockSize(shareLimits)
+    fsrc = open(srcFile, "rb")
+    try:
+        if blocks > 0: fdest = open(destFile, "r+b")
+        else: fdest = open(destFile, "wb")
+        try:
+            fsrc.seek(blocks * COPY_CHUNK_SIZE)
+            fdest.seek(blocks * COPY_CHUNK_SIZE)
+            fdest.truncate()
+            while True:
+                copied = 0
+                while copied < COPY_CHUNK_SIZE:
+                    data = fsrc.read(min(blockSize, COPY_CHUNK_SIZE - copied))
+                    if not data: break
+                    if shareLimits != []: throttleBytes(shareLimits, len(data))
+                    fdest.write(data)
+                    copied = copied + len(data)
+                if copied < COPY_CHUNK_SIZE:
+                    break
+
+                # The block is only recorded once it is on disk
+                fdest.flush()
+                os.fsync(fdest.fileno())
+                blocks = blocks + 1
+                progressData = open(progressFile, "w")
+                try: json.dump({'source': source, 'blocks': blocks}, progressData)
+                finally: progressData.close()
+        finally:
+            fdest.close()
+    finally:
+        fsrc.close()
+
+
+def shareThrottles(*paths):
+
+    ''' Function to get the throttles of the servers whose shares the paths are on (\\server\share\...).
+    Local paths and servers without limits have none. They are sorted by server, the order their
+    file slots are taken in, so two copies never wait for each other.
+    '''
+    servers = set()
+    for path in paths:
+        if path is not None and path[:2] in ('\\\\', '//'):
+            servers.add(path[2:].replace('/', '\\').split('\\')[0].lower())
+
+    shareLimits = []
+    for server in sorted(servers):
+        throttle = getThrottle(server)
+        if throttle is not None: shareLimits.append(throttle)
+    return shareLimits
+
+
+def getThrottle(server):
+
+    #Throttle of a server for the whole run (THROTTLE_SERVERS or the default limits), None if it has no limits
+    with throttlesLock:
+        if server not in throttles:
+            limits = (THROTTLE_MB_PER_SECOND, THROTTLE_FILES)
+            for name, serverLimits in THROTTLE_SERVERS.items():
+                if name.lower() == server: limits = serverLimits
+
+            throttle = None
+            if limits[0] > 0 or limits[1] > 0:
+                throttle = {'server': server, 'rate': limits[0] * 1024.0 * 1024.0, 'files': limits[1], 'lock': threading.Lock(),
+                            'allowance': 0.0, 'last': None, 'bytes': 0, 'start': None, 'end': 0.0}
+                if limits[1] > 0: throttle['slots'] = threading.BoundedSemaphore(limits[1])
+            throttles[server] = throttle
+        return throttles[server]
+
+
+def acquireFiles(shareLimits):
+
+    #Wait for a file slot on every server (THROTTLE_FILES files at a time)
+    for throttle in shareLimits:
+        if 'slots' in throttle: throttle['slots'].acquire()
+
+
+def releaseFiles(shareLimits):
+    for throttle in reversed(shareLimits):
+        if 'slots' in throttle: throttle['slots'].release()
+
+
+def throttleBlockSize(shareLimits):
+
+    #Reads of about an eighth of a second at the lowest rate, so the share is read evenly and not in bursts
+    blockSize = COPY_BUFFER_SIZE
+    for throttle in shareLimits:
+        if throttle['rate'] > 0: blockSize = min(blockSize, max(64 * 1024, int(throttle['rate'] / 8)))
+    return blockSize
+
+
+def throttleBytes(shareLimits, size):
+
+    ''' Function to count size bytes read from or written to the shares, waiting as long as the rate of each
+    server needs (a token bucket that holds one second of its rate). The bytes are reserved before waiting,
+    so the copies that share a server wait in turn.
+    '''
+    for throttle in shareLimits:
+        wait = 0
+        with throttle['lock']:
+            now = time.time()
+            if throttle['start'] is None: throttle['start'] = now
+            if throttle['rate'] > 0:
+                if throttle['last'] is not None:
+                    throttle['allowance'] = min(throttle['rate'], throttle['allowance'] + (now - throttle['last']) * throttle['rate'])
+                throttle['last'] = now
+                throttle['allowance'] = throttle['allowance'] - size
+                if throttle['allowance'] < 0: wait = -throttle['allowance'] / throttle['rate']
+            throttle['bytes'] = throttle['bytes'] + size
+            throttle['end'] = max(throttle['end'], now + wait)
+        if wait > 0: time.sleep(wait)
+
+
+def copyData(fsrc, fdest, shareLimits):
+
+    #Copy an open file, at the rate of the servers of its shares if they have limits
+    if shareLimits == []:
+        shutil.copyfileobj(fsrc, fdest, COPY_BUFFER_SIZE)
+        return
+
+    blockSize = throttleBlockSize(shareLimits)
+    while True:
+        data = fsrc.read(blockSize)
+        if not data: break
+        throttleBytes(shareLimits, len(data))
+        fdest.write(data)
+
+
+def reportThrottles():
+
+    #Rate achieved on the shares of each server with limits
+    with throttlesLock:
+        shareLimits = [throttle for throttle in throttles.values() if throttle is not None and throttle['bytes'] > 0]
+    for throttle in sorted(shareLimits, key=lambda throttle: throttle['server']):
+        seconds = max(throttle['end'] - throttle['start'], 0.001)
+        limit = []
+        if throttle['rate'] > 0: limit.append(formatSize(throttle['rate']) + "/s")
+        if throttle['files'] > 0: limit.append(str(throttle['files']) + " files at a time")
+        arcpy.AddMessage(" - Shares of '" + throttle['server'] + "': " + formatSize(throttle['bytes']) + " in " + str(round(seconds, 1)) + " s ("
+                         + formatSize(throttle['bytes'] / seconds) + "/s, limit " + ", ".join(limit) + ")")
+
+
+def isLongPath(path, e=None):
+
+    #Windows can not open paths of MAX_PATH characters or more
+    if e is not None and getattr(e, 'errno', None) == errno.ENAMETOOLONG:
+        return True
+    return path is not None and len(os.path.abspath(path)) >= MAX_PATH
+
+
+def deltaCopy(src, dest, useHash=False, errors=None, scan=None):
+
+    ''' Function to bring a copy of a folder up to date with only the files that changed.
+    The size and modification date (and optionally the MD5) of every copied file are kept in a manifest
+    next to the copy ("<dest>.manifest"). Files that are not in the source any more are deleted; files
+    created in the copy by the tool itself (drafts, .sd) are not in the manifest and are left alone.
+    '''
+    if errors is None: errors = []
+    if scan is None: scan = scanFolder(src)
+    if scan['error'] is not None: raise scan['error']
+    errors.extend(scan['errors'])
+
+    manifestFile = dest + ".manifest"
+    manifest = {}
+    if os.path.isdir(dest) and os.path.isfile(manifestFile):
+        try:
+            manifestData = open(manifestFile, "r")
+            try: manifest = json.load(manifestData)
+            finally: manifestData.close()
+        except ValueError:
+            manifest = {}
+
+    newManifest = {}
+    toCopy = []
+    skipped = 0
+    
+    for folder in [""] + scan['folders']:
+        destRoot = os.path.join(dest, folder)
+        if not os.path.isdir(destRoot): os.makedirs(destRoot)
+
+    for relativePath, size, modified in scan['files']:
+        srcFile = os.path.join(src, relativePath)
+        destFile = os.path.join(dest, relativePath)
+        entry = [size, int(modified), None]
+
+        old = manifest.get(relativePath)
+        unchanged = old is not None and old[0] == entry[0] and old[1] == entry[1] and os.path.isfile(destFile) and os.path.getsize(destFile) == entry[0]
+        if unchanged and useHash:
+            entry[2] = fileHash(srcFile)
+            unchanged = old[2] == entry[2]
+
+        if unchanged:
+            entry[2] = old[2]
+            skipped = skipped + entry[0]
+        else:
+            toCopy.append((srcFile, destFile, relativePath))
+        newManifest[relativePath] = entry
+
+    #Copy the new and changed files; the failed ones are left out of the manifest so the next run copies them again
+    failed = len(errors)
+    copied = copyFiles([(srcFile, destFile, newManifest[relativePath][0]) for srcFile, destFile, relativePath in toCopy], errors)
+    failedFiles = set([error[0] for error in errors[failed:]])
+    
+    for srcFile, destFile, relativePath in toCopy:
+        if srcFile in failedFiles:
+            del newManifest[relativePath]
+        else:
+            entry = newManifest[relativePath]
+            if useHash and entry[2] is None: entry[2] = fileHash(destFile)
+
+    #Delete the files removed from the source
+    deleted = 0
+    for relativePath in manifest:
+        if relativePath not in newManifest:
+            destFile = os.path.join(dest, relativePath)
+            if os.path.isfile(destFile) and not os.path.isfile(os.path.join(src, relativePath)):
+                os.remove(destFile)
+                deleted = deleted + 1
+
+    manifestData = open(manifestFile, "w")
+    try: json.dump(newManifest, manifestData)
+    finally: manifestData.close()
+
+    with copyStatsLock:
+        copyStats['copied'] = copyStats['copied'] + copied
+        copyStats['skipped'] = copyStats['skipped'] + skipped
+
+    arcpy.AddMessage("     Incremental copy: " + formatSize(copied) + " copied, " + formatSize(skipped) + " unchanged, " + str(deleted) + " files deleted.")
+    return (copied, skipped)
+
+
+def scanFolder(path):
+
+    ''' Function to list a folder tree once for every step of the transfer.
+    Returns the sub folders and the files (relative paths, with size and modification date) in the same order
+    as os.walk, the total size and the MXD and iteminfo.xml (the first one of the last folder that has one, as
+    the walks it replaces). The size check, the copy, the backup and the draft read this instead of walking again.
+    A folder that can not be listed is added to errors; if it is the folder itself, error is the exception.
+    '''
+    scan = {'path': path, 'folders': [], 'files': [], 'size': 0, 'mxd': None, 'iteminfo': None, 'errors': [], 'error': None}
+
+    pending = [""]
+    while pending != []:
+        relativeRoot = pending.pop(0)
+        if relativeRoot == "": root = path
+        else: root = os.path.join(path, relativeRoot)
+        try:
+            entries = listFolder(root)
+        except OSError, e:
+            if relativeRoot == "": scan['error'] = e
+            else: scan['errors'].append((root, str(e), isLongPath(root, e)))
+            continue
+
+        folders = []
+        mxd = None
+        iteminfo = None
+        for name, isFolder, size, modified in entries:
+            relativePath = os.path.join(relativeRoot, name)
+            if isFolder:
+                folders.append(relativePath)
+                continue
+            scan['files'].append((relativePath, size, modified))
+            scan['size'] = scan['size'] + size
+            if mxd is None and name.endswith(".mxd"): mxd = relativePath
+            if iteminfo is None and name == "iteminfo.xml": iteminfo = relativePath
+
+        if mxd is not None: scan['mxd'] = mxd
+        if iteminfo is not None: scan['iteminfo'] = iteminfo
+        scan['folders'].extend(folders)
+        pending[0:0] = folders
+
+    return scan
+
+
+def listFolder(folder):
+
+    #Entries of a folder as (name, isFolder, size, modified). scandir reads the size and date with the listing.
+    entries = []
+    if scandir is not None:
+        for entry in scandir(folder):
+            try:
+                if entry.is_dir():
+                    entries.append((entry.name, True, 0, 0))
+                else:
+                    info = entry.stat()
+                    entries.append((entry.name, False, info.st_size, info.st_mtime))
+            except OSError:
+                entries.append((entry.name, False, 0, 0))
+        return entries
+
+    for name in os.listdir(folder):
+        try:
+            info = os.stat(os.path.join(folder, name))
+        except OSError:
+            entries.append((name, False, 0, 0))
+            continue
+        if stat.S_ISDIR(info.st_mode):
+            entries.append((name, True, 0, 0))
+        else:
+            entries.append((name, False, info.st_size, info.st_mtime))
+    return entries
+
+
+def fileHash(path):
+
+    md5 = hashlib.md5()
+    shareLimits = shareThrottles(path)
+    acquireFiles(shareLimits)
+    try:
+        data = open(path, "rb")
+        try:
+            for block in iter(lambda: data.read(min(1024 * 1024, throttleBlockSize(shareLimits))), ""):
+                if shareLimits != []: throttleBytes(shareLimits, len(block))
+                md5.update(block)
+        finally:
+            data.close()
+    finally:
+        releaseFiles(shareLimits)
+    return md5.hexdigest()
+
+
+def formatSize(size):
+    return ("%.1f" % (size / (1024.0 * 1024.0))) + " MB"
+
+
+def createZipFile(folder_path, output_path, scan=None):
+    """Zip the contents of an entire folder (with that folder included
+    in the archive). Empty subfolders will be included in the archive
+    as well.
+    """
+
+    parent_folder = os.path.dirname(folder_path)
+    # Retrieve the paths of the folder contents.
+    if scan is None: scan = scanFolder(folder_path)
+    try:
+        zip_file = zipfile.ZipFile(output_path, 'w', allowZip64 = True)
+        # Include all subfolders, including empty ones.
+        for folder_name in scan['folders']:
+            absolute_path = os.path.join(folder_path, folder_name)
+            relative_path = absolute_path.replace(parent_folder + '\\','')
+            zip_file.write(absolute_path, relative_path)
+            #zipfile.ZipFile(absolute_path, relative_path, mode='w', allowZip64 = True)
+
+        for file_name, size, modified in scan['files']:
+            absolute_path = os.path.join(folder_path, file_name)
+            relative_path = absolute_path.replace(parent_folder + '\\','')
+            zip_file.write(absolute_path, relative_path)
+            #zipfile.ZipFile(absolute_path, relative_path, mode='w', allowZip64 = True)
+
+
+        zip_file.close()
+        return True
+    
+    except IOError, message:
+        zip_file.close()
+        
+        os.remove(output_path)
+        return False
+    except OSError, message:
+        zip_file.close()
+        
+        os.remove(output_path)
+        return False
+    except zipfile.BadZipfile, message:
+        zip_file.close()
+        
+        os.remove(output_path)
+        return False
+    
+    except Exception, e:
+        arcpy.AddMessage('     Failed: '+ str(e))
+        zip_file.close()
+        os.remove(output_path)
+        return False
+
+def backupFolder(src, dest, zipPath, level=None, scan=None):
+
+    ''' Function to back up a folder to a plain copy and a ZIP file reading each file only once.
+    Every block read from the source is written to the copy and to the archive.
+    level = Compression level of the archive (1-9), 0 only stores the files, BACKUP_COMPRESSION by default
+    '''
+    if level is None: level = BACKUP_COMPRESSION
+    if scan is None: scan = scanFolder(src)
+    if scan['error'] is not None:
+        arcpy.AddMessage('     Directory not copied. Error: %s' % scan['error'])
+        return False
+    for path, message, longPath in scan['errors']:
+        arcpy.AddMessage('     Directory not copied. Error: %s' % message)
+        return False
+
+    #Check if folder exists, if exists delete. The ZIP file goes next to the copy.
+    try:
+        if os.path.exists(dest): shutil.rmtree(dest)
+        os.makedirs(dest)
+        zip_file = zipfile.ZipFile(zipPath, 'w', allowZip64 = True)
+    except (IOError, OSError), e:
+        arcpy.AddMessage('     Directory not copied. Error: %s' % e)
+        return False
+
+    parent_folder = os.path.dirname(src)
+    try:
+        # Include all subfolders, including empty ones.
+        for folder_name in scan['folders']:
+            os.mkdir(os.path.join(dest, folder_name))
+            absolute_path = os.path.join(src, folder_name)
+            zip_file.write(absolute_path, absolute_path.replace(parent_folder + '\\',''))
+
+        for file_name, size, modified in scan['files']:
+            absolute_path = os.path.join(src, file_name)
+            writeBackupFile(zip_file, absolute_path, absolute_path.replace(parent_folder + '\\',''), os.path.join(dest, file_name), level)
+
+        zip_file.close()
+        return True
+
+    except (IOError, OSError, RuntimeError, zipfile.BadZipfile, zipfile.LargeZipFile), e:
+        arcpy.AddMessage('     Failed: '+ str(e))
+        zip_file.close()
+        os.remove(zipPath)
+        return False
+
+
+def writeBackupFile(zip_file, path, arcname, destPath, level):
+
+    #Same entry as ZipFile.write, but the blocks are also written to destPath and compressed with level
+    info = os.stat(path)
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(info.st_mtime)[0:6])
+    zinfo.external_attr = (info.st_mode & 0xFFFF) << 16L
+    if level == 0:
+        zinfo.compress_type = zipfile.ZIP_STORED
+        compressor = None
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    zinfo.file_size = info.st_size
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+
+    # The header is written again at the end with the CRC and sizes
+    zinfo.CRC = 0
+    zinfo.compress_size = 0
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+
+    crc = 0
+    fileSize = 0
+    compressSize = 0
+    shareLimits = shareThrottles(path, destPath)
+    blockSize = throttleBlockSize(shareLimits)
+    acquireFiles(shareLimits)
+    try:
+        fsrc = open(path, "rb")
+        try:
+            fdest = open(destPath, "wb")
+            try:
+                while True:
+                    block = fsrc.read(blockSize)
+                    if not block: break
+                    if shareLimits != []: throttleBytes(shareLimits, len(block))
+                    fdest.write(block)
+                    fileSize = fileSize + len(block)
+                    crc = zlib.crc32(block, crc) & 0xffffffff
+                    if compressor is not None: block = compressor.compress(block)
+                    compressSize = compressSize + len(block)
+                    zip_file.fp.write(block)
+                if compressor is not None:
+                    block = compressor.flush()
+                    compressSize = compressSize + len(block)
+                    zip_file.fp.write(block)
+            finally:
+                fdest.close()
+        finally:
+            fsrc.close()
+    finally:
+        releaseFiles(shareLimits)
+    shutil.copystat(path, destPath)
+
+    zinfo.CRC = crc
+    zinfo.file_size = fileSize
+    zinfo.compress_size = compressSize
+    if not zip64 and (fileSize > zipfile.ZIP64_LIMIT or compressSize > zipfile.ZIP64_LIMIT):
+        raise RuntimeError('File size has increased during compressing')
+
+    position = zip_file.fp.tell()
+    zip_file.fp.seek(zinfo.header_offset, 0)
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.seek(position, 0)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+def get_size(start_path):
+    return scanFolder(start_path)['size']
+        
+
+def deleteInfo(src):
     
     for root, dirs, files in os.walk(src):
         for file in files:            
@@ -285,575 +1792,1890 @@ def deleteInfo(src):
                 break;
 
 
-def formatDate():
-    return str(time.strftime('%Y-%m-%d %H:%M:%S'))
+def formatDate():
+    return str(time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def setPermission(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, fromFolderName, toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType, initialPermissions=None):
+
+    # The permissions of both servers are read at the same time (the origin ones may come from a snapshot)
+    if initialPermissions is None:
+        initialPermissions, finalPermissions = adminLookups([(getPermissions, (fromServerName, fromServerPort, fromAdminUser, fromAdminPass, fromFolderName, serviceName, serviceType)),
+                                                             (getPermissions, (toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType))])
+    else:
+        finalPermissions = getPermissions(toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType)
+    
+    # Only the permissions that differ are applied
+    for role, isAllowed, fromOrigin in permissionChanges(initialPermissions, finalPermissions):
+
+        #If the role does not exists and is not a special role, we have to create it, assign privileges and users
+        if fromOrigin and role not in SPECIAL_ROLES:
+            searchRole(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role)
+            
+        applyPermission(toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType, role, isAllowed)
+
+
+def permissionChanges(initialPermissions, finalPermissions):
+
+    ''' Function to compare the permissions of the origin and the destination service.
+    Returns the (role, isAllowed, fromOrigin) to apply in the destination: the origin permissions that are
+    missing or different, and a deny for the roles allowed in the destination that the origin does not have.
+    '''
+    desired = dict((permission['principal'], permission['permission']['isAllowed']) for permission in initialPermissions)
+    current = dict((permission['principal'], permission['permission']['isAllowed']) for permission in finalPermissions)
+
+    changes = []
+    seen = set()
+    for permission in initialPermissions:
+        role = permission['principal']
+        if role not in seen and current.get(role) != desired[role]:
+            changes.append((role, desired[role], True))
+        seen.add(role)
+
+    for permission in finalPermissions:
+        role = permission['principal']
+        if role not in seen and current[role] != False:
+            changes.append((role, False, False))
+        seen.add(role)
+    return changes
+
+
+def applyDeferredPermissions(run):
+
+    ''' Function to set the permissions of all the published services at the end of the run (deferPermissions).
+    The destination permissions are read in parallel, then the changes are applied role by role: each role is
+    synchronised once and its permission is applied to all its services with PERMISSION_WORKERS threads.
+    '''
+    items = run['deferredPermissions']
+    if items == []:
+        return
+
+    arcpy.AddMessage("\n  ** Setting the permissions of " + str(len(items)) + " services" + destinationName(run) + ".")
+    pool = ThreadPool(min(PERMISSION_WORKERS, len(items)))
+
+    def readChanges(item):
+        try:
+            finalPermissions = getPermissions(run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], item['folderName'], item['serviceName'], run['serviceType'])
+            return permissionChanges(item['permissions'], finalPermissions)
+        except ValueError, value:
+            item['errors'].append(str(value))
+            return []
+
+    def apply(change):
+        item, role, isAllowed = change
+        try:
+            applyPermission(run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], item['folderName'], item['serviceName'], run['serviceType'], role, isAllowed)
+        except ValueError, value:
+            item['errors'].append(str(value))
+
+    try:
+        # Changes grouped by role
+        roles = []
+        byRole = {}
+        for item, changes in zip(items, pool.map(readChanges, items)):
+            for role, isAllowed, fromOrigin in changes:
+                if role not in byRole:
+                    roles.append(role)
+                    byRole[role] = {'changes': [], 'fromOrigin': False}
+                byRole[role]['changes'].append((item, role, isAllowed))
+                byRole[role]['fromOrigin'] = byRole[role]['fromOrigin'] or fromOrigin
+
+        for role in roles:
+            if byRole[role]['fromOrigin'] and role not in SPECIAL_ROLES:
+                try:
+                    searchRole(run['fromServerName'], run['fromServerPort'], run['fromAdminUser'], run['fromAdminPass'], run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], role)
+                except ValueError, value:
+                    for item, role, isAllowed in byRole[role]['changes']:
+                        item['errors'].append(str(value))
+                    continue
+            pool.map(apply, byRole[role]['changes'])
+    finally:
+        pool.close()
+
+    for item in items:
+        if item['errors'] != []:
+            arcpy.AddMessage("          Failed to assign permission on '" + item['finalServiceName'] + "'. Please assign manually: \n               - " + "\n               - ".join(item['errors']))
+            content = "\n " + formatDate() + "\n Failed to assign permission. \n   - " + item['finalServiceName'] + "\n   - " + "\n   - ".join(item['errors']) + "\n"
+            recordPermissionFailure(run, content)
+        journalRecord(run, item['service'], 'permissions' + run['journalTag'])
+
+
+def getPermissions(serverName, serverPort, adminUser, adminPass, folderName, serviceName, serviceType):
+
+    if  folderName == 'root' or folderName == '':
+        url = "/arcgis/admin/services/" + serviceName + "." + serviceType + "/permissions"
+    else:
+        url = "/arcgis/admin/services/" + folderName + "/" + serviceName + "." + serviceType + "/permissions"
+
+    response, data = postAdminRequest(serverName, serverPort, adminUser, adminPass, url)
+
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        raise ValueError("     Unable to get the permission on the " + serviceType + " '" + serviceName + "'")
+    else:
+        permissionsJSON = json.loads(data)
+        return permissionsJSON['permissions']
+        
+        
+def applyPermission(serverName, serverPort, adminUser, adminPass, folderName, serviceName, serviceType, role, isAllowed):
+
+    params = {'principal':role,'isAllowed':isAllowed}
+    
+    if  folderName == 'root' or folderName == '':
+        url = "/arcgis/admin/services/" + serviceName + "." + serviceType + "/permissions/add"
+    else:
+        url = "/arcgis/admin/services/" + folderName + "/" + serviceName + "." + serviceType + "/permissions/add"
+
+    response, data = postAdminRequest(serverName, serverPort, adminUser, adminPass, url, params)
+                
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        if (isAllowed): 
+            raise ValueError("     Unable to assign the permission '" + role + "' on the " + serviceType + " '" + serviceName + "'")        
+        
+
+def searchRole(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role):
+
+    ''' Function to make sure the role of the origin server exists in the destination server.
+    The roles and users of both servers are read once per run (see loadSecurityIndex) and every role is
+    only checked once per run, however many services use it.
+    '''
+    key = (fromServerName, str(fromServerPort), toServerName, str(toServerPort), role.lower())
+
+    with securityIndexLock:
+        if key in syncedRoles:
+            return
+
+    # Only one thread synchronises the role, the others wait for it
+    with securityKeyLock(('role',) + key):
+        with securityIndexLock:
+            if key in syncedRoles:
+                return
+
+        destination = loadSecurityIndex(toServerName, toServerPort, toAdminUser, toAdminPass)
+        if role.lower() not in destination['roles']:
+            #If the role does not exists, create it
+            createRoleAndPrivileges(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role)
+
+        with securityIndexLock:
+            syncedRoles.add(key)
+
+
+def securityKeyLock(key):
+
+    #Lock of an index, role or user of the security synchronisation
+    with securityIndexLock:
+        if key not in securityLocks:
+            securityLocks[key] = threading.Lock()
+        return securityLocks[key]
+
+
+def loadSecurityIndex(server, port, adminUser, adminPass, privileges=False):
+
+    ''' Function to read the roles and the users of a server with paginated requests.
+    The index is kept for the whole run: {'roles': {rolename in lowercase: role}, 'users': {username: user}}.
+    privileges = Also read the privilege of the roles (only needed for the origin server)
+    Only one thread reads the index of a server, the others wait for it and use it.
+    '''
+    key = (server, str(port))
+    with securityKeyLock(('index',) + key):
+        with securityIndexLock:
+            if key in securityIndex and (securityIndex[key]['privileges'] or not privileges):
+                return securityIndex[key]
+
+        index = readSecurityIndex(server, port, adminUser, adminPass, privileges)
+
+        with securityIndexLock:
+            securityIndex[key] = index
+        return index
+
+
+def readSecurityIndex(server, port, adminUser, adminPass, privileges):
+
+    #Roles and users of a server (see loadSecurityIndex)
+    index = {'roles': {}, 'users': {}, 'privileges': privileges}
+
+    # The roles, the users and the roles of each privilege (one request per privilege instead of one per role) are read at the same time
+    rolePrivileges = ()
+    if privileges: rolePrivileges = ('ADMINISTER', 'PUBLISH', 'ACCESS')
+    lookups = [(getSecurityPages, (server, port, adminUser, adminPass, "/arcgis/admin/security/roles/getRoles", 'roles')),
+               (getSecurityPages, (server, port, adminUser, adminPass, "/arcgis/admin/security/users/getUsers", 'users'))]
+    lookups.extend([(postAdminRequest, (server, port, adminUser, adminPass, "/arcgis/admin/security/roles/getRolesByPrivilege", {'privilege': privilege})) for privilege in rolePrivileges])
+    results = adminLookups(lookups)
+
+    for role in results[0]:
+        role['privilege'] = None
+        index['roles'][role['rolename'].lower()] = role
+
+    for privilege, (response, data) in zip(rolePrivileges, results[2:]):
+        if response.status == 200 and assertJsonSuccess(data):
+            for rolename in json.loads(data).get('rolenames', []):
+                if rolename.lower() in index['roles']:
+                    index['roles'][rolename.lower()]['privilege'] = privilege
+
+    for user in results[1]:
+        index['users'][user['username']] = user
+    return index
+
+
+def getSecurityPages(server, port, adminUser, adminPass, url, name):
+
+    #All the items of a paginated security list (roles/getRoles, users/getUsers)
+    items = []
+    while True:
+        params = {'startIndex': len(items), 'pageSize': SECURITY_PAGE_SIZE}
+        response, data = postAdminRequest(server, port, adminUser, adminPass, url, params)
+
+        if (response.status != 200 or not assertJsonSuccess(data)):
+            raise ValueError("Unable to read the " + name + " of server '" + server + "'.")
+        page = json.loads(data)
+        items.extend(page[name])
+        if not page.get('hasMore') or page[name] == []:
+            return items
+
+
+def clearSecurityIndex():
+
+    #The roles and users are read again in every run
+    with securityIndexLock:
+        securityIndex.clear()
+        securityLocks.clear()
+        syncedRoles.clear()
+
+
+def createRoleAndPrivileges(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role):
+
+    ''' Function to create a role of the origin server in the destination server, with its privilege and users.
+    The role, privilege and user details come from the security indexes of both servers; only the users missing
+    in the destination are created, and all the users are added to the role SECURITY_BATCH_SIZE at a time.
+    Called holding the lock of the role (see searchRole). The indexes of both servers are loaded at the same time
+    by adminLookups threads, and each missing user is created holding its own lock, as other roles may have it too.
+    '''
+    origin, destination = adminLookups([(loadSecurityIndex, (fromServerName, fromServerPort, fromAdminUser, fromAdminPass, True)),
+                                        (loadSecurityIndex, (toServerName, toServerPort, toAdminUser, toAdminPass))])
+
+    #Check the original properties of the role
+    originalRole = origin['roles'].get(role.lower())
+    if originalRole is None:
+        return
+    originalRoleName = originalRole['rolename']
+    originalRoleDescription = originalRole.get('description', '')
+    privilege = originalRole['privilege']
+
+    #Get users within the role, and the privileges of the role at the same time
+    lookups = [(postAdminRequest, (fromServerName, fromServerPort, fromAdminUser, fromAdminPass, "/arcgis/admin/security/roles/getUsersWithinRole",
+                                   {'rolename':originalRoleName,'filter':'','maxCount':SECURITY_MAX_USERS}))]
+    if privilege is None:
+        lookups.append((postAdminRequest, (fromServerName, fromServerPort, fromAdminUser, fromAdminPass, "/arcgis/admin/security/roles/getPrivilege", {'rolename':originalRoleName})))
+    results = adminLookups(lookups)
+
+    if privilege is None:
+        response, data = results[1]
+        if (response.status != 200 or not assertJsonSuccess(data)):
+            raise ValueError("Unable to get privileges for role '" + role + "'.")
+        privilege = json.loads(data)['privilege']
+
+    response, data = results[0]
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        raise ValueError("Unable to get users for role '" + role + "'.")
+    users = json.loads(data)['users']
+
+    #Create the role in the destination server
+    url = "/arcgis/admin/security/roles/add"
+    params = {'rolename':originalRoleName,'description':originalRoleDescription}
+
+    response, data = postAdminRequest(toServerName, toServerPort, toAdminUser, toAdminPass, url, params)
+
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        return
+    arcpy.AddMessage("     - Role '" + originalRoleName + "' created successfully.")
+    destination['roles'][originalRoleName.lower()] = {'rolename': originalRoleName, 'description': originalRoleDescription, 'privilege': privilege}
+
+    #Assign privileges to the role in the destination server
+    url = "/arcgis/admin/security/roles/assignPrivilege"
+    params = {'rolename':originalRoleName,'privilege':privilege}
+
+    response, data = postAdminRequest(toServerName, toServerPort, toAdminUser, toAdminPass, url, params)
+
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        raise ValueError("Unable to privilege '" + privilege + "' for role '" + role + "'.")
+    arcpy.AddMessage("       Privilege '" + privilege + "' assigned successfully.")
+
+    #Search the details of the users missing in the origin index, all at the same time
+    missing = [username for username in users if username not in destination['users'] and username not in origin['users']]
+    searches = adminLookups([(postAdminRequest, (fromServerName, fromServerPort, fromAdminUser, fromAdminPass, "/arcgis/admin/security/users/search",
+                                                 {'filter':username,'maxCount':'1'})) for username in missing])
+    details = dict(zip(missing, searches))
+
+    #Create the users that do not exist in the destination server
+    for username in users:
+        with securityKeyLock(('user', toServerName, str(toServerPort), username)):
+            createRoleUser(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass,
+                           role, username, origin, destination, details)
+
+    #Add the users to the role, several in each request
+    for start in range(0, len(users), SECURITY_BATCH_SIZE):
+        batch = users[start:start + SECURITY_BATCH_SIZE]
+        url = "/arcgis/admin/security/roles/addUsersToRole"
+        params = {'rolename':originalRoleName,'users':",".join(batch)}
+
+        response, data = postAdminRequest(toServerName, toServerPort, toAdminUser, toAdminPass, url, params)
+
+        if (response.status != 200 or not assertJsonSuccess(data)):
+            raise ValueError("Unable to add users '" + ",".join(batch) + "' to role '" + role + "'.")
+
+
+def createRoleUser(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role, username, origin, destination, details):
+
+    #Create a user of a role in the destination server, unless it exists (called holding the lock of the user)
+    if username in destination['users']:
+        return
+
+    user = origin['users'].get(username)
+    if user is None:
+        response, data = details[username]
+
+        if (response.status != 200 or not assertJsonSuccess(data) or json.loads(data)['users'] == []):
+            raise ValueError("Unable to get user '" + username + "' details for role '" + role + "'.")
+        user = json.loads(data)['users'][0]
+
+    url = "/arcgis/admin/security/users/add"
+    params = {'username': user['username'], 'disabled': user.get('disabled', False), 'password': 'changeme'}
+    if user.get('fullname'): params['fullname'] = user['fullname'].encode('utf8', 'strict')
+    if user.get('description'): params['description'] = user['description'].encode('utf8', 'strict')
+    if user.get('email'): params['email'] = user['email']
+
+    try:
+        response, data = postAdminRequest(toServerName, toServerPort, toAdminUser, toAdminPass, url, params)
+    except (httplib.HTTPException, socket.error), e:
+        raise ValueError("Unable to create user '" + username + "' for role '" + role + "': " + str(e))
+
+    if (response.status != 200 or not assertJsonSuccess(data)):
+        raise ValueError("Unable to create user '" + username + "' for role '" + role + "'.")
+    arcpy.AddMessage("       User '" + username + "' created successfully.")
+    destination['users'][username] = {'username': username}
+
+
+def runHeader(toServerName, toServerPort, toAdminUser):
+
+    #Header of Success.txt and Failure.txt
+    return "\n *************************************************************************** \n           Publishing in Server: " + toServerName + " Port: " + toServerPort + " AdminUser: " + toAdminUser + "\n           " + formatDate() + "\n *************************************************************************** "
+
+
+def writeTxtFile(success, content, number, content1, workspace):
+
+    #Queue a result for Success.txt or Failure.txt, after the header (content1) if it is the first one of the run
+    if success == True: fileName = workspace + "Success.txt"
+    else: fileName = workspace + "Failure.txt"
+    if number == 1: content = content1 + content
+    createTxtFile(fileName, content)
+
+
+def createTxtFile(fileName, content):
+
+    ''' Function to append content to a run log file (Success.txt, Failure.txt).
+    While the run log is open (see openRunLog) the content is queued for its writer thread, which keeps the order
+    of the calls. Otherwise the file is opened and appended at once.
+    '''
+    with runLogLock:
+        if runLog['queue'] is not None:
+            runLog['queue'].put((fileName, content))
+            return
+
+    # Append mode adds to the existing content, e.g. for keeping a log file. Append
+    # mode will _never_ harm the existing contents of a file.
+    try:
+        # This tries to open an existing file but creates a new file if necessary.
+        logfile = open(fileName, "a")
+        try:
+            logfile.write(content)
+        finally:
+            logfile.close()
+    except IOError:
+        pass
+
+
+def openRunLog():
+
+    ''' Function to start the writer thread of the run log. From now on createTxtFile only queues the content
+    and returns, and the writer appends it (see runLogWriter) until closeRunLog.
+    The worker processes send their results to the main process (see processStageChain), so only its writer
+    writes to the files.
+    '''
+    with runLogLock:
+        if runLog['queue'] is not None:
+            return
+        runLog.update({'queue': Queue.Queue(), 'lost': [], 'error': None})
+        runLog['thread'] = threading.Thread(target=runLogWriter, args=(runLog['queue'],))
+        runLog['thread'].daemon = True
+        runLog['thread'].start()
+
+
+def closeRunLog():
+
+    #Write what is still queued and stop the writer thread (also when the tool exits before the end of the run)
+    with runLogLock:
+        if runLog['queue'] is None:
+            return
+        runLog['queue'].put(None)
+        thread = runLog['thread']
+        runLog.update({'queue': None, 'thread': None})
+    thread.join()
+
+    if runLog['lost'] != []:
+        arcpy.AddWarning("     " + str(len(runLog['lost'])) + " results could not be written to " + ", ".join(sorted(set([os.path.basename(record[0]) for record in runLog['lost']]))) + ": " + runLog['error'])
+
+
+def runLogWriter(logQueue):
+
+    ''' Function run by the writer thread of the run log.
+    The content queued meanwhile is appended together, each file being opened once (see writeRunLogBatch).
+    What can not be written, e.g. while the share of the workspace is not reachable, is kept and written with the
+    next batch, after at most LOG_RETRY_SECONDS. None stops the writer.
+    '''
+    pending = []
+    stop = False
+    while not stop:
+        try:
+            if pending == []: record = logQueue.get()
+            else: record = logQueue.get(True, LOG_RETRY_SECONDS)
+            while True:
+                if record is None:
+                    stop = True
+                    break
+                pending.append(record)
+                record = logQueue.get_nowait()
+        except Queue.Empty:
+            pass
+        pending = writeRunLogBatch(pending)
+
+    runLog['lost'] = pending
+
+
+def writeRunLogBatch(records):
+
+    #Append the content of the records (fileName, content) to their files in order. Returns the records not written.
+    fileNames = []
+    contents = {}
+    for fileName, content in records:
+        if fileName not in contents:
+            fileNames.append(fileName)
+            contents[fileName] = []
+        contents[fileName].append(content)
+
+    failed = []
+    for fileName in fileNames:
+        try:
+            logfile = open(fileName, "a")
+            try:
+                logfile.write("".join(contents[fileName]))
+            finally:
+                logfile.close()
+        except IOError, e:
+            runLog['error'] = str(e)
+            failed.extend([record for record in records if record[0] == fileName])
+    return failed
+
+
+def transferMapServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceList, toServerName, toServerPort, toAdminUser, toAdminPass, serviceType, workspace, newFolder,
+                        overwrite, workFolder, token=None, workers=None, snapshot=None, delta=False, resume=False, deferPermissions=False, sdCache=None, processes=0, schedule=None, metrics=True, trace=False, catalog=None, destinations=None):
+
+    ''' Function to transfer the services of the list from the origin to the destination server.
+    The services go through the copy, draft, stage, upload and permissions stages as a pipeline, so while
+    one service uploads the next ones are staging and copying.
+    workers = Optional dictionary with the number of worker threads per stage (defaults to PIPELINE_WORKERS)
+    snapshot = Optional snapshot of the origin server (see snapshotServer) to read the service properties and permissions from
+    delta = Copy only the files changed since the sources were copied to this workspace by an earlier run (see deltaCopy)
+    resume = Go on with the interrupted run of this workspace, skipping the stages its journal records (see openJournal)
+    deferPermissions = Set the permissions of all the services at the end, grouped by role (see applyDeferredPermissions)
+    sdCache = Optional folder of the SD cache, to reuse the service definitions staged by earlier runs (see getCachedSd)
+    processes = Number of worker processes that create, analyse and stage the service definitions (see startProcessPool),
+                0 to do it in the pipeline threads
+    schedule = Optional file with the times of the earlier runs, to transfer the services longest first (see scheduleServices)
+    metrics = Write the size, stage times, admin requests and outcome of each service to METRICS_FILE (see recordMetrics)
+    trace = Write every admin request to HTTP_TRACE_FILE in the workspace (see traceRequest)
+    catalog = Optional dictionary to migrate the whole origin server instead of serviceList, with the 'include' and 'exclude'
+              patterns and the 'shard' (i, N) of the services. They are listed folder by folder as the transfer goes on
+              (see streamServerServices), so they are not scheduled longest first.
+    destinations = Optional list of more destination servers (server, port, adminUser, adminPass). Each service is staged once
+                   and published in all of them (see fanOutDestination).
+    '''
+    workspace = workspace + "\\"
+                
+    content1 = runHeader(toServerName, toServerPort, toAdminUser)
+  
+    # Getting services from tool validation creates a semicolon delimited list that needs to be broken up
+    selection = {}
+    if catalog is None:
+        services = serviceList.split(';')
+        selection['selected'] = len(services)
+    else:
+        services = streamServerServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceType, catalog.get('include'), catalog.get('exclude'),
+                                        catalog.get('shard'), selection)
+        # The scheduler would read and list the services ahead of the pipeline
+        schedule = None
+    
+    con = makeAGSconnection(toServerName, toServerPort, toAdminUser, toAdminPass, workspace)
+
+    clearSecurityIndex()
+    openRunLog()
+    with throttlesLock:
+        throttles.clear()
+    with httpTraceLock:
+        httpTrace['endpoints'].clear()
+    if trace and HTTP_TRACE_FILE != "":
+        openHttpTrace(workspace + HTTP_TRACE_FILE)
+
+    run = {'fromServerName': fromServerName, 'fromServerPort': fromServerPort, 'fromAdminUser': fromAdminUser, 'fromAdminPass': fromAdminPass,
+           'toServerName': toServerName, 'toServerPort': toServerPort, 'toAdminUser': toAdminUser, 'toAdminPass': toAdminPass,
+           'serviceType': serviceType, 'workspace': workspace, 'newFolder': newFolder, 'overwrite': overwrite, 'workFolder': workFolder,
+           'con': con, 'content1': content1, 'successNumber': 0, 'failureNumber': 0, 'permissionFailures': 0, 'backupPath': None, 'lock': threading.Lock(), 'snapshot': None, 'delta': delta,
+           'journal': openJournal(workspace, resume), 'resumedNumber': 0, 'deferPermissions': deferPermissions, 'deferredPermissions': [], 'sdCache': sdCache, 'metrics': None,
+           'logPrefix': "", 'journalTag': ""}
+
+    run['destinations'] = [run]
+    for destination in destinations or []:
+        run['destinations'].append(fanOutDestination(run, *destination))
+    if len(run['destinations']) > 1:
+        arcpy.AddMessage("  ** Publishing in " + str(len(run['destinations'])) + " servers: " + ", ".join([destination['toServerName'] + ":" + str(destination['toServerPort']) for destination in run['destinations']]))
+
+    #Index the folders and services of the servers once for the whole run, all at the same time (the origin is listed as the services are taken)
+    lookups = [(buildCatalogIndex, (destination['toServerName'], destination['toServerPort'], destination['toAdminUser'], destination['toAdminPass'])) for destination in run['destinations']]
+    if catalog is None:
+        lookups.insert(0, (buildCatalogIndex, (fromServerName, fromServerPort, fromAdminUser, fromAdminPass)))
+    adminLookups(lookups)
+
+    if metrics and METRICS_FILE != "":
+        run['metrics'] = openMetrics(workspace, resume)
+
+    if resume:
+        arcpy.AddMessage("  ** Resuming the interrupted run of " + workspace + " (" + str(len(run['journal']['done'])) + " services in the journal)")
+
+    if sdCache is not None and not os.path.isdir(sdCache):
+        os.makedirs(sdCache)
+
+    if catalog is not None:
+        description = "  ** Migrating every " + serviceType + " service of '" + fromServerName + "'"
+        if catalog.get('include'): description = description + ", matching " + " or ".join(catalog['include'])
+        if catalog.get('exclude'): description = description + ", not matching " + " or ".join(catalog['exclude'])
+        if catalog.get('shard'): description = description + ", shard " + str(catalog['shard'][0]) + " of " + str(catalog['shard'][1])
+        arcpy.AddMessage(description)
+
+    if snapshot:
+        run['snapshot'] = loadSnapshot(snapshot)
+        arcpy.AddMessage("  ** Reading the origin services from the snapshot: " + snapshot)
+
+    stageWorkers = dict(PIPELINE_WORKERS)
+    if workers is not None: stageWorkers.update(workers)
+
+    stages = [('copy', copyServiceStage, stageWorkers['copy']),
+              ('draft', draftServiceStage, stageWorkers['draft']),
+              ('stage', stageServiceStage, stageWorkers['stage']),
+              ('upload', uploadServiceStage, stageWorkers['upload']),
+              ('permissions', permissionServiceStage, stageWorkers['permissions'])]
+
+    # One pipeline thread per worker process, each waiting for the service definition of a service
+    if processes > 0:
+        run['processPool'] = startProcessPool(run, processes)
+        stages[1:3] = [('draft', processChainStage, processes)]
+
+    if run['metrics'] is not None:
+        run['metrics']['stages'] = [stage[0] for stage in stages]
+
+    # Threads of the upload and permission workers for the extra destinations of their service
+    if len(run['destinations']) > 1:
+        run['fanOutPool'] = ThreadPool((stageWorkers['upload'] + stageWorkers['permissions']) * len(run['destinations']))
+
+    #modify the services(s)
+    jobs = ({'service': urllib.quote(service.encode('utf8'))} for service in services)
+    if schedule is not None:
+        history = loadScheduleHistory(schedule)
+        scheduled = []
+        jobs = scheduleServices(jobs, run, history, scheduled)
+    try:
+        runPipeline(jobs, stages, run)
+    finally:
+        # Also when the run is stopped, its journal is left open for RESUME
+        if processes > 0:
+            run['processPool'].close()
+            run['processPool'].join()
+        if 'fanOutPool' in run:
+            run['fanOutPool'].close()
+        closeArcpyThread()
+    if schedule is not None:
+        saveScheduleHistory(schedule, history, scheduled)
+    for destination in run['destinations']:
+        applyDeferredPermissions(destination)
+    closeJournal(run)
+    closeRunLog()
+                    
+    number = numberOfServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceType)
+
+    temp_workspace = string.replace(workspace,':','',1)
+    #migration_backup = string.replace(temp_workspace, 'X', os.path.join(r'\\' + socket.gethostname(), 'x'), 1)
+    migration_backup = os.path.join(r'\\' + socket.gethostname(), temp_workspace)
+    
+    arcpy.AddMessage("\n***************************************************************************  ")
+    arcpy.AddMessage(" - Number of services in '" + fromServerName + "': " + str(number))
+    arcpy.AddMessage(" - Number of services selected in '" + fromServerName + "': " + str(selection['selected']))
+    for destination in run['destinations']:
+        arcpy.AddMessage(" - Number of services transfered successfully to '" + destination['toServerName'] + "': " + str(destination['successNumber']))
+        arcpy.AddMessage(" - Number of services not transfered to '" + destination['toServerName'] + "': " + str(destination['failureNumber']))
+        if destination['permissionFailures'] > 0:
+            arcpy.AddMessage(" - Number of services transfered to '" + destination['toServerName'] + "' whose permissions must be assigned manually: " + str(destination['permissionFailures']))
+    if resume:
+        arcpy.AddMessage(" - Number of services already transfered by the interrupted run: " + str(run['resumedNumber']))
+    if delta:
+        arcpy.AddMessage(" - Sources copied: " + formatSize(copyStats['copied']) + ", unchanged and not copied again: " + formatSize(copyStats['skipped']))
+    if sdCache is not None:
+        arcpy.AddMessage(" - Service definitions reused from the SD cache: " + str(sdCacheStats['reused']) + " (" + str(sdCacheStats['stored']) + " staged and cached)")
+    arcpy.AddMessage(" - Token requests saved by reusing tokens: " + str(tokenRequestsSaved()) + " (" + str(tokenStats['requested']) + " generated)")
+    arcpy.AddMessage(" - Admin requests sent: " + str(httpStats['requests']) + " over " + str(httpStats['connections']) + " connections")
+    reportHttpTrace()
+    if httpTrace['file'] is not None:
+        closeHttpTrace()
+        arcpy.AddMessage(" - The admin requests are traced in: " + workspace + HTTP_TRACE_FILE)
+    reportThrottles()
+    reportMetrics(run)
+    closeConnections()
+    
+    arcpy.AddMessage("\n - The migration backup is placed in: " + migration_backup)
+    
+    for destination in run['destinations']:
+        if destination['backupPath'] is not None and overwrite == 'true':
+             arcpy.AddMessage(" - Old service backup is placed in: " + destination['backupPath'])
+        
+    arcpy.AddMessage("***************************************************************************  ")
+
+
+def runPipeline(jobs, stages, run):
+
+    ''' Function to push the jobs through the stages of the transfer.
+    stages = List of (name, function, workers). A stage function returns True to pass the job on to the next stage.
+    Each stage reads from a queue of at most PIPELINE_QUEUE_SIZE jobs, so a fast stage waits for a slow one.
+    An error that is not an Exception (SystemExit, KeyboardInterrupt) stops the run: the jobs left are not
+    transferred and the error is raised again here once every worker has stopped.
+    '''
+    queues = [Queue.Queue(PIPELINE_QUEUE_SIZE) for stage in stages]
+    remaining = [stage[2] for stage in stages]
+    remainingLock = threading.Lock()
+    threads = []
+
+    def worker(position):
+        name, function = stages[position][0], stages[position][1]
+
+        try:
+            while True:
+                job = queues[position].get()
+                if job is None: break
+
+                # The run was stopped, the jobs still queued are dropped
+                if 'stopped' in run: continue
+
+                try:
+                    start = time.time()
+                    requestContext.job = job
+                    try:
+                        forward = function(job, run)
+                    finally:
+                        requestContext.job = None
+                        job.setdefault('timings', {})[name] = time.time() - start
+                except Exception, e:
+                    arcpy.AddWarning("     Unexpected error in the " + name + " stage of '" + job['service'] + "': " + str(e))
+                    content = "\n " + formatDate() + "\n Unexpected error in the " + name + " stage.\n   - " + job['service'] + "\n   - " + str(e) + "\n"
+                    recordFailure(job, run, content)
+                    forward = False
+                except BaseException, e:
+                    arcpy.AddWarning("     The run was stopped in the " + name + " stage of '" + job['service'] + "': " + repr(e))
+                    content = "\n " + formatDate() + "\n The run was stopped in the " + name + " stage.\n   - " + job['service'] + "\n   - " + repr(e) + "\n"
+                    recordFailure(job, run, content)
+                    run.setdefault('stopped', sys.exc_info())
+                    forward = False
+
+                if forward and position + 1 < len(stages):
+                    queues[position + 1].put(job)
+                else:
+                    if forward: job['completed'] = True
+                    recordMetrics(run, job, name)
+
+        finally:
+            # The last worker of a stage tells the workers of the next one to stop
+            with remainingLock:
+                remaining[position] = remaining[position] - 1
+                last = remaining[position] == 0
+            if last and position + 1 < len(stages):
+                for i in range(stages[position + 1][2]):
+                    queues[position + 1].put(None)
+
+    for position in range(len(stages)):
+        for i in range(stages[position][2]):
+            thread = threading.Thread(target=worker, args=(position,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+    for job in jobs:
+        if 'stopped' in run: break
+        queues[0].put(job)
+    for i in range(stages[0][2]):
+        queues[0].put(None)
+
+    for thread in threads:
+        thread.join()
+
+    if 'stopped' in run:
+        error = run['stopped']
+        raise error[0], error[1], error[2]
+
+
+def recordResult(run, success, content):
+
+    #Count the result of a service and write it to Success.txt or Failure.txt
+    with run['lock']:
+        # A worker process sends its results to the main process (see processStageChain)
+        if 'results' in run:
+            run['results'].append((success, content))
+            return
+
+        if success == True:
+            run['successNumber'] = run['successNumber'] + 1
+            number = run['successNumber']
+        else:
+            run['failureNumber'] = run['failureNumber'] + 1
+            number = run['failureNumber']
+        writeTxtFile(success, content, number, run['content1'], run['workspace'] + run['logPrefix'])
+
+
+def recordPermissionFailure(run, content=None):
+
+    ''' Function to count a transferred service whose permissions could not all be assigned (shown in the summary).
+    It stays a success: the failure is a note of its entry in Success.txt, or content is appended to Success.txt
+    when the permissions are assigned after the last upload (see applyDeferredPermissions).
+    '''
+    with run['lock']:
+        run['permissionFailures'] = run['permissionFailures'] + 1
+    if content is not None:
+        createTxtFile(run['workspace'] + run['logPrefix'] + "Success.txt", content)
+
+
+def recordFailure(job, run, content):
+
+    #Count a service that failed as not transferred in each destination it was still going to (all of them before the upload)
+    if 'results' in run:
+        # The main process records it for the destinations of the service (see processChainStage)
+        recordResult(run, False, content)
+        return
+
+    for number in job.get('destinations', [0]):
+        recordResult(run['destinations'][number], False, content)
+
+
+def fanOutDestination(run, toServerName, toServerPort, toAdminUser, toAdminPass):
+
+    ''' Function to add an extra destination server to the run (fan-out).
+    The destination is a copy of the run with its own server, connection file, results files, counts and backups.
+    Its stages are journaled with its journalTag ('uploaded@server:port'), the ones of the run destination without it.
+    '''
+    destination = dict(run)
+    destination.update({'toServerName': toServerName, 'toServerPort': toServerPort, 'toAdminUser': toAdminUser, 'toAdminPass': toAdminPass,
+                        'con': makeAGSconnection(toServerName, toServerPort, toAdminUser, toAdminPass, run['workspace']),
+                        'content1': runHeader(toServerName, toServerPort, toAdminUser), 'successNumber': 0, 'failureNumber': 0, 'permissionFailures': 0, 'backupPath': None,
+                        'deferredPermissions': [], 'workFolder': os.path.join(run['workFolder'], toServerName + "_" + str(toServerPort)),
+                        'logPrefix': toServerName + "_" + str(toServerPort) + "_", 'journalTag': "@" + toServerName + ":" + str(toServerPort)})
+    return destination
+
+
+def fanOut(job, run, function):
+
+    #Call function(job, destination) for the destinations of the service at the same time, and keep the ones it succeeded in
+    destinations = [run['destinations'][number] for number in job['destinations']]
+
+    def call(destination):
+        requestContext.job = job
+        try:
+            return callCaught(function, (job, destination))
+        finally:
+            requestContext.job = None
+
+    if len(destinations) == 1:
+        results = [function(job, destinations[0])]
+    else:
+        results = [callResult(outcome) for outcome in run['fanOutPool'].map(call, destinations)]
+    job['destinations'] = [number for number, success in zip(job['destinations'], results) if success]
+    return job['destinations'] != []
+
+
+def destinationName(run):
+
+    #Server of a destination in the messages of a fan-out run
+    if len(run['destinations']) == 1: return ""
+    return " in '" + run['toServerName'] + ":" + str(run['toServerPort']) + "'"
+
+
+def openMetrics(workspace, resume=False):
+
+    ''' Function to open the metrics file of the run, "metrics.jsonl" in the workspace.
+    Each service that leaves the pipeline is written to it as a JSON line (see recordMetrics) and its stage
+    times are kept for the summary of the run (see reportMetrics). A resumed run appends to the former metrics.
+    '''
+    metricsFile = workspace + METRICS_FILE
+    if resume: mode = "a"
+    else: mode = "w"
+    return {'path': metricsFile, 'file': open(metricsFile, mode), 'lock': threading.Lock(), 'stages': [], 'timings': {}, 'outcomes': {}}
+
+
+def recordMetrics(run, job, stage):
+
+    #Write the bytes copied by this run, stage times, admin requests and outcome of a service that left the pipeline after stage
+    metrics = run['metrics']
+    if metrics is None:
+        return
+
+    if job.get('completed'): outcome = 'transferred'
+    elif job.get('skipped'): outcome = 'skipped'
+    else: outcome = 'failed'
+
+    timings = job.get('timings', {})
+    entry = {'service': job['service'], 'time': formatDate(), 'outcome': outcome, 'stage': stage, 'resumed': job.get('resumed', False),
+             'bytes': job.get('copiedBytes', 0), 'files': job.get('files'), 'requests': job.get('requests', 0),
+             'timings': dict((name, round(seconds, 3)) for name, seconds in timings.items()), 'seconds': round(sum(timings.values()), 3)}
+
+    with metrics['lock']:
+        metrics['file'].write(json.dumps(entry) + "\n")
+        metrics['file'].flush()
+        metrics['outcomes'][outcome] = metrics['outcomes'].get(outcome, 0) + 1
+        for name, seconds in timings.items():
+            metrics['timings'].setdefault(name, []).append(seconds)
+        metrics['timings'].setdefault('total', []).append(sum(timings.values()))
+
+
+def reportMetrics(run):
+
+    #Show the p50, p95 and max time of each stage over the services of the run, and close the metrics file
+    metrics = run['metrics']
+    if metrics is None:
+        return
+
+    with metrics['lock']:
+        metrics['file'].close()
+    if metrics['timings'] == {}:
+        return
+
+    outcomes = ", ".join([str(number) + " " + outcome for outcome, number in sorted(metrics['outcomes'].items())])
+    arcpy.AddMessage(" - Time of each stage per service (" + outcomes + "), the details are in: " + metrics['path'])
+    arcpy.AddMessage("       " + "stage".ljust(12) + "services".rjust(10) + "p50 (s)".rjust(10) + "p95 (s)".rjust(10) + "max (s)".rjust(10))
+    for name in metrics['stages'] + ['total']:
+        timings = sorted(metrics['timings'].get(name, []))
+        if timings == []:
+            continue
+        line = "       " + name.ljust(12) + str(len(timings)).rjust(10)
+        for seconds in (percentile(timings, 0.5), percentile(timings, 0.95), timings[-1]):
+            line = line + ("%.1f" % seconds).rjust(10)
+        arcpy.AddMessage(line)
+
+
+def percentile(values, fraction):
+
+    #Nearest-rank percentile of sorted values
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+def scheduleServices(jobs, run, history, scheduled):
+
+    ''' Function to order the services longest first as they are taken, SCHEDULE_WINDOW at a time.
+    The cost of each service is estimated (see estimateServiceCost) with the model fitted to the times of the
+    earlier runs (history), and the most expensive services of each window go into the pipeline first, so the
+    last one does not keep the other workers waiting. The next window is estimated while the pipeline takes one.
+    The windows keep the order of the list: a long service of a later window is not moved before an earlier window.
+    Yields the jobs in that order and appends them to scheduled (for saveScheduleHistory).
+    '''
+    model = fitScheduleModel(history)
+    jobs = iter(jobs)
+    estimate = lambda job: estimateServiceCost(job, run, history, model)
+    arcpy.AddMessage("  ** Services scheduled longest first, " + str(SCHEDULE_WINDOW) + " at a time.")
+
+    pool = ThreadPool(SCHEDULE_WORKERS)
+    try:
+        window = list(itertools.islice(jobs, SCHEDULE_WINDOW))
+        pending = pool.map_async(estimate, window)
+        while window != []:
+            pending.get()
+            nextWindow = list(itertools.islice(jobs, SCHEDULE_WINDOW))
+            nextPending = pool.map_async(estimate, nextWindow)
+
+            for job in sorted(window, key=lambda job: job['predicted'], reverse=True):
+                scheduled.append(job)
+                yield job
+            window, pending = nextWindow, nextPending
+    finally:
+        pool.close()
+        pool.join()
+
+
+def estimateServiceCost(job, run, history, model):
+
+    ''' Function to estimate the seconds the transfer of a service takes (job['predicted']).
+    The properties of the service are read and its source folder listed here, and kept in the job for the
+    copy stage. A service the interrupted run already copied is estimated from the history only.
+    '''
+    service = job['service']
+    size = None
+    requestContext.job = job
+    if 'copied' not in journalStages(run, service):
+        try:
+            propInitialService = None
+            if run['snapshot'] is not None and run['snapshot'].get(service) is not None:
+                propInitialService = run['snapshot'][service]['properties']
+            else:
+                response, data = postAdminRequest(run['fromServerName'], run['fromServerPort'], run['fromAdminUser'], run['fromAdminPass'], "/arcgis/admin/services/" + service)
+                if response.status == 200 and assertJsonSuccess(data):
+                    propInitialService = json.loads(data)
+                    job['propInitialService'] = propInitialService
+
+            if propInitialService is not None:
+                scan = scanFolder(serviceSourceFolder(run['fromServerName'], propInitialService, os.path.split(service)[1]))
+                if scan['error'] is None:
+                    job['scan'] = scan
+                    size = scan['size']
+        except Exception:
+            # The copy stage reads the service again and reports the error
+            pass
+    requestContext.job = None
+
+    job['predicted'] = predictServiceCost(model, history.get(service), size)
+
+
+def predictServiceCost(model, entry, size):
+
+    ''' Function to predict the seconds of a service: its time in the last run, corrected by the change of size, or the model.
+    The layers of a service are only known once its map is opened, so the model gives it the mean layers of the history.
+    '''
+    if entry is not None:
+        if size is None: return entry['duration']
+        return max(entry['duration'] + (size - entry['size']) * model['secondsPerByte'], 0.0)
+
+    if size is None: size = 0
+    return model['serviceSeconds'] + size * model['secondsPerByte'] + model['layers'] * SCHEDULE_LAYER_SECONDS
+
+
+def fitScheduleModel(history):
+
+    ''' Function to fit the cost model to the services of the earlier runs: the time of a service, without
+    SCHEDULE_LAYER_SECONDS per layer, as fixed seconds plus seconds per byte of its sources (least squares),
+    and the mean layers of the services, whose time predictServiceCost adds back.
+    The default SCHEDULE_* values are used until there are services of different sizes in the history.
+    '''
+    model = {'serviceSeconds': SCHEDULE_SERVICE_SECONDS, 'secondsPerByte': 1.0 / SCHEDULE_BYTES_PER_SECOND, 'layers': 0.0}
+    points = [(float(entry['size']), entry['duration'] - entry.get('layers', 0) * SCHEDULE_LAYER_SECONDS) for entry in history.values()]
+    if len(points) < 2:
+        return model
+
+    meanSize = sum([size for size, seconds in points]) / len(points)
+    meanSeconds = sum([seconds for size, seconds in points]) / len(points)
+    variance = sum([(size - meanSize) ** 2 for size, seconds in points])
+    if variance == 0:
+        return model
+
+    secondsPerByte = sum([(size - meanSize) * (seconds - meanSeconds) for size, seconds in points]) / variance
+    serviceSeconds = meanSeconds - secondsPerByte * meanSize
+    if secondsPerByte > 0 and serviceSeconds >= 0:
+        meanLayers = sum([entry.get('layers', 0) for entry in history.values()]) / float(len(points))
+        model.update({'serviceSeconds': serviceSeconds, 'secondsPerByte': secondsPerByte, 'layers': meanLayers})
+    return model
+
+
+def loadScheduleHistory(historyFile):
+
+    #Size, layers and time of the services transferred by the earlier runs
+    if not os.path.isfile(historyFile):
+        return {}
+    try:
+        historyData = open(historyFile, "r")
+        try:
+            return json.load(historyData)
+        finally:
+            historyData.close()
+    except (IOError, ValueError):
+        return {}
+
+
+def saveScheduleHistory(historyFile, history, jobs):
+
+    ''' Function to report the predicted and actual time of each service and keep the actual times for the next runs.
+    Only the services transferred from start to end in this run are kept.
+    '''
+    arcpy.AddMessage("\n - Predicted and actual time of each service:")
+    for job in jobs:
+        actual = sum(job.get('timings', {}).values())
+        arcpy.AddMessage("     " + job['service'] + ": predicted " + str(round(job['predicted'], 1)) + " s, took " + str(round(actual, 1)) + " s")
+        if job.get('completed') and not job.get('resumed') and job.get('size') is not None:
+            history[job['service']] = {'size': job['size'], 'layers': job.get('layers', 0), 'duration': actual, 'date': formatDate()}
+
+    try:
+        tempFile = historyFile + ".tmp"
+        historyData = open(tempFile, "w")
+        try:
+            json.dump(history, historyData)
+        finally:
+            historyData.close()
+        if os.path.isfile(historyFile): os.remove(historyFile)
+        os.rename(tempFile, historyFile)
+    except (IOError, OSError), e:
+        arcpy.AddWarning("     The times of the services could not be saved: " + str(e))
+
+
+def openJournal(workspace, resume=False):
+
+    ''' Function to open the journal of the run, "journal.jsonl" in the workspace.
+    Every stage completed by a service is appended as a JSON line and written to disk at once, so an
+    interrupted run can be resumed (resume = True) from the last completed stage of each service.
+    Returns the journal with the stages completed by the former run ('done', {service: {stage: data}}).
+    '''
+    journalFile = workspace + JOURNAL_FILE
+    if not resume:
+        return {'file': open(journalFile, "w"), 'lock': threading.Lock(), 'done': {}}
+
+    done = readJournal(journalFile)
+
+    # Start on a new line if the interruption cut the last one
+    cut = False
+    if os.path.isfile(journalFile) and os.path.getsize(journalFile) > 0:
+        journalData = open(journalFile, "rb")
+        try:
+            journalData.seek(-1, 2)
+            cut = journalData.read(1) != "\n"
+        finally:
+            journalData.close()
+    journalData = open(journalFile, "a")
+    if cut: journalData.write("\n")
+    return {'file': journalData, 'lock': threading.Lock(), 'done': done}
+
+
+def readJournal(journalFile):
+
+    #Stages completed by each service. A last line cut by the interruption is ignored.
+    done = {}
+    if not os.path.isfile(journalFile):
+        return done
+    journalData = open(journalFile, "r")
+    try:
+        for line in journalData:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('service') is not None:
+                done.setdefault(entry['service'], {})[entry['stage']] = entry.get('data', {})
+    finally:
+        journalData.close()
+    return done
+
+
+def journalRecord(run, service, stage, data=None):
+
+    #Append a completed stage to the journal
+    if data is None: data = {}
+    line = json.dumps({'service': service, 'stage': stage, 'time': formatDate(), 'data': data})
+    journal = run['journal']
+    with journal['lock']:
+        # A worker process sends its records to the main process (see processStageChain)
+        if journal['file'] is None:
+            journal['records'].append((stage, data))
+            return
+        journal['file'].write(line + "\n")
+        journal['file'].flush()
+        os.fsync(journal['file'].fileno())
+
+
+def journalStages(run, service):
+
+    #Stages of the service completed by the interrupted run
+    return run['journal']['done'].get(service, {})
+
+
+def closeJournal(run):
+
+    #A finished journal is not resumed again
+    journal = run['journal']
+    with journal['lock']:
+        journal['file'].write(json.dumps({'stage': 'finished', 'time': formatDate()}) + "\n")
+        journal['file'].close()
+
+
+def findInterruptedRun(sysTemp, runName):
+
+    ''' Function to find the workspace of the last interrupted run between two servers.
+    runName = Name of the runs: origin_destination, and the shard if the run migrates one (see __main__)
+    Returns the workspace whose journal does not end with 'finished', or None.
+    '''
+    suffix = runName
+    found = None
+    foundTime = 0
+    for name in os.listdir(sysTemp):
+        if name != suffix and not name.endswith('_' + suffix):
+            continue
+        journalFile = os.path.join(sysTemp, name, JOURNAL_FILE)
+        if not os.path.isfile(journalFile):
+            continue
+
+        lastLine = ""
+        journalData = open(journalFile, "r")
+        try:
+            for line in journalData:
+                if line.strip() != "": lastLine = line
+        finally:
+            journalData.close()
+        try:
+            finished = json.loads(lastLine).get('stage') == 'finished'
+        except ValueError:
+            finished = False
+
+        if not finished and os.path.getmtime(journalFile) > foundTime:
+            found = os.path.join(sysTemp, name)
+            foundTime = os.path.getmtime(journalFile)
+    return found
+
+
+def sourceManifestKey(scan):
+
+    #Hash of the files of the service folder (path, size and modification time), the sources part of the SD cache keys
+    manifest = hashlib.sha1()
+    for relPath, size, mtime in sorted(scan['files']):
+        manifest.update(repr((relPath, size, mtime)) + "\n")
+    return manifest.hexdigest()
+
+
+def draftCacheKey(sourceKey, draftXml, workspace):
+
+    #SD cache key of a draft: its sources and the _mod.sddraft, without the path of the run workspace
+    if isinstance(workspace, unicode): workspace = workspace.encode("utf-8")
+    draftData = open(draftXml, "rb")
+    try:
+        draft = draftData.read()
+    finally:
+        draftData.close()
+    return hashlib.sha1(sourceKey + "\n" + draft.replace(workspace, "")).hexdigest()
+
+
+def analysisSummary(analysis):
+
+    #Messages, warnings and errors of AnalyzeForSD without the layer objects, sorted so it can be hashed
+    summary = {}
+    for kind in ('messages', 'warnings', 'errors'):
+        entries = analysis.get(kind, {})
+        if isinstance(entries, dict):
+            entries = sorted([message, code, sorted([layer.name for layer in layers])] for (message, code), layers in entries.iteritems())
+        summary[kind] = entries
+    return summary
+
+
+def sdCacheKey(draftKey, summary):
+
+    #SD cache key of the .sd staged from a draft with that analysis
+    return hashlib.sha1(draftKey + "\n" + json.dumps(summary, sort_keys=True)).hexdigest()
+
+
+def readCachedAnalysis(cacheFolder, draftKey):
+
+    #Analysis of the draft kept by an earlier run, or None
+    analysisFile = os.path.join(cacheFolder, draftKey + ".json")
+    try:
+        analysisData = open(analysisFile, "r")
+        try:
+            summary = json.load(analysisData)
+        finally:
+            analysisData.close()
+        os.utime(analysisFile, None)
+        return summary
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def writeCachedAnalysis(cacheFolder, draftKey, summary):
+
+    #Keep the analysis of a draft without errors
+    analysisFile = os.path.join(cacheFolder, draftKey + ".json")
+    tempFile = analysisFile + "." + str(threading.current_thread().ident) + ".tmp"
+    try:
+        analysisData = open(tempFile, "w")
+        try:
+            json.dump(summary, analysisData)
+        finally:
+            analysisData.close()
+        with sdCacheLock:
+            replaceCacheFile(tempFile, analysisFile)
+    except (IOError, OSError), e:
+        arcpy.AddWarning("     The analysis could not be kept in the SD cache: " + str(e))
+
+
+def getCachedSd(cacheFolder, sdKey, sd):
+
+    ''' Function to copy the .sd of the SD cache named sdKey to sd.
+    The file is touched, so the cache removes the least recently used ones first (see evictSdCache).
+    Returns False if the cache does not have it or it can not be copied.
+    '''
+    cachedSd = os.path.join(cacheFolder, sdKey + ".sd")
+    if not os.path.isfile(cachedSd):
+        return False
+    try:
+        os.utime(cachedSd, None)
+        if os.path.isfile(sd): os.remove(sd)
+        copyErrors = copyFileBatch([(cachedSd, sd, os.path.getsize(cachedSd))])[0]
+    except OSError, e:
+        copyErrors = [(cachedSd, str(e), False)]
+    if copyErrors != []:
+        arcpy.AddWarning("     The .sd of the SD cache could not be copied, staging again: " + copyErrors[0][1])
+        return False
+
+    with sdCacheLock:
+        sdCacheStats['reused'] = sdCacheStats['reused'] + 1
+    return True
+
+
+def putCachedSd(cacheFolder, sdKey, sd):
+
+    #Keep a staged .sd in the SD cache and remove the least recently used files if it is too big
+    cachedSd = os.path.join(cacheFolder, sdKey + ".sd")
+    tempFile = cachedSd + "." + str(threading.current_thread().ident) + ".tmp"
+    copyErrors = copyFileBatch([(sd, tempFile, os.path.getsize(sd))])[0]
+    if copyErrors != []:
+        arcpy.AddWarning("     The .sd could not be kept in the SD cache: " + copyErrors[0][1])
+        if os.path.isfile(tempFile): os.remove(tempFile)
+        return
+
+    with sdCacheLock:
+        try:
+            replaceCacheFile(tempFile, cachedSd)
+            sdCacheStats['stored'] = sdCacheStats['stored'] + 1
+        except OSError, e:
+            arcpy.AddWarning("     The .sd could not be kept in the SD cache: " + str(e))
+        evictSdCache(cacheFolder)
+
+
+def replaceCacheFile(tempFile, cacheFile):
+
+    #Rename a written file to its name in the cache (Windows does not rename over an existing file)
+    try:
+        os.rename(tempFile, cacheFile)
+    except OSError:
+        if os.path.isfile(cacheFile): os.remove(cacheFile)
+        os.rename(tempFile, cacheFile)
+
+
+def evictSdCache(cacheFolder, maxSize=None):
+
+    ''' Function to remove the least recently used files of the SD cache until it is not bigger than maxSize (SD_CACHE_SIZE by default).
+    Files in use (being copied by another stage) are left for the next time.
+    '''
+    if maxSize is None: maxSize = SD_CACHE_SIZE
+    cacheFiles = []
+    cacheSize = 0
+    for name in os.listdir(cacheFolder):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(cacheFolder, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        cacheFiles.append((info.st_mtime, info.st_size, path))
+        cacheSize = cacheSize + info.st_size
+
+    cacheFiles.sort()
+    for mtime, size, path in cacheFiles:
+        if cacheSize <= maxSize:
+            break
+        try:
+            os.remove(path)
+            cacheSize = cacheSize - size
+        except OSError:
+            pass
+
+
+def copyServiceStage(job, run):
+
+    #Read the service properties from the origin server and copy its sources to the workspace
+    service = job['service']
+    workspace = run['workspace']
+    fromServerName = run['fromServerName']
+    serviceURL = "/arcgis/admin/services/" + service
+
+    # Stages already completed by the interrupted run, and the destinations the service is not published in yet
+    done = journalStages(run, service)
+    job['destinations'] = [number for number, destination in enumerate(run['destinations']) if 'permissions' + destination['journalTag'] not in done]
+    if job['destinations'] == []:
+        arcpy.AddMessage("\n  ** Service '" + str(service) + "' was already transfered by the interrupted run.")
+        with run['lock']:
+            run['resumedNumber'] = run['resumedNumber'] + 1
+        job['skipped'] = True
+        return False
+
+    if 'copied' in done and os.path.isfile(done['copied']['mxdFile']):
+        job.update(done['properties'])
+        job.update(done['copied'])
+        lastStage = [stage for stage in JOURNAL_STAGES if stage in done][-1]
+        arcpy.AddMessage("\n  ** Service '" + str(service) + "' resumed after the '" + lastStage + "' stage of the interrupted run.")
+        job['resumed'] = True
+        return True
+
+    # Use the snapshot of the origin server if there is one
+    record = None
+    if run['snapshot'] is not None:
+        record = run['snapshot'].get(service)
+    if record is None and 'properties' in done:
+        record = {'properties': done['properties']['propInitialService'], 'permissions': done['properties']['initialPermissions']}
+
+    if record is not None:
+        propInitialService = record['properties']
+        job['initialPermissions'] = record['permissions']
+    elif 'propInitialService' in job:
+        # Already read by the scheduler
+        propInitialService = job['propInitialService']
+    else:
+        # This request only needs the token and the response formatting parameter 
+        response, data = postAdminRequest(fromServerName, run['fromServerPort'], run['fromAdminUser'], run['fromAdminPass'], serviceURL)
+        
+        if (response.status != 200):
+            arcpy.AddMessage("\n  ** Could not read service '" + str(service) + "' information.")
+            return False
+
+        # Check that data returned is not an error object
+        if not assertJsonSuccess(data):
+            arcpy.AddMessage("\n  ** Error when reading service '" + str(service) + "' information. " + str(data))
+            return False
+
+        # Deserialize response into Python object
+        propInitialService = json.loads(data)
+
+    arcpy.AddMessage("\n  ** Service '" + str(service) + "' information read successfully. Now transfering... (5 steps)")
+
+    if run['newFolder'] != "" : folderName = run['newFolder']
+    else: folderName = os.path.split(service)[0]
+
+    serviceName = os.path.split(service)[1]
+    serviceName2 = serviceName
+    pos3 = serviceName2.find(".MapServer")
+    simpleServiceName = serviceName2[:pos3]
+
+    if  folderName != 'root' or folderName != '':                           
+        finalServiceName = folderName + "//" + simpleServiceName + ".MapServer"
+    else:
+        finalServiceName = serviceName
+
+    job.update({'propInitialService': propInitialService, 'folderName': folderName, 'simpleServiceName': simpleServiceName, 'finalServiceName': finalServiceName})
+    journalRecord(run, service, 'properties', {'propInitialService': propInitialService, 'folderName': folderName, 'simpleServiceName': simpleServiceName,
+                                               'finalServiceName': finalServiceName, 'initialPermissions': job.get('initialPermissions')})
+
+    inputFolderPath = serviceSourceFolder(fromServerName, propInitialService, serviceName)
+
+    #Check if the service exists in each destination, all at the same time
+    numbers = list(job['destinations'])
+    found = adminLookups([(isServicePresent, (run['destinations'][number]['toServerName'], str(run['destinations'][number]['toServerPort']), run['destinations'][number]['toAdminUser'],
+                                              run['destinations'][number]['toAdminPass'], simpleServiceName, folderName, "")) for number in numbers])
+    for number, serviceExists in zip(numbers, found):
+        destination = run['destinations'][number]
+
+        #If service exists and must be overwritten                
+        if serviceExists == True and run['overwrite'] == 'true':
+            backupService(job, destination, serviceName)
+            serviceExists = False
+
+        # Service already is published
+        if serviceExists == True:
+            arcpy.AddWarning("     Service already exists" + (destinationName(destination) or " in the server") + " and can not be created.")
+
+            content = "\n " + formatDate() + "\n Service already exists in the server and can not be created.\n   - " + str(service) + "\n"
+            recordResult(destination, False, content)
+            job['destinations'].remove(number)
+
+    if job['destinations'] == []:
+        return False
+
+    #The path of the folder that contains the service info
+    if folderName != "":
+        try:
+            if not os.path.exists(workspace + folderName):
+                os.makedirs(workspace + folderName)
+        except OSError:
+            # Another worker created it meanwhile
+            if not os.path.isdir(workspace + folderName): raise
+        serviceName = folderName + "\\" + serviceName
+
+    #List the service folder once for the copy, the MXD and the item description (the scheduler may have listed it already)
+    scan = job.get('scan')
+    if scan is None or scan['path'] != inputFolderPath:
+        scan = scanFolder(inputFolderPath)
+
+    #Copy service data (large files are copied in blocks)
+    copyErrors = []
+    written = {'bytes': 0}
+    copyStart = time.time()
+    continuePublish = copy(inputFolderPath, workspace + serviceName, run['delta'], copyErrors, scan, written)
+    copyTime = time.time() - copyStart
+    job['copiedBytes'] = written['bytes']
+
+    if continuePublish == True and not run['delta'] and scan['size'] >= COPY_CHUNK_SIZE:
+        arcpy.AddMessage("     Sources copied: " + formatSize(written['bytes']) + " in " + str(round(copyTime, 1)) + " s (" + formatSize(written['bytes'] / max(copyTime, 0.001)) + "/s).")
+
+    # Service information folder already exists (can't be deleted)
+    if continuePublish != True:
+        if copyErrors == []:
+            arcpy.AddWarning("     Service information folder already exists and can not be created.")
+
+            content = "\n " + formatDate() + "\n Service information folder already exists and can not be created.\n   - " + finalServiceName + "\n"
+        elif True in [error[2] for error in copyErrors]:
+            arcpy.AddWarning("     The source can not be copied because the path is extremely long.")
+
+            content = "\n " + formatDate() + "\n The source can not be copied because the path is extremely long.\n   - " + finalServiceName + "\n"
+        else:
+            arcpy.AddWarning("     The source can not be copied, " + str(len(copyErrors)) + " files failed.")
+
+            content = "\n " + formatDate() + "\n The source can not be copied, " + str(len(copyErrors)) + " files failed.\n   - " + finalServiceName + "\n"
+        for path, message, longPath in copyErrors:
+            content = content + "        --> " + path + ": " + message + "\n"
+        recordFailure(job, run, content)
+        return False
+
+    mxdExist = False
+    #Check for MXD (the copy has the same files as the source)
+    if scan['mxd'] is not None:
+        mxdFile = os.path.join(workspace + serviceName, scan['mxd'])
+        mxdExist = True
+
+    # MXD not found
+    if mxdExist == False:
+        arcpy.AddWarning("     Service MXD not found.")
+        
+        content = "\n " + formatDate() + "\n Service MXD not found.\n   - " + finalServiceName + "\n"
+        recordFailure(job, run, content)
+        return False
+
+    sourceKey = sourceManifestKey(scan)
+    job.update({'serviceName': serviceName, 'mxdFile': mxdFile, 'scan': scan, 'sourceKey': sourceKey, 'size': scan['size'], 'files': len(scan['files'])})
+    journalRecord(run, service, 'copied', {'serviceName': serviceName, 'mxdFile': mxdFile, 'sourceKey': sourceKey})
+    return True
+
 
+def serviceSourceFolder(serverName, propInitialService, serviceName):
 
-def setPermission(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, fromFolderName, toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType):
+    #Shared folder of the server with the sources of the service (the folder of its MSD)
+    pathInitial = propInitialService["properties"]["filePath"]
+    pathInitial = pathInitial.replace(':', '', 1)
+    #msdPath = pathInitial.replace('X', os.path.join(r'\\' + serverName, 'x'), 1)
+    msdPath = os.path.join(r'\\' + serverName, pathInitial)
 
-    initialPermissions = getPermissions(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, fromFolderName, serviceName, serviceType)
-    finalPermissions = getPermissions(toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType)
-    
-    for permission in initialPermissions:
-        role = permission['principal']
+    pos = msdPath.find(serviceName) + len(serviceName)
+    return msdPath[:pos]
 
-        #If the role does not exists and is not a special role, we have to create it, assign privileges and users
-        if role != 'esriAnonymous' and role != 'esriAuthenticated' and role != 'esriEveryone':
-            searchRole(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role)
-            
-        isAllowed = permission['permission']['isAllowed']
-        applyPermission(toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType, role, isAllowed)
 
-    for permission in finalPermissions:
-        if permission not in initialPermissions:
-            role = permission['principal']
-            applyPermission(toServerName, toServerPort, toAdminUser, toAdminPass, toFolderName, serviceName, serviceType, role, False)    
+def backupService(job, run, serviceName):
+
+    #Backup the old service of the destination server before overwriting it
+    folderName = job['folderName']
+    toServerName = run['toServerName']
+    workFolder = run['workFolder']
+    serviceURLforbackup = "/arcgis/admin/services/" + folderName + "/" + serviceName
+
+    # This request only needs the token and the response formatting parameter
+    responseforbackup, dataforbackup = postAdminRequest(toServerName, run['toServerPort'], run['toAdminUser'], run['toAdminPass'], serviceURLforbackup)
     
+    if (responseforbackup.status == 200) and assertJsonSuccess(dataforbackup):
+        propInitialServiceforbackup = json.loads(dataforbackup)
+        pathInitialforbackup = propInitialServiceforbackup["properties"]["filePath"]
+        pathInitialforbackup = pathInitialforbackup.replace(':', '', 1)
+        #msdPathforbackup = pathInitialforbackup.replace('X', os.path.join(r'\\' + toServerName, 'x'), 1)
+        msdPathforbackup = os.path.join(r'\\' + toServerName, pathInitialforbackup)
+        posforbackup = msdPathforbackup.find(serviceName) + len(serviceName) 
+        inputFolderPathforbackup = msdPathforbackup[:posforbackup]
+
+        copyFrom = inputFolderPathforbackup                    
+        copyTo = os.path.join(workFolder, folderName, serviceName)
+
+        # One read of the old service for both the copy and the ZIP file (ZIP64 for large services)
+        continuePublish = backupFolder(copyFrom, copyTo, workFolder + "\\" + folderName + "\\" + serviceName + ".zip", BACKUP_COMPRESSION)
+
+        if continuePublish == True:
+            arcpy.AddMessage("     Step 0: Old service backup done succesfully.")
+        else:
+            arcpy.AddMessage("     Step 0: Error when backing up old service .")
 
-def getPermissions(serverName, serverPort, adminUser, adminPass, folderName, serviceName, serviceType):
+        run['backupPath'] = copyTo
 
-    token = gentoken(serverName, serverPort, adminUser, adminPass) 
-    params = urllib.urlencode({'token': token, 'f': 'json'})
 
-    if  folderName == 'root' or folderName == '':
-        url = "/arcgis/admin/services/" + serviceName + "." + serviceType + "/permissions"
-    else:
-        url = "/arcgis/admin/services/" + folderName + "/" + serviceName + "." + serviceType + "/permissions"
+def draftServiceStage(job, run):
 
-    response, data = postToServer(serverName, str(serverPort), url, params)
+    #Create the customized Service Definition Draft and analyze it
+    service = job['service']
+    workspace = run['workspace']
+    serviceName = job['serviceName']
+    folderName = job['folderName']
+    mxdFile = job['mxdFile']
+    done = journalStages(run, service)
 
-    if (response.status != 200 or not assertJsonSuccess(data)):
-        raise ValueError("     Unable to get the permission on the " + serviceType + " '" + serviceName + "'")
+    mapName = os.path.split(mxdFile)[1]
+    pos2 = mapName.find(".mxd")
+    sdname = mapName[:pos2]
+
+    sddraft = workspace + serviceName + "\\" + sdname + '.sddraft'
+    sd = workspace + serviceName + "\\" + sdname + '.sd'
+
+    mapDoc = arcpyCall(arcpy.mapping.MapDocument, mxdFile)
+    job['layers'] = len(arcpyCall(arcpy.mapping.ListLayers, mapDoc))
+
+    # Reuse the draft of the interrupted run
+    if 'draft' in done and os.path.isfile(done['draft']['draftXml']):
+        draftXml = done['draft']['draftXml']
+        job.update({'mapDoc': mapDoc, 'draftXml': draftXml, 'sd': sd})
+        job.pop('scan', None)
+        if 'analysed' in done:
+            if run['sdCache'] is not None: job['sdKey'] = done['analysed'].get('sdKey')
+            return True
     else:
-        permissionsJSON = json.loads(data)
-        return permissionsJSON['permissions']
+        createFolder(run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], folderName, "")
+
+        #Create a customized Service Definition Draft
+        arcpy.AddMessage("     Step 1: Creating Service Definition Draft (.sddraft) for '" + service + "'")
+        draftXml = CreateServiceDefinitionDraft(mapDoc, sddraft, job['simpleServiceName'], run['con'], folderName, job['propInitialService'], workspace + serviceName, job.pop('scan', None))
+        journalRecord(run, service, 'draft', {'draftXml': draftXml})
+
+    # Key of the draft in the SD cache, and its analysis if an earlier run already made it
+    draftKey = None
+    summary = None
+    if run['sdCache'] is not None and job.get('sourceKey') is not None:
+        draftKey = draftCacheKey(job['sourceKey'], draftXml, workspace)
+        if SD_CACHE_ANALYSIS: summary = readCachedAnalysis(run['sdCache'], draftKey)
+
+    if summary is not None:
+        arcpy.AddMessage("     Step 2: Reusing the analysis of the Service Definition Draft for '" + service + "' from the SD cache")
+        analyseDraft = {'errors': {}}
+    else:
+        #Get the analysis result
+        arcpy.AddMessage("     Step 2: Analyzing Service Definition Draft for '" + service + "'")
+
+        # Analyze the service definition draft
+        analyseDraft = analyseServiceDraft(draftXml, service)
+
+    job.update({'mapDoc': mapDoc, 'draftXml': draftXml, 'sd': sd})
+
+    # Stage and upload the service if the sddraft analysis did not contain errors
+    if analyseDraft['errors'] == {}:
+        if draftKey is not None:
+            if summary is None:
+                summary = analysisSummary(analyseDraft)
+                if SD_CACHE_ANALYSIS: writeCachedAnalysis(run['sdCache'], draftKey, summary)
+            job['sdKey'] = sdCacheKey(draftKey, summary)
+        journalRecord(run, service, 'analysed', {'sdKey': job.get('sdKey')})
+        return True
+
+    # if the sddraft analysis contained errors
+    del job['mapDoc']
+    del mapDoc
+
+    #Service Definition Draft could not be analyzed
+    if analyseDraft['errors'] == "NO":
         
+        arcpy.AddWarning("     Service Definition Draft could not be analyzed.")
         
-def applyPermission(serverName, serverPort, adminUser, adminPass, folderName, serviceName, serviceType, role, isAllowed):
-
-    token = gentoken(serverName, serverPort, adminUser, adminPass) 
-    params = urllib.urlencode({'principal':role,'isAllowed':isAllowed,'token':token,'f':'json'})
-    
-    if  folderName == 'root' or folderName == '':
-        url = "/arcgis/admin/services/" + serviceName + "." + serviceType + "/permissions/add"
+        content = "\n " + formatDate() + "\n Service Definition Draft could not be analyzed.\n"
     else:
-        url = "/arcgis/admin/services/" + folderName + "/" + serviceName + "." + serviceType + "/permissions/add"
+        arcpy.AddWarning("     Service could not be published because errors were found during analysis. \n" + analyseDraft['errors'])                             
+        content = "\n " + formatDate() + "\n Service could not be published because errors were found during analysis. \n " + analyseDraft['errors'] + "\n  "
+    recordFailure(job, run, content)
+    return False
 
-    response, data = postToServer(serverName, str(serverPort), url, params)
-                
-    if (response.status != 200 or not assertJsonSuccess(data)):
-        if (isAllowed): 
-            raise ValueError("     Unable to assign the permission '" + role + "' on the " + serviceType + " '" + serviceName + "'")        
-        
 
-def searchRole(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role):
-    
-    token = gentoken(toServerName, toServerPort, toAdminUser, toAdminPass)
-    url = "/arcgis/admin/security/roles/search"
-    params = urllib.urlencode({'token':token,'f':'json','filter':role})
+def stageServiceStage(job, run):
 
-    response, data = postToServer(toServerName, str(toServerPort), url, params)
+    #Create the Service Definition (.sd) from the analyzed draft
+    sd = job['sd']
+    mapDoc = job.pop('mapDoc')
 
-    if response.status != 200:
-        return
-    else:
-        searchRoles = json.loads(data)
-        if searchRoles['roles'] != []:
-            return 
-        else:
-            #If the role does not exists, create it
-            createRoleAndPrivileges(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role)
-        
+    # Reuse the .sd of the interrupted run
+    if 'staged' in journalStages(run, job['service']) and os.path.isfile(sd):
+        del mapDoc
+        return True
+
+    # Reuse the .sd staged by an earlier run from the same sources and draft
+    sdKey = job.get('sdKey')
+    if sdKey is not None and getCachedSd(run['sdCache'], sdKey, sd):
+        arcpy.AddMessage("     Step 3: Reusing the Service Definition (.sd) for '" + job['service'] + "' from the SD cache")
+        journalRecord(run, job['service'], 'staged')
+        del mapDoc
+        return True
 
+    try:
+        #If SD exist is deleted
+        if os.path.isfile(sd): os.remove(sd)
+
+        # Execute StageService. This creates the service definition.
+        arcpy.AddMessage("     Step 3: Creating Service Definition (.sd) for '" + job['service'] + "'")
+        arcpyCall(arcpy.StageService_server, job['draftXml'], sd)
+        if sdKey is not None: putCachedSd(run['sdCache'], sdKey, sd)
+        journalRecord(run, job['service'], 'staged')
+
+        del mapDoc
+        return True
+
+    # SD can't be created
+    except arcpy.ExecuteError:
+        finalServiceName = job['finalServiceName']
+        strconex = arcpyCall(layerConnection, mapDoc)
+        del mapDoc
         
-def createRoleAndPrivileges(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, toServerName, toServerPort, toAdminUser, toAdminPass, role):
+        if strconex != "":
+            arcpy.AddWarning("     Consolidating the data failed. Please register first the database in the Server DataStore: ")
+            arcpy.AddWarning(strconex)
+            content = "\n " + formatDate() + "\n Consolidating the data failed.\n   - " + finalServiceName + "\n     Please register first the database in the Server DataStore:\n" + strconex + "\n"
+        else:
+            arcpy.AddWarning("     Consolidating the data failed. Please check datasources.")
+            content = "\n " + formatDate() + "\n Consolidating the data failed. Please check datasources. \n   - " + finalServiceName + "\n"
 
-    #Check the original properties of the role
-    token = gentoken(fromServerName, fromServerPort, fromAdminUser, fromAdminPass)
-    url = "/arcgis/admin/security/roles/search"
-    params = urllib.urlencode({'filter':role,'maxCount':'1','f':'json','token':token})
+        recordFailure(job, run, content)
+        return False
 
-    response, data = postToServer(fromServerName, str(fromServerPort), url, params)
 
-    if (response.status != 200 or not assertJsonSuccess(data)):
-        return
-    else:
-        info = json.loads(data)
-        originalRoles = info['roles']   
-        originalRoleName = originalRoles[0]['rolename']
-        originalRoleDescription = originalRoles[0]['description']
- 
-        #Check the privileges of the role
-        url = "/arcgis/admin/security/roles/getPrivilege"
-        params = urllib.urlencode({'rolename':originalRoleName,'f':'json','token':token})
+def layerConnection(mapDoc):
 
-        response, data = postToServer(fromServerName, str(fromServerPort), url, params)
+    #Connection of the layers of the map to a database, for the message of a failed staging (called on the arcpy thread)
+    serviceTypeD = ""
+    serverD = ""
+    serviceD = ""
+    databaseD = ""
+    strconex = ""
 
-        if (response.status != 200 or not assertJsonSuccess(data)):
-            raise ValueError("Unable to get privileges for role '" + role + "'.")
-            return
-        else:
-            privileges = json.loads(data)
-            privilege = privileges['privilege']
+    for lyr in arcpy.mapping.ListLayers(mapDoc):
+        if lyr.supports("SERVICEPROPERTIES"):
+            #Para no repetir las fuentes
+            if serviceTypeD != lyr.serviceProperties["ServiceType"] and serverD != lyr.serviceProperties["Server"] and serviceD != lyr.serviceProperties["Server"] and databaseD != lyr.serviceProperties["Database"]:
+                serviceTypeD = lyr.serviceProperties["ServiceType"]
+                serverD = lyr.serviceProperties["Server"]
+                serviceD = lyr.serviceProperties["Service"]
+                databaseD = lyr.serviceProperties["Database"]
+                strconex = "          * ServiceType: '" + serviceTypeD + "', Server: '" + serverD + "', Service: '" + serviceD + "', Database: '" + databaseD + "'."
+    return strconex
 
-            #Get users within the role
-            url = "/arcgis/admin/security/roles/getUsersWithinRole"
-            params = urllib.urlencode({'rolename':originalRoleName,'filter':'','f':'json','token':token})
 
-            response, data = postToServer(fromServerName, str(fromServerPort), url, params)
+def processChainStage(job, run):
 
-            if (response.status != 200 or not assertJsonSuccess(data)):
-                raise ValueError("Unable to get users for role '" + role + "'.")
-                return
-            else:
-                objectData = json.loads(data)
-                users = objectData['users']
-                usersData = list()
+    ''' Function to create, analyse and stage the service definition in one of the worker processes (see startProcessPool).
+    The messages, journal records and results of the worker are passed on here, in the main process.
+    '''
+    createFolder(run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], job['folderName'], "")
+
+    task = {'job': job, 'done': journalStages(run, job['service'])}
+    outcome = run['processPool'].apply(processStageChain, (task,))
+    job.pop('scan', None)
+
+    for kind, message in outcome['messages']:
+        if kind == 'warning': arcpy.AddWarning(message)
+        elif kind == 'error': arcpy.AddError(message)
+        else: arcpy.AddMessage(message)
+    for stage, data in outcome['records']:
+        journalRecord(run, job['service'], stage, data)
+    for success, content in outcome['results']:
+        if success: recordResult(run, True, content)
+        else: recordFailure(job, run, content)
+    with sdCacheLock:
+        for key in sdCacheStats:
+            sdCacheStats[key] = sdCacheStats[key] + outcome['sdCacheStats'][key]
+    mergeHttpTrace(*outcome['httpTrace'])
+
+    if outcome['error'] is not None:
+        raise RuntimeError(outcome['error'])
+
+    job.update(outcome['job'])
+    return outcome['forward']
+
+
+def startProcessPool(run, processes):
+
+    ''' Function to start the worker processes that create, analyse and stage the service definitions.
+    Each worker gets the destination of the run and its catalog, and makes its own connection file and
+    scratch folder in the run workspace (see initProcessWorker).
+    '''
+    # ArcMap runs the tool inside its own executable, the workers need the Python one
+    executable = os.path.join(sys.exec_prefix, "pythonw.exe")
+    if sys.platform == "win32" and os.path.basename(sys.executable).lower() not in ("python.exe", "pythonw.exe") and os.path.isfile(executable):
+        multiprocessing.set_executable(executable)
 
-                for user in users:
-                    url = "/arcgis/admin/security/users/search"
-                    params = urllib.urlencode({'filter':user,'maxCount':'1','f':'json','token':token})
+    settings = dict((key, run[key]) for key in ('toServerName', 'toServerPort', 'toAdminUser', 'toAdminPass', 'workspace', 'sdCache'))
+    settings.update({'trace': httpTrace['file'] is not None, 'traceStart': httpTrace['start']})
 
-                    response, data = postToServer(fromServerName, str(fromServerPort), url, params)
+    # A forked worker would write again the trace lines not written to the file yet
+    with httpTraceLock:
+        if httpTrace['file'] is not None: httpTrace['file'].flush()
+    with catalogIndexLock:
+        settings['catalog'] = catalogIndex.get((run['toServerName'], str(run['toServerPort'])))
 
-                    if (response.status != 200 or not assertJsonSuccess(data)):
-                        raise ValueError("Unable to get user '" + user + "' details for role '" + role + "'.")
-                        return
-                    else:
-                        usersData.append(json.loads(data)['users'][0])
-                
-                #Create the role in the destination server
-                token = gentoken(toServerName, toServerPort, toAdminUser, toAdminPass)
-                url = "/arcgis/admin/security/roles/add"
-                params = urllib.urlencode({'rolename':originalRoleName,'description':originalRoleDescription,'f':'json','token':token})
+    return multiprocessing.Pool(processes, initProcessWorker, (settings,))
 
-                response, data = postToServer(toServerName, str(toServerPort), url, params)
 
-                if (response.status != 200 or not assertJsonSuccess(data)):
-                    return
-                else:
-                    arcpy.AddMessage("     - Role '" + originalRoleName + "' created successfully.")
-                    
-                    #Assign privileges to the role in the destination server
-                    url = "/arcgis/admin/security/roles/assignPrivilege"
-                    params = urllib.urlencode({'rolename':originalRoleName,'privilege':privilege,'f':'json','token':token})
-
-                    response, data = postToServer(toServerName, str(toServerPort), url, params)
-
-                    if (response.status != 200 or not assertJsonSuccess(data)):
-                        raise ValueError("Unable to privilege '" + privilege + "' for role '" + role + "'.")
-                        return
-                    else:
-
-                        arcpy.AddMessage("       Privilege '" + privilege + "' assigned successfully.")
-                        
-                        for user in usersData:
-
-                            #Check if the user exits
-                            url = "/arcgis/admin/security/users/search"
-                            params = urllib.urlencode({'filter':user['username'],'maxCount':'1','f':'json','token':token})
-
-                            response, data = postToServer(toServerName, str(toServerPort), url, params)
-
-                            if (response.status != 200 or not assertJsonSuccess(data)):
-                                raise ValueError("Unable to create user '" + user['username'] + "' for role '" + role + "'.")
-                                return
-                            else:
-                                #If the user does not exists we need to create
-                                if json.loads(data)['users'] == []:                                
-                                    try:
-                                        url = "/arcgis/admin/security/users/add"
-                                        params = {'username':user['username'],'disabled':user['disabled'],'f':'json','token':token}
-                  
-                                        try: params['fullname'] = user['fullname'].encode('utf8','strict')
-                                        except: print ''
-
-                                        try: params['password'] = user['password']
-                                        except: print ''
-                                        
-                                        try: params['description'] = user['description'].encode('utf8','strict')
-                                        except: print ''
-                                        
-                                        try: params['email'] = user['email']
-                                        except: print ''
-                                        
-                                        params['password'] = 'changeme'
-
-                                        params = urllib.urlencode(params)
-
-                                        response, data = postToServer(toServerName, str(toServerPort), url, params)
-                                    
-                                        if (response.status != 200 or not assertJsonSuccess(data)):
-                                            raise ValueError("Unable to create user '" + user['username'] + "' for role '" + role + "'.")
-                                            return
-                                        else:
-                                            arcpy.AddMessage("       User '" + user['username'] + "' created successfully.")
-                                            
-                                            url = "/arcgis/admin/security/roles/addUsersToRole"
-                                            params = urllib.urlencode({'rolename':originalRoleName,'users':user['username'],'f':'json','token':token})
-
-                                            response, data = postToServer(toServerName, str(toServerPort), url, params)
-                                
-                                            if (response.status != 200 or not assertJsonSuccess(data)):
-                                                raise ValueError("Unable to add user '" + user['username'] + "' to role '" + role + "'.")
-                                                return                                    
-                                    except:
-                                        raise ValueError("Unable to create user '" + user['username'] + "' for role '" + role + "'.")
-                                        return
-                                else:
-
-                                    url = "/arcgis/admin/security/roles/addUsersToRole"
-                                    params = urllib.urlencode({'rolename':originalRoleName,'users':user['username'],'f':'json','token':token})
-
-                                    response, data = postToServer(toServerName, str(toServerPort), url, params)
-                        
-                                    if (response.status != 200 or not assertJsonSuccess(data)):
-                                        raise ValueError("Unable to add user '" + user['username'] + "' to role '" + role + "'.")
-                                    return
-
-         
-def writeTxtFile(success, content, number, content1, workspace):
-    
-    if success == True:        
-        if number == 1: createTxtFile(workspace + "Success.txt", content1)
-        createTxtFile(workspace + "Success.txt", content)
-    else:        
-        if number == 1: createTxtFile(workspace + "Failure.txt", content1)
-        createTxtFile(workspace + "Failure.txt", content)
-        
+def initProcessWorker(settings):
+
+    ''' Function to set up a worker process. Its messages, journal records and results are kept and sent back with each service.
+    An error here is kept and returned for each service (see processStageChain): multiprocessing would start the
+    worker again and again, and the services sent to the pool would wait forever.
+    '''
+    workerRun.clear()
+    workerRun.update(settings)
+    workerRun.update({'lock': threading.Lock(), 'messages': [], 'results': [], 'journal': {'file': None, 'lock': threading.Lock(), 'done': {}, 'records': []}})
+
+    # The connections, trace file, run log and arcpy thread of the main process are not shared with it, nor the tokens it was generating
+    with httpPoolsLock:
+        httpPools.clear()
+    tokenLocks.clear()
+    arcpyThread['pool'] = None
+    with runLogLock:
+        runLog.update({'queue': None, 'thread': None})
+    with httpTraceLock:
+        httpTrace.update({'endpoints': {}, 'file': None, 'records': None, 'start': settings['traceStart']})
+        if settings['trace']: httpTrace['records'] = []
+    with catalogIndexLock:
+        catalogIndex.clear()
+        if settings['catalog'] is not None:
+            catalogIndex[(settings['toServerName'], str(settings['toServerPort']))] = settings['catalog']
+
+    arcpy.AddMessage = lambda message: workerRun['messages'].append(('message', message))
+    arcpy.AddWarning = lambda message: workerRun['messages'].append(('warning', message))
+    arcpy.AddError = lambda message: workerRun['messages'].append(('error', message))
 
-def createTxtFile(fileName, content):
-    
-# Append mode adds to the existing content, e.g. for keeping a log file. Append
-# mode will _never_ harm the existing contents of a file.
     try:
-        # This tries to open an existing file but creates a new file if necessary.
-        logfile = open(fileName, "a")
+        workerFolder = settings['workspace'] + "worker" + str(os.getpid())
+        if not os.path.isdir(workerFolder): os.makedirs(workerFolder)
+        arcpy.env.scratchWorkspace = workerFolder
+        workerRun['con'] = makeAGSconnection(settings['toServerName'], settings['toServerPort'], settings['toAdminUser'], settings['toAdminPass'], workerFolder)
+    except Exception, e:
+        workerRun['error'] = "The worker process " + str(os.getpid()) + " could not be set up: " + str(e)
+
+
+def processStageChain(task):
+
+    ''' Function run by a worker process: the draft, analysis and staging of one service.
+    Returns the job fields the upload needs, whether the service goes on to it, and the messages, journal
+    records, results and SD cache counts of the worker for the main process (see processChainStage).
+    '''
+    job = task['job']
+    journal = workerRun['journal']
+    journal['done'] = {job['service']: task['done']}
+    del journal['records'][:]
+    del workerRun['messages'][:]
+    del workerRun['results'][:]
+    sdCacheStats.update({'reused': 0, 'stored': 0})
+    with httpTraceLock:
+        httpTrace['endpoints'].clear()
+        if httpTrace['records'] is not None: del httpTrace['records'][:]
+
+    # The worker could not be set up (see initProcessWorker)
+    outcome = {'forward': False, 'error': workerRun.get('error')}
+    if outcome['error'] is None:
+        # The main process already created the folder
+        catalogAddFolder(workerRun['toServerName'], workerRun['toServerPort'], job['folderName'])
+
+        requestContext.job = job
         try:
-            logfile.write(content)
-        finally:
-            logfile.close()
-    except IOError:
-        pass
+            outcome['forward'] = draftServiceStage(job, workerRun) and stageServiceStage(job, workerRun)
+        except Exception, e:
+            outcome['error'] = str(e)
+        requestContext.job = None
 
-  
-def transferMapServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceList, toServerName, toServerPort, toAdminUser, toAdminPass, serviceType, workspace, newFolder,
-                        overwrite, workFolder, token=None):
-    serviceSuccesNumber = 0
-    serviceFailureNumber = 0
-    sources = ""
+    outcome.update({'job': dict((key, job[key]) for key in ('draftXml', 'sd', 'sdKey', 'layers', 'requests') if key in job), 'messages': list(workerRun['messages']),
+                    'records': list(journal['records']), 'results': list(workerRun['results']), 'sdCacheStats': dict(sdCacheStats)})
+    with httpTraceLock:
+        outcome['httpTrace'] = (dict(httpTrace['endpoints']), list(httpTrace['records'] or []))
+    return outcome
 
-    workspace = workspace + "\\"
-    serviceExists = False
-    serviceExistsOld = False
-                
-    content1 = "\n *************************************************************************** \n           Publishing in Server: " + toServerName + " Port: " + toServerPort + " AdminUser: " + toAdminUser + "\n           " + formatDate() + "\n *************************************************************************** "
-  
-    # Getting services from tool validation creates a semicolon delimited list that needs to be broken up
-    services = serviceList.split(';')
-    
-    con = makeAGSconnection(toServerName, toServerPort, toAdminUser, toAdminPass, workspace)
 
-    #modify the services(s)    
-    for service in services:                                            
-        service = urllib.quote(service.encode('utf8'))
-        serviceURL = "/arcgis/admin/services/" + service
+def uploadServiceStage(job, run):
 
-        # Get and set the token
-        token = gentoken(fromServerName, fromServerPort, fromAdminUser, fromAdminPass)
+    #Publish the Service Definition in the destination servers of the service, all at the same time
+    return fanOut(job, run, uploadServiceDefinition)
 
-        # This request only needs the token and the response formatting parameter 
-        params = urllib.urlencode({'token': token, 'f': 'json'})
-        response, data = postToServer(fromServerName, str(fromServerPort), serviceURL, params)
-        
-        if (response.status != 200):
-            arcpy.AddMessage("\n  ** Could not read service '" + str(service) + "' information.")
-        else:
-            # Check that data returned is not an error object
-            if not assertJsonSuccess(data): arcpy.AddMessage("\n  ** Error when reading service '" + str(service) + "' information. " + str(data))
-            else:
-                arcpy.AddMessage("\n  ** Service '" + str(service) + "' information read successfully. Now transfering... (5 steps)")
 
-                # Deserialize response into Python object
-                propInitialService = json.loads(data)
-                user = getpass.getuser()
+def uploadServiceDefinition(job, run):
 
-                pathInitial = propInitialService["properties"]["filePath"]
-                pathInitial = pathInitial.replace(':', '', 1)
-                #msdPath = pathInitial.replace('X', os.path.join(r'\\' + fromServerName, 'x'), 1)
-                msdPath = os.path.join(r'\\' + fromServerName, pathInitial)  
-                
-                if newFolder != "" : folderName = newFolder
-                else: folderName = os.path.split(service)[0]
-
-                serviceName = os.path.split(service)[1]
-                serviceName2 = serviceName
-                pos3 = serviceName2.find(".MapServer")
-                simpleServiceName = serviceName2[:pos3]
-
-                if  folderName != 'root' or folderName != '':                           
-                    finalServiceName = folderName + "//" + simpleServiceName + ".MapServer"
-                    temp_workspace = string.replace(workspace, ':', '', 1)
-                    #temp_workspace = string.replace(temp_workspace, 'X', os.path.join(r'\\' + socket.gethostname(), 'x'), 1)
-                    temp_workspace = os.path.join(r'\\' + socket.gethostname(), temp_workspace)
-    
-                    sources = os.path.join(temp_workspace, os.path.join(folderName, simpleServiceName + ".MapServer"))
-                else:
-                    finalServiceName = serviceName
-                    temp_workspace = string.replace(workspace, ':', '', 1)
-                    #sources = os.path.join(string.replace(temp_workspace, 'X', os.path.join(r'\\' + socket.gethostname(), 'x'), 1), serviceName)
-                    sources = os.path.join(os.path.join(r'\\' + socket.gethostname(), temp_workspace), serviceName)
-                    
+    #Publish the Service Definition in one destination server
+    if 'uploaded' + run['journalTag'] in journalStages(run, job['service']):
+        return True
 
-                #Check if the service exists
-                serviceExists = isServicePresent(toServerName, str(toServerPort), toAdminUser, toAdminPass, simpleServiceName, folderName, "")
+    try:
+        # The folder of the run destination is created before the draft
+        createFolder(run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], job['folderName'], "")
 
-                pos = msdPath.find(serviceName) + len(serviceName) 
-                inputFolderPath = msdPath[:pos]
+        arcpy.AddMessage("     Step 4: Uploading Service Definition for '" + job['service'] + "'" + destinationName(run))
+        arcpyCall(arcpy.UploadServiceDefinition_server, job['sd'], run['con'])
+        journalRecord(run, job['service'], 'uploaded' + run['journalTag'])
+        catalogAddService(run['toServerName'], run['toServerPort'], job['folderName'], job['simpleServiceName'], run['serviceType'])
+        return True
 
-                #If service exists and must be overwritten                
-                if serviceExists == True and overwrite == 'true':
-                    #Backup old service
-                    serviceURLforbackup = "/arcgis/admin/services/" + folderName + "/" + serviceName
+    except arcpy.ExecuteError:
+        arcpy.AddWarning("%%%%%%%%%%%%%%%%%%     " + arcpy.GetMessages())
+        arcpy.AddWarning("     Failed to publish" + destinationName(run) + ".")
 
-                    # This request only needs the token and the response formatting parameter
-                    tokenforbackup = gentoken(toServerName, toServerPort, toAdminUser, toAdminPass)
-                    paramsforbackup = urllib.urlencode({'token': tokenforbackup, 'f': 'json'})
-                    responseforbackup, dataforbackup = postToServer(toServerName, str(toServerPort), serviceURLforbackup, paramsforbackup)
-                    
-                    if (responseforbackup.status == 200) and assertJsonSuccess(dataforbackup):
-                        propInitialServiceforbackup = json.loads(dataforbackup)
-                        pathInitialforbackup = propInitialServiceforbackup["properties"]["filePath"]
-                        pathInitialforbackup = pathInitialforbackup.replace(':', '', 1)
-                        #msdPathforbackup = pathInitialforbackup.replace('X', os.path.join(r'\\' + toServerName, 'x'), 1)
-                        msdPathforbackup = os.path.join(r'\\' + toServerName, pathInitialforbackup)
-                        posforbackup = msdPathforbackup.find(serviceName) + len(serviceName) 
-                        inputFolderPathforbackup = msdPathforbackup[:posforbackup]
-
-                        copyFrom = inputFolderPathforbackup                    
-                        copyTo = os.path.join(workFolder, folderName, serviceName)
-
-                        #Check that size is smaller than 3 Gb
-                        if (get_size(copyFrom)/(1024*1024)) < 1907:
-                            continuePublish1 = copy(copyFrom, copyTo)                        
-                            continuePublish2 = createZipFile(copyFrom, workFolder + "\\" + folderName + "\\" + serviceName + ".zip")
-                        
-                            if continuePublish1 == True and continuePublish2 == True:
-                                arcpy.AddMessage("     Step 0: Old service backup done succesfully.")
-                            else:
-                                arcpy.AddMessage("     Step 0: Error when backing up old service .")                                        
-
-                    serviceExistsOld = serviceExists
-                    serviceExists = False
-                 
-                if serviceExists == False:            
-                    #The path of the folder that contains the service info
-                    if folderName != "":
-                        if not os.path.exists(workspace + folderName):
-                            os.makedirs(workspace + folderName)
-                        serviceName = folderName + "\\" + serviceName
-
-                    #Check that size is smaller than 3 Gb
-                    if (get_size(inputFolderPath)/(1024*1024)) < 1907:
-                        #Copy service data
-                        continuePublish = copy(inputFolderPath, workspace + serviceName)
-
-                        #If the data copied ok
-                        if continuePublish == True:
-                            mxdExist = False
-                            #Check for MXD
-                            for root, dirs, files in os.walk(workspace + serviceName):
-                                for file in files:
-                                    if file.endswith(".mxd"):
-                                         mxdFile = os.path.join(root, file)
-                                         mxdExist = True
-                                         break;
-                                                
-                            #If MXD exist
-                            if mxdExist == True:
-                            
-                                createFolder(toServerName, toServerPort, toAdminUser, toAdminPass, folderName, "")
-
-                                mapName = os.path.split(mxdFile)[1]
-                                pos2 = mapName.find(".mxd")
-                                sdname = mapName[:pos2]
-
-                                sddraft = workspace + serviceName + "\\" + sdname + '.sddraft'
-                                sd = workspace + serviceName + "\\" + sdname + '.sd'
-
-                                mapDoc = arcpy.mapping.MapDocument(mxdFile)
-
-                                #Create a customized Service Definition Draft
-                                arcpy.AddMessage("     Step 1: Creating Service Definition Draft (.sddraft)")
-                                draftXml = CreateServiceDefinitionDraft(mapDoc, sddraft, simpleServiceName, con, folderName, propInitialService, workspace + serviceName)
-
-                                #Get the analysis result
-                                arcpy.AddMessage("     Step 2: Analyzing Service Definition Draft.")
-
-                                # Analyze the service definition draft
-                                analyseDraft = analyseServiceDraft(draftXml, service)
-                                
-                                # Stage and upload the service if the sddraft analysis did not contain errors
-                                if analyseDraft['errors'] == {}:                                
-                                    try:                                
-                                        #If SD exist is deleted
-                                        if os.path.isfile(sd): os.remove(sd)
-
-                                        # Execute StageService. This creates the service definition.
-                                        arcpy.AddMessage("     Step 3: Creating Service Definition (.sd)")
-                                        arcpy.StageService_server(draftXml, sd)
-
-                                        try:
-                                            arcpy.AddMessage("     Step 4: Uploading Service Definition.")
-                                            arcpy.UploadServiceDefinition_server(sd, con)
-
-                                            try:
-                                                arcpy.AddMessage("     Step 5: Setting permissions.")
-                                                setPermission(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, os.path.split(service)[0], toServerName, toServerPort, toAdminUser, toAdminPass, folderName, simpleServiceName, serviceType)
-                                                content = "\n " + formatDate() + "\n Published successfully. \n   - " + finalServiceName + "\n        --> " + mxdFile + "\n        --> " + sd + "\n"
-                                                
-                                            except ValueError, value:
-                                                arcpy.AddMessage("          Failed to assign permission. Please assign manually: \n               - " + str(value))
-                                                content = "\n " + formatDate() + "\n Published successfully. \n   - " + finalServiceName + "\n        --> " + mxdFile + "\n        --> " + sd + "\n"
-                                                content  = content + "\n Failed to assign permission. \n   - " + str(value) + "\n"
-
-                                            serviceSuccesNumber = serviceSuccesNumber + 1
-                                            writeTxtFile(True, content, serviceSuccesNumber, content1, workspace)
-
-                                        except arcpy.ExecuteError:
-                                            arcpy.AddWarning("%%%%%%%%%%%%%%%%%%     " + arcpy.GetMessages())
-                                            arcpy.AddWarning("     Failed to publish.")
-
-                                            content = "\n " + formatDate() + "\n Failed to publish. \n   - " + finalServiceName + "\n"
-                                            serviceFailureNumber = serviceFailureNumber + 1
-                                            writeTxtFile(False, content, serviceFailureNumber, content1, workspace)                                      
-                                                
-                                        #Published successfully.
-                                        arcpy.AddMessage("  ** Service '" + finalServiceName + "' published successfully.")
-
-                                    # SD can't be created
-                                    except arcpy.ExecuteError:
-                                        serviceTypeD = ""
-                                        serverD = ""
-                                        serviceD = ""
-                                        databaseD = ""
-                                        strconex = ""
-                                        
-                                        for lyr in arcpy.mapping.ListLayers(mapDoc):
-                                            if lyr.supports("SERVICEPROPERTIES"):
-                                                #Para no repetir las fuentes
-                                                if serviceTypeD != lyr.serviceProperties["ServiceType"] and serverD != lyr.serviceProperties["Server"] and serviceD != lyr.serviceProperties["Server"] and databaseD != lyr.serviceProperties["Database"]:
-                                                    serviceTypeD = lyr.serviceProperties["ServiceType"]
-                                                    serverD = lyr.serviceProperties["Server"]
-                                                    serviceD = lyr.serviceProperties["Service"]
-                                                    databaseD = lyr.serviceProperties["Database"]
-                                                    strconex = "          * ServiceType: '" + serviceTypeD + "', Server: '" + serverD + "', Service: '" + serviceD + "', Database: '" + databaseD + "'."
-                                        del mapDoc
-                                        del serviceTypeD
-                                        del serverD
-                                        del serviceD
-                                        del databaseD
-                                        
-                                        if strconex != "":
-                                            arcpy.AddWarning("     Consolidating the data failed. Please register first the database in the Server DataStore: ")
-                                            arcpy.AddWarning(strconex)
-                                            content = "\n " + formatDate() + "\n Consolidating the data failed.\n   - " + finalServiceName + "\n     Please register first the database in the Server DataStore:\n" + strconex + "\n"
-                                            dbcontent = 'Consolidating the data failed. Please register first the database in the Server DataStore. '
-                                        else:
-                                            arcpy.AddWarning("     Consolidating the data failed. Please check datasources.")
-                                            content = "\n " + formatDate() + "\n Consolidating the data failed. Please check datasources. \n   - " + finalServiceName + "\n"
-                                            dbcontent = 'Consolidating the data failed. Please check datasources.'
-
-                                        serviceFailureNumber = serviceFailureNumber + 1
-                                        writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-
-                                # if the sddraft analysis contained errors
-                                else:
-                                    #Service Definition Draft could not be analyzed
-                                    if analyseDraft['errors'] == "NO":
-                                        
-                                        arcpy.AddWarning("     Service Definition Draft could not be analyzed.")
-                                        
-                                        content = "\n " + formatDate() + "\n Service Definition Draft could not be analyzed.\n"
-                                        serviceFailureNumber = serviceFailureNumber + 1
-                                        writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-                                        
-                                    else:
-                                        arcpy.AddWarning("     Service could not be published because errors were found during analysis. \n" + analyseDraft['errors'])                             
-                                        content = "\n " + formatDate() + "\n Service could not be published because errors were found during analysis. \n " + analyseDraft['errors'] + "\n  "
-                                        serviceFailureNumber = serviceFailureNumber + 1
-                                        writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-                                        
-                            # MXD not found
-                            else:                              
-                                arcpy.AddWarning("     Service MXD not found.")
-                                
-                                content = "\n " + formatDate() + "\n Service MXD not found.\n   - " + finalServiceName + "\n"
-                                serviceFailureNumber = serviceFailureNumber + 1
-                                writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-                                
-                        # Service information folder already exists (can't be deleted)
-                        else:
-                            if longErrorGlobal == False:                        
-                                arcpy.AddWarning("     Service information folder already exists and can not be created.")
-
-                                content = "\n " + formatDate() + "\n Service information folder already exists and can not be created.\n   - " + finalServiceName + "\n"
-                                serviceFailureNumber = serviceFailureNumber + 1
-                                writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-                                
-                            else:
-                                arcpy.AddWarning("     The source can not be copied because the path is extremely long.")
-
-                                content = "\n " + formatDate() + "\n The source can not be copied because the path is extremely long.\n   - " + finalServiceName + "\n"
-                                serviceFailureNumber = serviceFailureNumber + 1
-                                writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-
-                    else:
-                        arcpy.AddWarning("     Service size is more than 2 Gb, can not be transfered. Please use the toolbox.")
-
-                        content = "\n " + formatDate() + "\n Service size is more than 2 Gb, can not be transfered. Please use the toolbox.\n   - " + str(service) + "\n"
-                        serviceFailureNumber = serviceFailureNumber + 1
-                        writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-                        
-                                
-                # Service already is published
-                else:
-                    arcpy.AddWarning("     Service already exists in the server and can not be created.")
+        content = "\n " + formatDate() + "\n Failed to publish. \n   - " + job['finalServiceName'] + "\n"
+        recordResult(run, False, content)
+        return False
 
-                    content = "\n " + formatDate() + "\n Service already exists in the server and can not be created.\n   - " + str(service) + "\n"
-                    serviceFailureNumber = serviceFailureNumber + 1
-                    writeTxtFile(False, content, serviceFailureNumber, content1, workspace)
-                    
-    number = numberOfServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceType)
 
-    temp_workspace = string.replace(workspace,':','',1)
-    #migration_backup = string.replace(temp_workspace, 'X', os.path.join(r'\\' + socket.gethostname(), 'x'), 1)
-    migration_backup = os.path.join(r'\\' + socket.gethostname(), temp_workspace)
-    
-    arcpy.AddMessage("\n***************************************************************************  ")
-    arcpy.AddMessage(" - Number of services in '" + fromServerName + "': " + str(number))
-    arcpy.AddMessage(" - Number of services selected in '" + fromServerName + "': " + str(len(services)))
-    arcpy.AddMessage(" - Number of services transfered successfully to '" + toServerName + "': " + str(serviceSuccesNumber))
-    arcpy.AddMessage(" - Number of services not transfered to '" + toServerName + "': " + str(serviceFailureNumber))
-    
-    arcpy.AddMessage("\n - The migration backup is placed in: " + migration_backup)
-    
-    if serviceExistsOld == True and overwrite == 'true':
-         arcpy.AddMessage(" - Old service backup is placed in: " + copyTo)
+def permissionServiceStage(job, run):
+
+    #Copy the permissions of the origin service to the published ones
+    return fanOut(job, run, setServicePermissions)
+
+
+def setServicePermissions(job, run):
+
+    #Copy the permissions of the origin service to the one published in a destination server
+    service = job['service']
+    finalServiceName = job['finalServiceName']
+    content = "\n " + formatDate() + "\n Published successfully. \n   - " + finalServiceName + "\n        --> " + job['mxdFile'] + "\n        --> " + job['sd'] + "\n"
+
+    # Only read the origin permissions now, they are set after the pipeline (see applyDeferredPermissions)
+    if run['deferPermissions']:
+        try:
+            initialPermissions = job.get('initialPermissions')
+            if initialPermissions is None:
+                initialPermissions = getPermissions(run['fromServerName'], run['fromServerPort'], run['fromAdminUser'], run['fromAdminPass'], os.path.split(service)[0], job['simpleServiceName'], run['serviceType'])
+            with run['lock']:
+                run['deferredPermissions'].append({'service': service, 'finalServiceName': finalServiceName, 'folderName': job['folderName'], 'serviceName': job['simpleServiceName'],
+                                                   'permissions': initialPermissions, 'errors': []})
+        except ValueError, value:
+            arcpy.AddMessage("          Failed to assign permission. Please assign manually: \n               - " + str(value))
+            content  = content + "\n Failed to assign permission. \n   - " + str(value) + "\n"
+            recordPermissionFailure(run)
+            journalRecord(run, service, 'permissions' + run['journalTag'])
+        recordResult(run, True, content)
+
+        arcpy.AddMessage("  ** Service '" + finalServiceName + "' published successfully" + destinationName(run) + ".")
+        return True
+
+    try:
+        arcpy.AddMessage("     Step 5: Setting permissions for '" + service + "'" + destinationName(run))
+        setPermission(run['fromServerName'], run['fromServerPort'], run['fromAdminUser'], run['fromAdminPass'], os.path.split(service)[0], run['toServerName'], run['toServerPort'], run['toAdminUser'], run['toAdminPass'], job['folderName'], job['simpleServiceName'], run['serviceType'], job.get('initialPermissions'))
         
-    arcpy.AddMessage("***************************************************************************  ")
-   
+    except ValueError, value:
+        arcpy.AddMessage("          Failed to assign permission. Please assign manually: \n               - " + str(value))
+        content  = content + "\n Failed to assign permission. \n   - " + str(value) + "\n"
+        recordPermissionFailure(run)
+
+    recordResult(run, True, content)
+    journalRecord(run, service, 'permissions' + run['journalTag'])
+
+    #Published successfully.
+    arcpy.AddMessage("  ** Service '" + finalServiceName + "' published successfully" + destinationName(run) + ".")
+    return True
+
 
         
-def CreateServiceDefinitionDraft(mapDoc, sddraft, service, con, folder, dataObj, iteminfoworkspace):
+def CreateServiceDefinitionDraft(mapDoc, sddraft, service, con, folder, dataObj, iteminfoworkspace, scan=None):
+
+    ''' Function to create the sddraft of the service with the properties of the origin service.
+    The sddraft is read once with readDraft, which indexes the elements to modify, and the keys are copied with
+    the SDDRAFT_* tables. The output is the same the DOM version wrote ("<name>_mod.sddraft").
+    '''
     iteminfoExist = False
     #Check for item description
-    for root, dirs, files in os.walk(iteminfoworkspace):
-        for file in files:
-            if file == "iteminfo.xml":
-                iteminfoFile = os.path.join(root, file)
-                iteminfoExist = True
-                break;
+    if scan is None: scan = scanFolder(iteminfoworkspace)
+    if scan['iteminfo'] is not None:
+        iteminfoFile = os.path.join(iteminfoworkspace, scan['iteminfo'])
+        iteminfoExist = True
 
     if iteminfoExist == True:
         # Read the sddraft xml.
@@ -868,241 +3690,46 @@ def CreateServiceDefinitionDraft(mapDoc, sddraft, service, con, folder, dataObj,
             summary = ""            
 
         # Create service definition draft
-        arcpy.mapping.CreateMapSDDraft(mapDoc, sddraft, service, 'ARCGIS_SERVER', con, True, folder, summary, tags)
+        arcpyCall(arcpy.mapping.CreateMapSDDraft, mapDoc, sddraft, service, 'ARCGIS_SERVER', con, True, folder, summary, tags)
     else:
         # Create service definition draft
-        arcpy.mapping.CreateMapSDDraft(mapDoc, sddraft, service, 'ARCGIS_SERVER', con, True, folder)
+        arcpyCall(arcpy.mapping.CreateMapSDDraft, mapDoc, sddraft, service, 'ARCGIS_SERVER', con, True, folder)
 
     # Read the sddraft xml.
-    doc = DOM.parse(sddraft)
-                    
-    # Find all elements named TypeName. This is where the server object extension (SOE) names are defined.
-    extensionsMSD = dataObj["extensions"]
-    typeNames = doc.getElementsByTagName('TypeName')
-    
-    # Get the TypeName whose properties we want to modify.
-    for typeName in typeNames:
-        found = False
-        active = "false"
-        
-        #Search fot the extension in the original MSD
-        for extensionMSD in extensionsMSD:
-            if typeName.firstChild.data == extensionMSD["typeName"]:
-                found = True
-                active = extensionMSD["enabled"]
-                capabilities = extensionMSD["capabilities"]
-                properties = extensionMSD["properties"]
-
-                #If is there
-                if found:
-                    extension = typeName.parentNode
-                    for extElement in extension.childNodes:
-                        if extElement.tagName == 'Enabled':
-                            extElement.firstChild.data = active
-                            
-                        elif extElement.tagName == 'Props':                    
-                            for propNodes in extElement.childNodes:
-                                for propNode in propNodes.childNodes:                        
-                                    if propNode.childNodes[0].tagName == 'Key':
-                                        try:                                            
-                                            propNode.childNodes[1].firstChild.data = extensionMSD["properties"][propNode.childNodes[0].firstChild.data]
-                                        except Exception, e:                                
-                                            try:
-                                                textnode = docItemInfo.createTextNode(extensionMSD["properties"][propNode.childNodes[0].firstChild.data])
-                                                propNode.childNodes[1].appendChild(textnode)
-                                            except Exception, e:
-                                                print ''
-                                            
-                        elif extElement.tagName == 'Info':
-                            for infoNodes in extElement.childNodes:
-                                for infoNode in infoNodes.childNodes:                
-                                    try:
-                                        if infoNode.childNodes[0].tagName == 'Key' and infoNode.childNodes[0].firstChild.data == 'WebCapabilities':
-                                            infoNode.childNodes[1].firstChild.data = capabilities
-                                        #elif infoNode.childNodes[0].tagName == 'Key' and infoNode.childNodes[0].firstChild.data == 'WebEnabled':
-                                        #    arcpy.AddMessage('WebEnabled ' + infoNode.childNodes[1].lastChild.data)                                    
-                                            
-                                    except Exception, e:
-                                        print ''                       
-
+    nodes, index = readDraft(sddraft)
 
-    # turn on caching in the configuration properties
-    propertiesMSD = dataObj["properties"]
-    
-    configProperties = doc.getElementsByTagName('ConfigurationProperties')[0]
-    configPropertiesArray = configProperties.firstChild
-    configPropertiesSet = configPropertiesArray.childNodes
-    for configPropertySet in configPropertiesSet:
-        keyValues = configPropertySet.childNodes
-        for keyValue in keyValues:
-            if keyValue.tagName == 'Key':
-                if keyValue.firstChild.data == "supportedImageReturnTypes":
-                    try:
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["supportedImageReturnTypes"]
-                    except Exception, e:
-                        print keyValue, keyValue.firstChild
-                elif keyValue.firstChild.data == "useLocalCacheDir":
-                    try:
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["useLocalCacheDir"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "isCached":
-                    try:
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["isCached"]
-                    except Exception, e:
-                        print keyValue                    
-                elif keyValue.firstChild.data == "clientCachingAllowed": 
-                    try:                   
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["clientCachingAllowed"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "schemaLockingEnabled": 
-                    try:                   
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["schemaLockingEnabled"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "textAntialiasingMode":  
-                    try:                  
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["textAntialiasingMode"]
-                    except Exception, e:
-                        print keyValue                        
-                elif keyValue.firstChild.data == "enableDynamicLayers":   
-                    try:                 
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["enableDynamicLayers"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "antialiasingMode":  
-                    try:                  
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["antialiasingMode"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "maxRecordCount":
-                    try:
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["maxRecordCount"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "dynamicDataWorkspaces": 
-                    try:                   
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["dynamicDataWorkspaces"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "MaxImageHeight":      
-                    try:              
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["maxImageHeight"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "cacheOnDemand":  
-                    try:                  
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["cacheOnDemand"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "maxBufferCount":   
-                    try:                 
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["maxBufferCount"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "disableIdentifyRelates":  
-                    try:                  
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["disableIdentifyRelates"]
-                    except Exception, e:
-                        print keyValue                    
-                elif keyValue.firstChild.data == "MaxImageWidth":       
-                    try:             
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["maxImageWidth"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "maxScale":         
-                    try:
-                        if propertiesMSD["maxScale"] != "":
-                            keyValue.nextSibling.firstChild.data = propertiesMSD["maxScale"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "maxDomainCodeCount":   
-                    try:                 
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["maxDomainCodeCount"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "minScale":   
-                    try:
-                        if propertiesMSD["minScale"] != "":
-                            keyValue.nextSibling.firstChild.data = propertiesMSD["minScale"]
-                    except Exception, e:
-                        print keyValue                   
-                elif keyValue.firstChild.data == "ignoreCache":   
-                    try:                 
-                        keyValue.nextSibling.firstChild.data = propertiesMSD["ignoreCache"]
-                    except Exception, e:
-                        print keyValue                   
+    # Extensions of the original MSD by TypeName. This is where the server object extension (SOE) names are defined.
+    extensionsMSD = {}
+    for extensionMSD in dataObj["extensions"]:
+        extensionsMSD.setdefault(extensionMSD["typeName"], []).append(extensionMSD)
 
+    for typeName, extension in index['TypeName']:
+        if extensionsMSD == {}:
+            break
+        for extensionMSD in extensionsMSD.get(draftText(typeName), []):
+            setDraftExtension(extension, extensionMSD, iteminfoExist)
 
     # turn on caching in the configuration properties
-    props = doc.getElementsByTagName('Props')[0]
-    propsArray = props.firstChild
-    propSets = propsArray.childNodes
-    for propSet in propSets:
-        keyValues = propSet.childNodes
-        for keyValue in keyValues:
-            if keyValue.tagName == 'Key':
-                if keyValue.firstChild.data == "MaxInstances":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["maxInstancesPerNode"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "keepAliveInterval":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["keepAliveInterval"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "StartupTimeout":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["maxStartupTime"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "configuredState":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["configuredState"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "UsageTimeout":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["maxUsageTime"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "Isolation":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["isolationLevel"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "IdleTimeout":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["maxIdleTime"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "MinInstances":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["minInstancesPerNode"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "WaitTimeout":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["maxWaitTime"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "InstancesPerContainer":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["instancesPerContainer"]
-                    except Exception, e:
-                        print keyValue
-                elif keyValue.firstChild.data == "recycleInterval":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["recycleInterval"]
-                    except Exception, e:
-                        print keyValue                  
-                elif keyValue.firstChild.data == "recycleStartTime":
-                    try:
-                        keyValue.nextSibling.firstChild.data = dataObj["recycleStartTime"]
-                    except Exception, e:
-                        print keyValue
+    propertiesMSD = dataObj["properties"]
+    for key, value in draftKeyValues(draftElement(index, 'ConfigurationProperties')):
+        field = SDDRAFT_CONFIGURATION_PROPERTIES.get(key)
+        if field is None:
+            continue
+        try:
+            if field not in SDDRAFT_SCALES or propertiesMSD[field] != "":
+                setDraftText(value, propertiesMSD[field])
+        except (KeyError, AttributeError):
+            pass
+
+    # Properties of the service
+    for key, value in draftKeyValues(draftElement(index, 'Props')):
+        field = SDDRAFT_SERVICE_PROPS.get(key)
+        if field is None:
+            continue
+        try:
+            setDraftText(value, dataObj[field])
+        except (KeyError, AttributeError):
+            pass
 
     if iteminfoExist == True:
         # Find all elements named TypeName. This is where the server object extension (SOE) names are defined.
@@ -1112,64 +3739,257 @@ def CreateServiceDefinitionDraft(mapDoc, sddraft, service, con, folder, dataObj,
         licenseinfo = docItemInfo.getElementsByTagName('licenseinfo')[0]
         accessInformation = docItemInfo.getElementsByTagName('accessinformation')[0]
 
-        doc.getElementsByTagName('XMin')[0].firstChild.data = docItemInfo.getElementsByTagName('xmin')[0].firstChild.data
-        doc.getElementsByTagName('YMin')[0].firstChild.data = docItemInfo.getElementsByTagName('ymin')[0].firstChild.data
-        doc.getElementsByTagName('XMax')[0].firstChild.data = docItemInfo.getElementsByTagName('xmax')[0].firstChild.data
-        doc.getElementsByTagName('YMax')[0].firstChild.data = docItemInfo.getElementsByTagName('ymax')[0].firstChild.data        
-        
+        for tag in ('XMin', 'YMin', 'XMax', 'YMax'):
+            setDraftText(draftElement(index, tag), docItemInfo.getElementsByTagName(tag.lower())[0].firstChild.data)
+
     # turn on caching in the configuration properties
-    itemInfo = doc.getElementsByTagName('ItemInfo')[0]
-    itemInfoSets = itemInfo.childNodes
-    for itemInfoSet in itemInfoSets:
-        if itemInfoSet.tagName == "Snippet":
-            try:
+    for itemInfoSet in draftElement(index, 'ItemInfo')[2]:
+        try:
+            if itemInfoSet[0] == "Snippet":
                 if iteminfoExist == True:
-                    itemInfoSet.firstChild.data = snippet.firstChild.data
-                    
-            except Exception, e:
-                print itemInfoSet.tagName
-        elif itemInfoSet.tagName == "Description":
-            try:
+                    setDraftText(itemInfoSet, snippet.firstChild.data)
+            elif itemInfoSet[0] == "Description":
                 if iteminfoExist == True:
-                    itemInfoSet.firstChild.data = description.firstChild.data
-            except Exception, e:
-                print itemInfoSet.tagName
-        elif itemInfoSet.tagName == "Credits":
-            try:
+                    setDraftText(itemInfoSet, description.firstChild.data)
+            elif itemInfoSet[0] == "Credits":
                 if iteminfoExist == True:
-                    itemInfoSet.firstChild.data = accessInformation.firstChild.data
-            except Exception, e:
-                print itemInfoSet.tagName            
-        elif itemInfoSet.tagName == "MinScale":
-            try:
+                    setDraftText(itemInfoSet, accessInformation.firstChild.data)
+            elif itemInfoSet[0] == "MinScale":
                 if propertiesMSD["minScale"] != "":
-                    itemInfoSet.firstChild.data = propertiesMSD["minScale"]
-            except Exception, e:
-                print itemInfoSet.tagName
-        elif itemInfoSet.tagName == "MaxScale":
-            try:
+                    setDraftText(itemInfoSet, propertiesMSD["minScale"])
+            elif itemInfoSet[0] == "MaxScale":
                 if propertiesMSD["maxScale"] != "":
-                    itemInfoSet.firstChild.data = propertiesMSD["maxScale"]            
-            except Exception, e:
-                print itemInfoSet.tagName
+                    setDraftText(itemInfoSet, propertiesMSD["maxScale"])
+        except (KeyError, AttributeError):
+            pass
 
     # Output to a new sddraft.
     outXml = sddraft[:-8] + "_mod.sddraft"
     if os.path.exists(outXml): os.remove(outXml)
-    f = codecs.open(outXml, "w", "utf-8")
-    doc.writexml(f)
-    f.close()
+    writeDraft(nodes, outXml)
 
     os.remove(sddraft)
     
     return outXml
 
 
+def setDraftExtension(extension, extensionMSD, iteminfoExist):
+
+    #Copy the state, capabilities and properties of an extension of the original MSD to the SVCExtension of the sddraft
+    active = extensionMSD["enabled"]
+    capabilities = extensionMSD["capabilities"]
+    properties = extensionMSD["properties"]
+
+    for extElement in draftChildElements(extension):
+        if extElement[0] == 'Enabled':
+            setDraftText(extElement, active)
+
+        elif extElement[0] == 'Props':
+            for propNodes in draftChildElements(extElement):
+                for propNode in draftChildElements(propNodes):
+                    keyValue = propNode[2]
+                    if keyValue == [] or keyValue[0][0] != 'Key':
+                        continue
+                    try:
+                        setDraftText(keyValue[1], properties[draftText(keyValue[0])])
+                    except (KeyError, AttributeError, IndexError):
+                        # An empty value gets a text, as the DOM version did when there was an item description
+                        try:
+                            value = properties[draftText(keyValue[0])]
+                            if iteminfoExist and isinstance(value, basestring) and keyValue[1][0] not in DRAFT_NODES:
+                                keyValue[1][2].append([DRAFT_TEXT, value])
+                        except (KeyError, AttributeError, IndexError):
+                            pass
+
+        elif extElement[0] == 'Info':
+            for infoNodes in draftChildElements(extElement):
+                for infoNode in draftChildElements(infoNodes):
+                    keyValue = infoNode[2]
+                    try:
+                        if keyValue[0][0] == 'Key' and draftText(keyValue[0]) == 'WebCapabilities':
+                            setDraftText(keyValue[1], capabilities)
+                    except (AttributeError, IndexError):
+                        pass
+
+
+def readDraft(sddraft):
+
+    ''' Function to read an sddraft with expat into a light tree of lists instead of a DOM.
+    Elements are [tag, attributes, children], texts [DRAFT_TEXT, data], CDATA sections [DRAFT_CDATA, data], comments
+    [DRAFT_COMMENT, data] and processing instructions [DRAFT_PI, target, data]. The texts are joined as the DOM joins them.
+    Returns the nodes of the document and the index: the first element of each name of SDDRAFT_INDEXED and
+    'TypeName', the list of (TypeName, parent element).
+    '''
+    document = [DRAFT_DOCUMENT, {}, []]
+    stack = [document]
+    index = {'TypeName': []}
+    cdata = []
+
+    def startElement(tag, attributes):
+        element = [tag, attributes, []]
+        stack[-1][2].append(element)
+        stack.append(element)
+        if tag in SDDRAFT_INDEXED and tag not in index: index[tag] = element
+
+    def endElement(tag):
+        element = stack.pop()
+        if tag == 'TypeName': index['TypeName'].append((element, stack[-1]))
+
+    def characterData(data):
+        children = stack[-1][2]
+        if cdata != []:
+            if cdata[0] is not None:
+                cdata[0][1] = cdata[0][1] + data
+            else:
+                cdata[0] = [DRAFT_CDATA, data]
+                children.append(cdata[0])
+        elif children != [] and children[-1][0] == DRAFT_TEXT:
+            children[-1][1] = children[-1][1] + data
+        else:
+            children.append([DRAFT_TEXT, data])
+
+    def startCdata():
+        cdata.append(None)
+
+    def endCdata():
+        del cdata[:]
+
+    def comment(data):
+        stack[-1][2].append([DRAFT_COMMENT, data])
+
+    def processingInstruction(target, data):
+        stack[-1][2].append([DRAFT_PI, target, data])
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = characterData
+    parser.CommentHandler = comment
+    parser.ProcessingInstructionHandler = processingInstruction
+    parser.StartCdataSectionHandler = startCdata
+    parser.EndCdataSectionHandler = endCdata
+
+    draftData = open(sddraft, "rb")
+    try:
+        parser.ParseFile(draftData)
+    finally:
+        draftData.close()
+    return document[2], index
+
+
+def writeDraft(nodes, outXml):
+
+    #Write the tree of readDraft as xml.dom.minidom writexml writes the DOM
+    parts = []
+    f = codecs.open(outXml, "w", "utf-8")
+    try:
+        parts.append('<?xml version="1.0" ?>')
+        pending = list(reversed(nodes))
+        while pending != []:
+            node = pending.pop()
+            if isinstance(node, basestring):
+                parts.append(node)
+            elif node[0] == DRAFT_TEXT:
+                parts.append(escapeDraftData("%s" % (node[1],)))
+            elif node[0] == DRAFT_CDATA:
+                if "]]>" in node[1]: raise ValueError("']]>' not allowed in a CDATA section")
+                parts.append("<![CDATA[%s]]>" % node[1])
+            elif node[0] == DRAFT_COMMENT:
+                if "--" in node[1]: raise ValueError("'--' is not allowed in a comment node")
+                parts.append("<!--%s-->" % node[1])
+            elif node[0] == DRAFT_PI:
+                parts.append("<?%s %s?>" % (node[1], node[2]))
+            else:
+                parts.append("<" + node[0])
+                for name in sorted(node[1]):
+                    parts.append(" %s=\"" % name)
+                    parts.append(escapeDraftData(node[1][name]))
+                    parts.append("\"")
+                if node[2] != []:
+                    parts.append(">")
+                    pending.append("</%s>" % node[0])
+                    pending.extend(reversed(node[2]))
+                else:
+                    parts.append("/>")
+
+            if len(parts) > 4096:
+                f.write(u"".join(parts))
+                parts = []
+        f.write(u"".join(parts))
+    finally:
+        f.close()
+
+
+def escapeDraftData(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def draftElement(index, tag):
+
+    #First element of the sddraft with that name, as getElementsByTagName(tag)[0]
+    if tag not in index:
+        raise IndexError("The sddraft has no " + tag + " element")
+    return index[tag]
+
+
+def draftChildElements(element):
+    return [child for child in element[2] if child[0] not in DRAFT_NODES]
+
+
+def draftText(element):
+
+    #Same as element.firstChild.data in the DOM
+    if element[0] in DRAFT_NODES or element[2] == []:
+        raise AttributeError("'" + element[0] + "' has no text")
+    first = element[2][0]
+    if first[0] in (DRAFT_TEXT, DRAFT_CDATA, DRAFT_COMMENT):
+        return first[1]
+    if first[0] == DRAFT_PI:
+        return first[2]
+    raise AttributeError("'" + element[0] + "' has no text")
+
+
+def setDraftText(element, value):
+
+    #Same as element.firstChild.data = value in the DOM (an element as first child is left as it is)
+    if element[0] in DRAFT_NODES or element[2] == []:
+        raise AttributeError("'" + element[0] + "' has no text")
+    first = element[2][0]
+    if first[0] in (DRAFT_TEXT, DRAFT_CDATA, DRAFT_COMMENT):
+        first[1] = value
+    elif first[0] == DRAFT_PI:
+        first[2] = value
+
+
+def draftKeyValues(element):
+
+    ''' Function to list the (key, value element) pairs of the PropertyArray of a ConfigurationProperties or Props
+    element. The value is the node after the Key, as the DOM nextSibling.
+    '''
+    keyValues = []
+    if element[2] == []:
+        raise AttributeError("'" + element[0] + "' is empty")
+    propertyArray = element[2][0]
+    if propertyArray[0] in DRAFT_NODES:
+        return keyValues
+
+    for propertySet in draftChildElements(propertyArray):
+        children = propertySet[2]
+        for position in range(len(children)):
+            if children[position][0] == 'Key':
+                if position + 1 < len(children):
+                    keyValues.append((draftText(children[position]), children[position + 1]))
+                else:
+                    keyValues.append((draftText(children[position]), [DRAFT_DOCUMENT, {}, []]))
+    return keyValues
+
+
 def analyseServiceDraft(draftXml, service):
     analysis = {}
     try:    
         # Analyze the service definition draft
-        analysis = arcpy.mapping.AnalyzeForSD(draftXml)
+        analysis = arcpyCall(arcpy.mapping.AnalyzeForSD, draftXml)
 
         # Print errors, warnings, and messages returned from the analysis
         count = 0 
@@ -1205,24 +4025,86 @@ def analyseServiceDraft(draftXml, service):
         return analysis
         
    
-if __name__ == "__main__":
+def readToolSettings(values):
+
+    ''' Function to read the optional parameters of the tool after the first 14: Resume, Incremental Copy,
+    Defer Permissions and Destinations. The ones left empty keep RESUME, DELTA_COPY and DEFERRED_PERMISSIONS.
+    Destinations is a value table of server, port, admin user and password, one row per extra destination of the
+    fan-out: the services are copied, drafted and staged once and the same service definition is uploaded to all of them.
+    '''
+    values = list(values) + [''] * (4 - len(values))
+    settings = {'resume': RESUME, 'delta': DELTA_COPY, 'deferPermissions': DEFERRED_PERMISSIONS, 'destinations': []}
+    for key, value in zip(['resume', 'delta', 'deferPermissions'], values[0:3]):
+        if value != '': settings[key] = value.lower() == 'true'
+    rows = [row for row in values[3].split(';') if row.strip() != '']
+    for number, row in enumerate(rows):
+        fields = shlex.split(row)
+        if len(fields) != 4:
+            raise ValueError("The destination " + str(number + 1) + " must have a server, port, admin user and password")
+        settings['destinations'].append(tuple(fields))
+    return settings
+
+
+def readServerArguments(arguments):
+
+    ''' Function to read the command line of the migration of a whole server (see __main__).
+    Returns the parameters of the tool, with an empty service list, the selection of the services
+    for transferMapServices (include and exclude patterns, shard) and the settings of the run (see readToolSettings).
+    '''
+    parser = optparse.OptionParser(usage="python TransferServices.py --server <fromServer> <fromPort> <fromUser> <fromPass> <toServer> <toPort> <toUser> <toPass> <sysTemp> <backupPath> [options]")
+    parser.add_option("--include", action="append", default=[], help="only the services matching the pattern, e.g. \"Water/*\" (folder/service.MapServer), can be repeated")
+    parser.add_option("--exclude", action="append", default=[], help="not the services matching the pattern, can be repeated")
+    parser.add_option("--shard", default="", help="i/N: only the services of the shard i of N, to migrate the server with N runs")
+    parser.add_option("--folder", default="", help="destination folder of all the services")
+    parser.add_option("--overwrite", action="store_true", default=False, help="overwrite the services that exist in the destination server")
+    parser.add_option("--destination", action="append", nargs=4, default=[], metavar="SERVER PORT USER PASS", help="publish the services in this server too, can be repeated")
+    parser.add_option("--resume", action="store_true", default=None, help="go on with the last interrupted run between these servers")
+    parser.add_option("--delta", action="store_true", default=None, help="only copy the files changed since the last run")
+    parser.add_option("--defer-permissions", dest="deferPermissions", action="store_true", default=None, help="set the permissions after the last upload, grouped by role")
+    options, positional = parser.parse_args(arguments)
+    if len(positional) != 10:
+        parser.error("the origin and destination servers, sysTemp and backupPath are required")
+
+    shard = None
+    if options.shard != "":
+        try:
+            shard = tuple([int(part) for part in options.shard.split('/')])
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+            parser.error("--shard must be i/N, with i from 1 to N")
+
+    parameters = positional[0:4] + ["MapServer", ""] + positional[4:8] + [options.folder, positional[8], str(options.overwrite).lower(), positional[9]]
+    settings = readToolSettings([{None: '', True: 'true'}[flag] for flag in (options.resume, options.delta, options.deferPermissions)])
+    settings['destinations'] = [tuple(destination) for destination in options.destination]
+    return parameters, {'include': options.include, 'exclude': options.exclude, 'shard': shard}, settings
 
 
+def runTool(parameters, catalog=None, settings=None):
+
+    ''' Function to run the tool with its 14 parameters, from the toolbox or the command line (see __main__).
+    catalog selects the services of a whole server migration and settings are the ones of readToolSettings.
+    '''
+    if settings is None: settings = readToolSettings([])
+
     # Gather inputs    
-    fromServerName = arcpy.GetParameterAsText(0)
-    fromServerPort = arcpy.GetParameterAsText(1)
-    fromAdminUser = arcpy.GetParameterAsText(2)
-    fromAdminPass = arcpy.GetParameterAsText(3)
-    serviceType = arcpy.GetParameterAsText(4) 
-    serviceList = arcpy.GetParameterAsText(5)  
-    toServerName = arcpy.GetParameterAsText(6)
-    toServerPort = arcpy.GetParameterAsText(7)
-    toAdminUser = arcpy.GetParameterAsText(8)
-    toAdminPass = arcpy.GetParameterAsText(9)
-    newFolder = arcpy.GetParameterAsText(10)
-    sysTemp = arcpy.GetParameterAsText(11)
-    overwrite = arcpy.GetParameterAsText(12)
-    backupPath = arcpy.GetParameterAsText(13)
+    fromServerName = parameters[0]
+    fromServerPort = parameters[1]
+    fromAdminUser = parameters[2]
+    fromAdminPass = parameters[3]
+    serviceType = parameters[4] 
+    serviceList = parameters[5]  
+    toServerName = parameters[6]
+    toServerPort = parameters[7]
+    toAdminUser = parameters[8]
+    toAdminPass = parameters[9]
+    newFolder = parameters[10]
+    sysTemp = parameters[11]
+    overwrite = parameters[12]
+    backupPath = parameters[13]
+
+    runName = fromServerName + '_' + toServerName
+    if catalog is not None and catalog['shard'] is not None: runName = runName + '_shard' + str(catalog['shard'][0]) + 'of' + str(catalog['shard'][1])
 
     
 
@@ -1233,10 +4115,69 @@ if __name__ == "__main__":
         os.makedirs(backupPath)        
         
     now = datetime.datetime.now()
-    workspace = os.path.join(sysTemp, str(now.year) + str(now.month) + str(now.day) + '_' + str(now.hour) + str(now.minute) + str(now.second) + '_' + fromServerName + '_' + toServerName)
+    workspace = os.path.join(sysTemp, str(now.year) + str(now.month) + str(now.day) + '_' + str(now.hour) + str(now.minute) + str(now.second) + '_' + runName)
+
+    #The incremental copy reuses the sources of the earlier runs
+    if settings['delta']: workspace = os.path.join(sysTemp, runName)
+
+    #Go on with the last interrupted run between these servers
+    resume = False
+    if settings['resume']:
+        interrupted = findInterruptedRun(sysTemp, runName)
+        if interrupted is not None:
+            workspace = interrupted
+            resume = True
+    #Times of the services in the earlier runs, to transfer the longest first
+    schedule = None
+    if SCHEDULE_LONGEST_FIRST: schedule = os.path.join(sysTemp, SCHEDULE_HISTORY_FILE)
+
+    #Service definitions staged by the earlier runs
+    sdCache = None
+    if SD_CACHE: sdCache = SD_CACHE_FOLDER or os.path.join(sysTemp, "sdcache")
+
     workFolder = os.path.join(backupPath, str(now.year) + str(now.month) + str(now.day) + '_' + str(now.hour) + str(now.minute) + str(now.second) + '_' + toServerName)
     
     if not os.path.exists(workspace): os.makedirs(workspace)
 
     if serviceType == "MapServer":
-        transferMapServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceList, toServerName, toServerPort, toAdminUser, toAdminPass, serviceType, workspace, newFolder, overwrite, workFolder)
+        transferMapServices(fromServerName, fromServerPort, fromAdminUser, fromAdminPass, serviceList, toServerName, toServerPort, toAdminUser, toAdminPass, serviceType, workspace, newFolder, overwrite, workFolder, snapshot=SNAPSHOT_FILE, delta=settings['delta'], resume=resume, deferPermissions=settings['deferPermissions'], sdCache=sdCache, processes=PROCESS_WORKERS, schedule=schedule, trace=HTTP_TRACE, catalog=catalog, destinations=settings['destinations'])
+
+
+# Results still queued when the tool exits are written before it ends
+atexit.register(closeRunLog)
+
+
+if __name__ == "__main__":
+
+    # Snapshot of a whole server from the command line:
+    #   python TransferServices.py --snapshot <server> <port> <adminUser> <adminPass> <snapshot.jsonl>
+    if len(sys.argv) == 7 and sys.argv[1] == '--snapshot':
+        snapshotServer(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6])
+        closeConnections()
+        sys.exit()
+
+    # Admin requests of a traced run sent again to a server (a local stand-in), speed times faster:
+    #   python TransferServices.py --replay <http_trace.jsonl> <server> <port> <adminUser> <adminPass> [speed]
+    if len(sys.argv) in (7, 8) and sys.argv[1] == '--replay':
+        speed = 1.0
+        if len(sys.argv) == 8: speed = float(sys.argv[7])
+        arcpy.AddMessage(" - Admin requests replayed: " + str(replayTrace(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6], speed)))
+        reportHttpTrace()
+        closeConnections()
+        sys.exit()
+
+    # Every service of a server (or the ones matching the patterns, or a shard of them) from the command line,
+    # each shard in its own workspace:
+    #   python TransferServices.py --server <fromServer> <fromPort> <fromUser> <fromPass> <toServer> <toPort> <toUser> <toPass> <sysTemp> <backupPath>
+    #                              [--include <pattern>] [--exclude <pattern>] [--shard <i>/<N>] [--folder <folder>] [--overwrite]
+    #                              [--destination <server> <port> <user> <pass>]
+    #                              [--resume] [--delta] [--defer-permissions]
+    # From the tool, the optional parameters after the first 14 are read by readToolSettings
+    catalog = None
+    if len(sys.argv) > 1 and sys.argv[1] == '--server':
+        parameters, catalog, settings = readServerArguments(sys.argv[2:])
+    else:
+        parameters = [arcpy.GetParameterAsText(index) for index in range(arcpy.GetArgumentCount())]
+        settings = readToolSettings(parameters[14:])
+
+    runTool(parameters[0:14], catalog, settings)
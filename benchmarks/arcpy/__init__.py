@@ -0,0 +1,105 @@
+''' Fake arcpy for the benchmarks, with the functions TransferServices.py calls.
+Creating, analysing, staging and uploading a service definition take the seconds set in the environment
+(BENCH_DRAFT_SECONDS, BENCH_ANALYSE_SECONDS, BENCH_STAGE_SECONDS, BENCH_UPLOAD_SECONDS), the staged .sd has
+BENCH_SD_BYTES bytes and each map BENCH_LAYERS layers. The upload publishes the service in the mock server
+of the connection file (see mockserver.py). The messages go to the BENCH_LOG file, if it is set.
+'''
+import os, json, time, threading, urllib, urllib2
+import xml.dom.minidom as DOM
+import mapping
+
+logLock = threading.Lock()
+
+
+class ExecuteError(Exception):
+    pass
+
+
+class Environment(object):
+    scratchWorkspace = None
+
+env = Environment()
+
+
+def cost(name):
+
+    #Setting of the fake costs from the environment
+    return float(os.environ.get('BENCH_' + name, '0') or 0)
+
+
+def writeLog(kind, message):
+
+    #Append a message to the BENCH_LOG file, or show it
+    logFile = os.environ.get('BENCH_LOG')
+    if not logFile:
+        print kind + message
+        return
+    with logLock:
+        logData = open(logFile, 'a')
+        try:
+            logData.write(kind + message.encode('utf8', 'replace') + '\n')
+        finally:
+            logData.close()
+
+
+def AddMessage(message):
+    writeLog('', message)
+
+
+def AddWarning(message):
+    writeLog('WARNING ', message)
+
+
+def AddError(message):
+    writeLog('ERROR ', message)
+
+
+def GetMessages(severity=0):
+    return ''
+
+
+def GetParameterAsText(index):
+    return ''
+
+
+def GetArgumentCount():
+    return 14
+
+
+def StageService_server(draft, sd):
+
+    #Write a .sd of BENCH_SD_BYTES bytes, with the folder and name of the service on its first line
+    time.sleep(cost('STAGE_SECONDS'))
+    doc = DOM.parse(draft)
+    configuration = doc.getElementsByTagName('SVCConfiguration')[0]
+    header = {}
+    for tag in ('ServiceName', 'Folder'):
+        node = configuration.getElementsByTagName(tag)[0].firstChild
+        header[tag] = node is not None and node.data or ''
+
+    sdData = open(sd, 'wb')
+    try:
+        sdData.write(json.dumps(header) + '\n')
+        remaining = int(cost('SD_BYTES'))
+        block = '\0' * (1024 * 1024)
+        while remaining > 0:
+            sdData.write(block[:remaining])
+            remaining = remaining - len(block)
+    finally:
+        sdData.close()
+
+
+def UploadServiceDefinition_server(sd, con):
+
+    #Publish the service of the .sd in the mock server of the connection file
+    time.sleep(cost('UPLOAD_SECONDS'))
+    sdData = open(sd, 'rb')
+    try:
+        header = json.loads(sdData.readline())
+    finally:
+        sdData.close()
+    serverURL = open(con).read().strip()
+    try:
+        urllib2.urlopen(serverURL + '/_mock/publish', urllib.urlencode({'name': header['ServiceName'], 'folder': header['Folder']})).read()
+    except (IOError, ValueError), e:
+        raise ExecuteError(str(e))
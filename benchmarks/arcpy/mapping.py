@@ -0,0 +1,58 @@
+''' Fake arcpy.mapping for the benchmarks (see arcpy/__init__.py).
+'''
+import os, time
+from xml.sax.saxutils import escape
+
+SDDRAFT = ('<?xml version="1.0" encoding="utf-8"?><SVCManifest><Configurations><SVCConfiguration><Name>{name}</Name><Folder>{folder}</Folder><ServiceName>{name}</ServiceName>'
+           '<Definition><ConfigurationProperties><PropertyArray>'
+           '<PropertySetProperty><Key>maxRecordCount</Key><Value>1000</Value></PropertySetProperty>'
+           '<PropertySetProperty><Key>minScale</Key><Value>0</Value></PropertySetProperty>'
+           '<PropertySetProperty><Key>maxScale</Key><Value>0</Value></PropertySetProperty>'
+           '<PropertySetProperty><Key>isCached</Key><Value>false</Value></PropertySetProperty>'
+           '</PropertyArray></ConfigurationProperties>'
+           '<Extensions><SVCExtension><Enabled>false</Enabled><Info><PropertyArray><PropertySetProperty><Key>WebCapabilities</Key><Value>Query</Value></PropertySetProperty></PropertyArray></Info>'
+           '<Props><PropertyArray><PropertySetProperty><Key>maxRecords</Key><Value>10</Value></PropertySetProperty></PropertyArray></Props><TypeName>KmlServer</TypeName></SVCExtension></Extensions>'
+           '<Props><PropertyArray><PropertySetProperty><Key>MinInstances</Key><Value>1</Value></PropertySetProperty><PropertySetProperty><Key>MaxInstances</Key><Value>2</Value></PropertySetProperty></PropertyArray></Props>'
+           '</Definition></SVCConfiguration></Configurations>'
+           '<ItemInfo><Snippet></Snippet><Description></Description><Credits></Credits><MinScale>0</MinScale><MaxScale>0</MaxScale></ItemInfo>'
+           '<XMin>0</XMin><YMin>0</YMin><XMax>0</XMax><YMax>0</YMax></SVCManifest>')
+
+
+def cost(name):
+    return float(os.environ.get('BENCH_' + name, '0') or 0)
+
+
+class MapDocument(object):
+
+    def __init__(self, mxd):
+        self.filePath = mxd
+
+
+def ListLayers(mapDoc, wildcard=None, dataFrame=None):
+    return [str(number) for number in range(int(cost('LAYERS')))]
+
+
+def CreateGISServerConnectionFile(connectionType, outFolder, outName, serverURL, serverType='ARCGIS_SERVER', useArcGISDesktopStagingFolder=True,
+                                  stagingFolderPath=None, userName=None, password=None, saveUserNameAndPassword=None):
+
+    #The connection file only has the URL of the server
+    if not os.path.isdir(outFolder): os.makedirs(outFolder)
+    connectionData = open(os.path.join(outFolder, outName + '.ags'), 'w')
+    try:
+        connectionData.write(serverURL)
+    finally:
+        connectionData.close()
+
+
+def CreateMapSDDraft(mapDoc, outSddraft, serviceName, serverType='ARCGIS_SERVER', connectionFile=None, copyDataToServer=False, folderName=None, summary=None, tags=None):
+    time.sleep(cost('DRAFT_SECONDS'))
+    draftData = open(outSddraft, 'w')
+    try:
+        draftData.write(SDDRAFT.format(name=escape(serviceName), folder=escape(folderName or '')))
+    finally:
+        draftData.close()
+
+
+def AnalyzeForSD(sddraft):
+    time.sleep(cost('ANALYSE_SECONDS'))
+    return {'errors': {}, 'warnings': {}, 'messages': {}}
@@ -0,0 +1,169 @@
+''' End-to-end benchmark of transferMapServices, without ArcGIS Server or arcpy.
+For each number of services, synthetic service folders are generated (generate.py), served by two local mock
+admin servers (mockserver.py, the origin and the destination) and transferred with the fake arcpy of this folder.
+Each size runs in its own process, so every run starts with empty token, connection and catalog caches.
+Reports the wall time, the admin requests per service and the bytes moved.
+
+    python benchmarks\\benchmark.py --services 10,100,1000 --latency 0.005 --stage-seconds 0.2
+'''
+import os, sys, json, time, shutil, tempfile, subprocess, optparse, collections
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_FOLDER))
+sys.path.insert(0, BENCHMARKS_FOLDER)
+
+# Users of the role every origin service gives access to
+ROLE_USERS = 20
+
+
+def parseArguments(arguments):
+
+    #Options of the benchmark
+    parser = optparse.OptionParser(usage="python benchmark.py [options]")
+    parser.add_option("--services", default="10,100,1000", help="comma separated numbers of services to transfer (default 10,100,1000)")
+    parser.add_option("--folders", type="int", default=10, help="folders of the origin server the services are spread over")
+    parser.add_option("--files", type="int", default=8, help="data files per service")
+    parser.add_option("--file-size", type="int", default=32 * 1024, help="average size of the data files, in bytes")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds each admin request of the mock servers takes")
+    parser.add_option("--draft-seconds", type="float", default=0.0, help="seconds CreateMapSDDraft takes")
+    parser.add_option("--analyse-seconds", type="float", default=0.0, help="seconds AnalyzeForSD takes")
+    parser.add_option("--stage-seconds", type="float", default=0.0, help="seconds StageService takes")
+    parser.add_option("--upload-seconds", type="float", default=0.0, help="seconds UploadServiceDefinition takes")
+    parser.add_option("--sd-bytes", type="int", default=0, help="size of the staged service definitions")
+    parser.add_option("--layers", type="int", default=0, help="layers of each map")
+    parser.add_option("--workers", default="", help="worker threads per stage, e.g. copy=4,stage=2")
+    parser.add_option("--processes", type="int", default=0, help="worker processes that draft and stage (PROCESS_WORKERS)")
+    parser.add_option("--arcpy-threads", action="store_true", default=False, help="call arcpy from the pipeline threads at the same time (ARCPY_THREADS)")
+    parser.add_option("--destinations", type="int", default=1, help="destination servers the services are published in (fan-out)")
+    parser.add_option("--defer-permissions", action="store_true", default=False, help="set the permissions after the last upload")
+    parser.add_option("--snapshot", action="store_true", default=False, help="read the origin from a snapshot taken before the run")
+    parser.add_option("--trace", action="store_true", default=False, help="trace the admin requests to http_trace.jsonl in the workspace (with --keep, see replay.py)")
+    parser.add_option("--folder", default="", help="folder of the runs (a temporary folder by default)")
+    parser.add_option("--keep", action="store_true", default=False, help="keep the generated services and workspaces")
+    parser.add_option("--output", default="", help="JSON file to write the results to")
+    parser.add_option("--child", type="int", default=0, help=optparse.SUPPRESS_HELP)
+    return parser.parse_args(arguments)[0]
+
+
+def runBenchmarks(options, arguments):
+
+    ''' Function to run the benchmark once per number of services, each in a new process, and show the results.
+    Returns the results as a list of dictionaries.
+    '''
+    results = []
+    print "services    wall (s)  services/min  requests/service  origin/dest     MB copied   MB staged   KB HTTP/service  failed  published"
+    for count in [int(number) for number in options.services.split(',')]:
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", str(count)] + arguments, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        lines = [line for line in output.splitlines() if line.startswith("RESULT ")]
+        if child.returncode != 0 or lines == []:
+            print str(count).ljust(12) + "failed (exit code " + str(child.returncode) + ")"
+            continue
+
+        result = json.loads(lines[-1][len("RESULT "):])
+        results.append(result)
+        print (str(count).ljust(12) + ("%.2f" % result['wall']).rjust(8) + ("%.1f" % (60.0 * count / max(result['wall'], 0.001))).rjust(14) +
+               ("%.1f" % (float(result['requests']) / count)).rjust(18) + ("  %d/%d" % (result['originRequests'], result['destinationRequests'])).ljust(16) +
+               ("%.1f" % (result['copiedBytes'] / 1048576.0)).rjust(10) + ("%.1f" % (result['stagedBytes'] / 1048576.0)).rjust(12) +
+               ("%.1f" % (result['httpBytes'] / 1024.0 / count)).rjust(17) + str(result['failed']).rjust(8) + str(result['published']).rjust(11))
+
+    if options.output != "":
+        outputData = open(options.output, "w")
+        try:
+            json.dump(results, outputData, indent=2)
+        finally:
+            outputData.close()
+    return results
+
+
+def runTransfer(count, options):
+
+    ''' Function to transfer count synthetic services between two mock servers (run in the child process).
+    Returns the wall time, the requests and bytes of both mock servers, the bytes of the sources copied and
+    the service definitions staged (from the metrics of the run), and the services that failed.
+    '''
+    import mockserver, generate
+
+    folder = options.folder or tempfile.mkdtemp(prefix="benchmark")
+    root = os.path.join(folder, str(count))
+    if os.path.isdir(root): shutil.rmtree(root)
+    os.makedirs(root)
+
+    # The fake arcpy reads its costs from the environment, also in the worker processes
+    for name in ('draft_seconds', 'analyse_seconds', 'stage_seconds', 'upload_seconds', 'sd_bytes', 'layers'):
+        os.environ['BENCH_' + name.upper()] = str(getattr(options, name))
+    os.environ['BENCH_LOG'] = os.path.join(root, "messages.log")
+
+    origin = mockserver.createServer('origin', options.latency)
+    destinations = [mockserver.createServer('destination', options.latency) for number in range(max(options.destinations, 1))]
+    mockserver.addRole(origin, 'editors', ['user' + str(number) for number in range(ROLE_USERS)])
+    services = []
+    for folderName, serviceName, filePath, size in generate.generateServices(os.path.join(root, "origin"), count, options.folders, options.files, options.file_size):
+        mockserver.addService(origin, folderName, serviceName, filePath)
+        origin['permissions'][folderName + '/' + serviceName + '.MapServer'] = {'editors': True, 'esriEveryone': False}
+        services.append(folderName + '/' + serviceName + '.MapServer')
+    originServer = mockserver.startServer(origin)
+    destinationServers = [mockserver.startServer(destination) for destination in destinations]
+
+    import TransferServices
+    # The sources are generated in a local folder, not in the arcgisserver share of the origin server
+    TransferServices.serviceSourceFolder = lambda serverName, propInitialService, serviceName: localSourceFolder(propInitialService, serviceName)
+    TransferServices.ARCPY_THREADS = options.arcpy_threads
+
+    workspace = os.path.join(root, "workspace")
+    os.makedirs(workspace)
+    settings = {'processes': options.processes, 'deferPermissions': options.defer_permissions, 'trace': options.trace}
+    if options.workers != "":
+        settings['workers'] = dict((name, int(number)) for name, number in [worker.split('=') for worker in options.workers.split(',')])
+
+    start = time.time()
+    originPort, destinationPort = str(originServer.server_port), str(destinationServers[0].server_port)
+    if len(destinationServers) > 1:
+        settings['destinations'] = [('127.0.0.1', str(server.server_port), 'admin', 'admin') for server in destinationServers[1:]]
+    if options.snapshot:
+        settings['snapshot'] = os.path.join(root, "snapshot.jsonl")
+        TransferServices.snapshotServer('127.0.0.1', originPort, 'admin', 'admin', settings['snapshot'])
+    TransferServices.transferMapServices('127.0.0.1', originPort, 'admin', 'admin', ';'.join(services), '127.0.0.1', destinationPort, 'admin', 'admin',
+                                         'MapServer', workspace, '', 'false', os.path.join(root, "backup"), **settings)
+    wall = time.time() - start
+
+    destinationCalls = collections.Counter()
+    for destination in destinations: destinationCalls.update(destination['calls'])
+    result = {'services': count, 'wall': wall, 'copiedBytes': 0, 'stagedBytes': 0, 'failed': 0, 'options': vars(options),
+              'originRequests': sum(origin['calls'].values()), 'destinationRequests': sum(destinationCalls.values()),
+              'httpBytes': origin['bytes'] + sum([destination['bytes'] for destination in destinations]), 'originCalls': origin['calls'], 'destinationCalls': dict(destinationCalls)}
+    result['requests'] = result['originRequests'] + result['destinationRequests']
+    # Services published in all the destinations
+    result['published'] = sum([len(folderServices) for destination in destinations for folderServices in destination['folders'].values()])
+
+    metricsData = open(workspace + "\\" + TransferServices.METRICS_FILE)
+    try:
+        for line in metricsData:
+            entry = json.loads(line)
+            result['copiedBytes'] = result['copiedBytes'] + (entry['bytes'] or 0)
+            if entry['outcome'] == 'failed': result['failed'] = result['failed'] + 1
+    finally:
+        metricsData.close()
+    for path, folders, files in os.walk(folder):
+        result['stagedBytes'] = result['stagedBytes'] + sum([os.path.getsize(os.path.join(path, name)) for name in files if name.endswith(".sd")])
+
+    originServer.shutdown()
+    for destinationServer in destinationServers: destinationServer.shutdown()
+    if not options.keep: shutil.rmtree(root, True)
+    if not options.keep and options.folder == "": shutil.rmtree(folder, True)
+    return result
+
+
+def localSourceFolder(propInitialService, serviceName):
+
+    #Folder of the sources of a generated service (the folder of its MSD, as serviceSourceFolder)
+    filePath = propInitialService["properties"]["filePath"]
+    return filePath[:filePath.find(serviceName) + len(serviceName)]
+
+
+if __name__ == '__main__':
+    options = parseArguments(sys.argv[1:])
+    if options.child > 0:
+        print "RESULT " + json.dumps(runTransfer(options.child, options))
+    else:
+        runBenchmarks(options, sys.argv[1:])
@@ -0,0 +1,57 @@
+''' Generator of synthetic arcgisinput service folders for the benchmarks.
+Each service gets the folder ArcGIS Server keeps its sources in (<folder>\<name>.MapServer\extracted\v101) with
+an MXD and data files of random size around fileSize, and an esriinfo\iteminfo.xml. The sizes only depend on seed.
+'''
+import os, sys, random
+
+ARCGIS_INPUT = os.path.join('arcgisserver', 'directories', 'arcgissystem', 'arcgisinput')
+
+ITEMINFO = ('<?xml version="1.0" encoding="utf-8"?><ESRI_ItemInformation><tags>benchmark,{name}</tags><summary>Benchmark service {name}</summary>'
+            '<snippet>Synthetic service {name}</snippet><description>Service generated for the benchmarks</description>'
+            '<licenseinfo>None</licenseinfo><accessinformation>Benchmark</accessinformation>'
+            '<xmin>-10</xmin><ymin>35</ymin><xmax>40</xmax><ymax>70</ymax></ESRI_ItemInformation>')
+
+
+def generateServices(root, count, folders=10, files=8, fileSize=32 * 1024, seed=0):
+
+    ''' Function to create count service folders in root\arcgisserver\directories\arcgissystem\arcgisinput.
+    The services are spread over folders folders of the server (F0, F1...), each one with files data files.
+    Returns a list of (folderName, serviceName, filePath, size), filePath being the MSD of the service as
+    the admin JSON gives it.
+    '''
+    generator = random.Random(seed)
+    services = []
+    for number in range(count):
+        folderName = 'F' + str(number % max(folders, 1))
+        serviceName = 'Service' + str(number)
+        serviceFolder = os.path.join(root, ARCGIS_INPUT, folderName, serviceName + '.MapServer')
+        sourceFolder = os.path.join(serviceFolder, 'extracted', 'v101')
+        os.makedirs(os.path.join(sourceFolder, 'data'))
+        os.makedirs(os.path.join(serviceFolder, 'esriinfo'))
+
+        size = writeFile(os.path.join(sourceFolder, serviceName + '.mxd'), 4096)
+        size = size + writeFile(os.path.join(serviceFolder, 'esriinfo', 'iteminfo.xml'), 0, ITEMINFO.format(name=serviceName))
+        for fileNumber in range(files):
+            size = size + writeFile(os.path.join(sourceFolder, 'data', 'layer' + str(fileNumber) + '.dat'), generator.randint(fileSize / 2, fileSize * 3 / 2))
+
+        services.append((folderName, serviceName, os.path.join(sourceFolder, serviceName + '.msd'), size))
+    return services
+
+
+def writeFile(path, size, data=None):
+
+    #Write data, or size random bytes, to a file. Returns its size.
+    if data is None: data = os.urandom(size)
+    fileData = open(path, 'wb')
+    try:
+        fileData.write(data)
+    finally:
+        fileData.close()
+    return len(data)
+
+
+if __name__ == '__main__':
+    # python generate.py <folder> <services> [files] [fileSize]
+    arguments = [int(argument) for argument in sys.argv[2:]]
+    generated = generateServices(sys.argv[1], *arguments[:1], **dict(zip(('files', 'fileSize'), arguments[1:])))
+    print str(len(generated)) + ' services, ' + str(sum([service[3] for service in generated])) + ' bytes'
@@ -0,0 +1,196 @@
+''' Local stand-in for the ArcGIS Server Admin REST API, for the benchmarks.
+It answers the admin requests TransferServices.py sends (generateToken, services, createFolder, permissions
+and the security roles and users) from memory, after LATENCY seconds, and counts the requests and bytes of
+each endpoint. The fake arcpy publishes the uploaded services with /_mock/publish.
+'''
+import BaseHTTPServer, SocketServer
+import threading, json, urlparse, urllib, time, zlib
+import re
+
+# Parts of the paths replaced in the endpoint names of the counts
+ENDPOINT_PATTERNS = [(re.compile(r'^/services/[^/]+/[^/]+\.\w+Server'), '/services/{folder}/{service}'),
+                     (re.compile(r'^/services/[^/]+\.\w+Server'), '/services/{service}'),
+                     (re.compile(r'^/services/(?!createFolder$)[^/]+$'), '/services/{folder}')]
+
+
+def createServer(name, latency=0.0):
+
+    #State of a mock server: its folders and services, permissions, roles, users and request counts
+    return {'name': name, 'latency': latency, 'folders': {'': {}}, 'permissions': {}, 'roles': {}, 'users': {}, 'tokens': set(),
+            'calls': {}, 'bytes': 0, 'lock': threading.Lock()}
+
+
+def addService(server, folderName, serviceName, filePath, serviceType='MapServer'):
+
+    #Add a service to the mock server, with the properties the transfer copies to the sddraft
+    server['folders'].setdefault(folderName, {})[serviceName + '.' + serviceType] = {
+        'serviceName': serviceName, 'type': serviceType, 'folderName': folderName or '/',
+        'properties': {'filePath': filePath, 'maxRecordCount': '1000', 'minScale': '0', 'maxScale': '0'},
+        'extensions': [{'typeName': 'KmlServer', 'enabled': 'true', 'capabilities': 'SingleImage', 'properties': {'maxRecords': '20'}}],
+        'minInstancesPerNode': 1, 'maxInstancesPerNode': 2}
+
+
+def addRole(server, role, users, privilege='ACCESS'):
+
+    #Add a role and its users to the mock server
+    server['roles'][role] = {'description': role, 'privilege': privilege, 'users': set(users)}
+    for user in users:
+        server['users'][user] = {'username': user, 'disabled': False}
+
+
+def endpointName(path):
+
+    #Endpoint of an admin path, without the names of the folders and services
+    for pattern, name in ENDPOINT_PATTERNS:
+        path, found = pattern.subn(name, path)
+        if found: break
+    return path
+
+
+def startServer(server, port=0):
+
+    #Serve the mock server on 127.0.0.1 in a daemon thread. Returns the HTTP server (server_port, shutdown).
+    httpServer = ThreadingServer(('127.0.0.1', port), AdminHandler)
+    httpServer.state = server
+    thread = threading.Thread(target=httpServer.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpServer
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class AdminHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive connections, as ArcGIS Server
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.answer('')
+
+    def do_POST(self):
+        self.answer(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+    def answer(self, body):
+        server = self.server.state
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        params.update(dict(urlparse.parse_qsl(body)))
+        path = urllib.unquote(url.path).rstrip('/')
+        if path.startswith('/arcgis/admin'): path = path[len('/arcgis/admin'):]
+
+        time.sleep(server['latency'])
+        with server['lock']:
+            try:
+                data = json.dumps(route(server, path, params))
+            except KeyError, e:
+                data = json.dumps({'status': 'error', 'messages': ['Not found: ' + str(e)], 'code': 404})
+            endpoint = endpointName(path)
+            server['calls'][endpoint] = server['calls'].get(endpoint, 0) + 1
+            server['bytes'] = server['bytes'] + len(body) + len(data)
+
+        self.send_response(200)
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def route(server, path, params):
+
+    #Answer of an admin request
+    if path == '/generateToken':
+        token = 'token' + str(len(server['tokens']))
+        server['tokens'].add(token)
+        return {'token': token, 'expires': int((time.time() + 3600) * 1000)}
+    if path == '/_mock/publish':
+        addService(server, params.get('folder', ''), params['name'], '')
+        return {'status': 'success'}
+    if params.get('token') not in server['tokens']:
+        return {'status': 'error', 'messages': ['Invalid token.'], 'code': 498}
+    if path == '/services/createFolder':
+        server['folders'].setdefault(params['folderName'], {})
+        return {'status': 'success'}
+    if path.startswith('/security/'):
+        return routeSecurity(server, path, params)
+
+    parts = [part for part in path.split('/')[2:] if part]
+    if parts == [] or (len(parts) == 1 and parts[0] in server['folders']):
+        folderName = ''
+        if parts != []: folderName = parts[0]
+        result = {'services': [{'serviceName': service['serviceName'], 'type': service['type'], 'folderName': folderName or '/'}
+                               for service in server['folders'][folderName].values()]}
+        if parts == []:
+            result['folders'] = sorted([folder for folder in server['folders'] if folder != ''])
+        return result
+
+    if '.' in parts[0]: parts.insert(0, '')
+    if len(parts) < 2:
+        return {'status': 'error', 'messages': ['Folder not found'], 'code': 404}
+    key = parts[0] + '/' + parts[1]
+    service = server['folders'].get(parts[0], {}).get(parts[1])
+    if service is None:
+        return {'status': 'error', 'messages': ['Service not found'], 'code': 404}
+
+    resource = parts[2:]
+    if resource == []:
+        return service
+    if resource == ['permissions']:
+        return {'permissions': [{'principal': principal, 'permission': {'isAllowed': isAllowed}}
+                                for principal, isAllowed in server['permissions'].get(key, {}).items()]}
+    if resource == ['permissions', 'add']:
+        server['permissions'].setdefault(key, {})[params['principal']] = params['isAllowed'] in ('True', 'true')
+        return {'status': 'success'}
+    if resource == ['iteminfo']:
+        return {'description': '', 'summary': '', 'tags': []}
+    return {'status': 'error', 'messages': ['Unknown resource ' + path]}
+
+
+def routeSecurity(server, path, params):
+
+    #Answer of a request to the roles and users of the security store
+    roles, users = server['roles'], server['users']
+    if path == '/security/roles/search':
+        return {'roles': [{'rolename': role, 'description': roles[role]['description']} for role in sorted(roles) if params.get('filter', '') in role]}
+    if path == '/security/roles/getPrivilege':
+        return {'privilege': roles[params['rolename']]['privilege']}
+    if path == '/security/roles/getUsersWithinRole':
+        return {'users': sorted(roles[params['rolename']]['users'])}
+    if path == '/security/users/search':
+        found = [users[user] for user in sorted(users) if params.get('filter', '') in user]
+        return {'users': found[:int(params.get('maxCount', 1000))]}
+    if path == '/security/roles/add':
+        roles[params['rolename']] = {'description': params.get('description', ''), 'privilege': 'ACCESS', 'users': set()}
+        return {'status': 'success'}
+    if path == '/security/roles/assignPrivilege':
+        roles[params['rolename']]['privilege'] = params['privilege']
+        return {'status': 'success'}
+    if path == '/security/users/add':
+        users[params['username']] = {'username': params['username'], 'disabled': False}
+        return {'status': 'success'}
+    if path == '/security/roles/addUsersToRole':
+        roles[params['rolename']]['users'].update(params['users'].split(','))
+        return {'status': 'success'}
+    if path in ('/security/roles/getRoles', '/security/users/getUsers'):
+        start, size = int(params.get('startIndex', 0)), int(params.get('pageSize', 10))
+        if path == '/security/roles/getRoles':
+            page = [{'rolename': role, 'description': roles[role]['description']} for role in sorted(roles)[start:start + size]]
+            return {'roles': page, 'hasMore': start + size < len(roles)}
+        return {'users': [users[user] for user in sorted(users)[start:start + size]], 'hasMore': start + size < len(users)}
+    if path == '/security/roles/getRolesByPrivilege':
+        return {'rolenames': sorted([role for role in roles if roles[role]['privilege'] == params['privilege']])}
+    if path == '/security/roles/getRolesForUser':
+        return {'roles': sorted([role for role in roles if params['username'] in roles[role]['users']])}
+    return {'status': 'error', 'messages': ['Unknown resource ' + path]}
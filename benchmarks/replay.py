@@ -0,0 +1,56 @@
+''' Replay of the admin requests traced by a run (HTTP_TRACE, or benchmark.py --trace --keep) against a local mock
+admin server (mockserver.py) with the folders and services of the trace, to compare the latency of each endpoint.
+
+    python benchmarks\\replay.py <http_trace.jsonl> [speed] [latency]
+
+speed divides the time between the requests (0 sends them as fast as possible), latency is the seconds each
+request of the mock server takes.
+'''
+import os, sys, json
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_FOLDER))
+sys.path.insert(0, BENCHMARKS_FOLDER)
+
+import mockserver
+
+
+def createTraceServer(traceFile, latency=0.0):
+
+    #Mock server with the folders, services and roles the requests of the trace read or change
+    server = mockserver.createServer('replay', latency)
+    traceData = open(traceFile, "r")
+    try:
+        for line in traceData:
+            try:
+                record = json.loads(line)
+                url = record['url'].encode('utf8')
+            except (ValueError, KeyError):
+                continue
+            if 'rolename' in record['params'] and record['params']['rolename'] not in server['roles']:
+                mockserver.addRole(server, record['params']['rolename'].encode('utf8'), [])
+            parts = [part for part in url.split('/')[4:] if part]
+            if parts != [] and '.' in parts[0]: parts.insert(0, '')
+            if len(parts) >= 2 and '.' in parts[1]:
+                serviceName, serviceType = parts[1].rsplit('.', 1)
+                if parts[1] not in server['folders'].get(parts[0], {}):
+                    mockserver.addService(server, parts[0], serviceName, '', serviceType)
+            elif len(parts) == 1 and parts[0] != 'createFolder':
+                server['folders'].setdefault(parts[0], {})
+    finally:
+        traceData.close()
+    return server
+
+
+if __name__ == '__main__':
+    traceFile = sys.argv[1]
+    speed, latency = [float(argument) for argument in (sys.argv[2:] + ['1', '0'][len(sys.argv[2:]):])[:2]]
+
+    import TransferServices
+    server = createTraceServer(traceFile, latency)
+    httpServer = mockserver.startServer(server)
+    count = TransferServices.replayTrace(traceFile, '127.0.0.1', str(httpServer.server_port), 'admin', 'admin', speed)
+    print str(count) + " requests replayed"
+    TransferServices.reportHttpTrace()
+    TransferServices.closeConnections()
+    httpServer.shutdown()
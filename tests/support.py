@@ -0,0 +1,68 @@
+''' Shared set up of the tests: TransferServices.py runs with the fake arcpy and the mock admin servers of the
+benchmarks folder, so the tests need neither ArcGIS nor a server. The arcpy messages go to a log file.
+'''
+import os, sys, shutil, tempfile, unittest
+
+TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_FOLDER))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_FOLDER), 'benchmarks'))
+os.environ.setdefault('BENCH_LOG', os.path.join(tempfile.gettempdir(), 'transferservices_tests.log'))
+
+import TransferServices
+import mockserver
+
+
+class FolderTestCase(unittest.TestCase):
+
+    #Test with its own temporary folder, removed at the end
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, True)
+
+    def writeFile(self, relativePath, data):
+        path = os.path.join(self.folder, relativePath)
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        fileData = open(path, 'wb')
+        try:
+            fileData.write(data)
+        finally:
+            fileData.close()
+        return path
+
+    def readFile(self, relativePath):
+        fileData = open(os.path.join(self.folder, relativePath), 'rb')
+        try:
+            return fileData.read()
+        finally:
+            fileData.close()
+
+
+def originServer(folder, services):
+
+    #Mock origin server with the services (folder/name) and their sources in arcgisinput, as in an ArcGIS Server
+    origin = mockserver.createServer('origin')
+    for service in services:
+        folderName, serviceName = service.split('/')
+        sources = os.path.join(folder, 'arcgisserver', 'directories', 'arcgissystem', 'arcgisinput', folderName, serviceName + '.MapServer', 'extracted', 'v101')
+        os.makedirs(sources)
+        for fileName, data in [(serviceName + '.mxd', 'mxd'), ('data.dat', 'x' * 1000)]:
+            fileData = open(os.path.join(sources, fileName), 'wb')
+            try:
+                fileData.write(data)
+            finally:
+                fileData.close()
+        mockserver.addService(origin, folderName, serviceName, os.path.join(sources, serviceName + '.mxd'))
+    return origin
+
+
+def transfer(originPort, destinationPort, services, workspace, backup, **options):
+
+    #Transfer the services between two mock servers
+    TransferServices.transferMapServices('127.0.0.1', str(originPort), 'admin', 'pass', ';'.join([service + '.MapServer' for service in services]),
+                                         '127.0.0.1', str(destinationPort), 'admin', 'pass', 'MapServer', workspace, '', 'false', backup, **options)
+
+
+def publishedServices(server):
+    return sorted([folderName + '/' + serviceName for folderName, folderServices in server['folders'].items() for serviceName in folderServices])
@@ -0,0 +1,109 @@
+''' Tests of the incremental copy (deltaCopy) and of the copies of large files that go on from their last block (chunkedCopy).
+'''
+import os, json, unittest
+
+from support import TransferServices, FolderTestCase
+
+
+class DeltaCopyTest(FolderTestCase):
+
+    def setUp(self):
+        FolderTestCase.setUp(self)
+        self.src = os.path.join(self.folder, 'src')
+        self.dest = os.path.join(self.folder, 'dest')
+        self.writeFile('src/map.mxd', 'mxd')
+        self.writeFile('src/data/a.dat', 'a' * 100)
+        self.writeFile('src/data/b.dat', 'b' * 200)
+
+    def test_second_copy_only_copies_the_changes(self):
+        self.assertEqual(TransferServices.deltaCopy(self.src, self.dest), (303, 0))
+        self.assertEqual(self.readFile('dest/data/b.dat'), 'b' * 200)
+        self.assertTrue(os.path.isfile(self.dest + '.manifest'))
+
+        self.assertEqual(TransferServices.deltaCopy(self.src, self.dest), (0, 303))
+
+        self.writeFile('src/data/a.dat', 'c' * 150)
+        self.assertEqual(TransferServices.deltaCopy(self.src, self.dest), (150, 203))
+        self.assertEqual(self.readFile('dest/data/a.dat'), 'c' * 150)
+
+    def test_removed_sources_are_deleted_but_not_the_files_of_the_tool(self):
+        TransferServices.deltaCopy(self.src, self.dest)
+        self.writeFile('dest/map_mod.sddraft', 'draft')
+        os.remove(os.path.join(self.src, 'data', 'b.dat'))
+
+        TransferServices.deltaCopy(self.src, self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'data', 'b.dat')))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, 'map_mod.sddraft')))
+        manifestData = open(self.dest + '.manifest')
+        try:
+            self.assertEqual(sorted(json.load(manifestData)), [os.path.join('data', 'a.dat'), 'map.mxd'])
+        finally:
+            manifestData.close()
+
+    def test_hash_finds_changes_with_the_same_size_and_date(self):
+        TransferServices.deltaCopy(self.src, self.dest, useHash=True)
+        info = os.stat(os.path.join(self.src, 'data', 'a.dat'))
+        self.writeFile('src/data/a.dat', 'z' * 100)
+        os.utime(os.path.join(self.src, 'data', 'a.dat'), (info.st_atime, info.st_mtime))
+
+        self.assertEqual(TransferServices.deltaCopy(self.src, self.dest), (0, 303))
+        self.assertEqual(TransferServices.deltaCopy(self.src, self.dest, useHash=True), (100, 203))
+        self.assertEqual(self.readFile('dest/data/a.dat'), 'z' * 100)
+
+    def test_a_changed_copy_is_copied_again(self):
+        TransferServices.deltaCopy(self.src, self.dest)
+        self.writeFile('dest/data/b.dat', 'cut')
+        self.assertEqual(TransferServices.deltaCopy(self.src, self.dest), (200, 103))
+        self.assertEqual(self.readFile('dest/data/b.dat'), 'b' * 200)
+
+
+class ChunkedCopyTest(FolderTestCase):
+
+    def setUp(self):
+        FolderTestCase.setUp(self)
+        self.chunkSize = TransferServices.COPY_CHUNK_SIZE
+        TransferServices.COPY_CHUNK_SIZE = 1024
+        self.data = ''.join([chr(number % 251) for number in range(10 * 1024 + 100)])
+        self.src = self.writeFile('src/big.dat', self.data)
+
+    def tearDown(self):
+        TransferServices.COPY_CHUNK_SIZE = self.chunkSize
+        FolderTestCase.tearDown(self)
+
+    def writeProgress(self, destFile, blocks, source=None):
+        if source is None:
+            info = os.stat(self.src)
+            source = [info.st_size, int(info.st_mtime), TransferServices.COPY_CHUNK_SIZE]
+        self.writeFile(destFile + '.progress', json.dumps({'source': source, 'blocks': blocks}))
+
+    def test_copy_goes_on_from_the_last_block(self):
+        # The blocks of the former run are kept as they are, only the rest is read from the source
+        destFile = self.writeFile('dest/big.dat', 'x' * (5 * 1024 + 300))
+        self.writeProgress(destFile, 5)
+
+        self.assertEqual(TransferServices.chunkedCopy(self.src, destFile), len(self.data) - 5 * 1024)
+        self.assertEqual(self.readFile('dest/big.dat'), 'x' * (5 * 1024) + self.data[5 * 1024:])
+        self.assertFalse(os.path.exists(destFile + '.progress'))
+
+    def test_progress_of_another_source_starts_again(self):
+        destFile = self.writeFile('dest/big.dat', 'x' * (5 * 1024))
+        self.writeProgress(destFile, 5, [1, 2, 3])
+
+        self.assertEqual(TransferServices.chunkedCopy(self.src, destFile), len(self.data))
+        self.assertEqual(self.readFile('dest/big.dat'), self.data)
+
+    def test_copy_of_a_folder_keeps_the_partial_files(self):
+        destFile = self.writeFile('dest/big.dat', self.data[:3 * 1024])
+        self.writeProgress(destFile, 3)
+        self.writeFile('dest/old.dat', 'old')
+        self.writeFile('src/small.dat', 'small')
+
+        written = {'bytes': 0}
+        self.assertTrue(TransferServices.copy(os.path.join(self.folder, 'src'), os.path.join(self.folder, 'dest'), written=written))
+        self.assertEqual(written['bytes'], len(self.data) - 3 * 1024 + 5)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'dest'))), ['big.dat', 'small.dat'])
+        self.assertEqual(self.readFile('dest/big.dat'), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+''' Tests of the token cache, the shards of a server, the permissions to apply, the throttle of the shares,
+the percentiles of the metrics and the settings of the tool parameters.
+'''
+import time, unittest
+
+from support import TransferServices, mockserver
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mockserver.createServer('origin')
+        self.httpServer = mockserver.startServer(self.server)
+        self.port = str(self.httpServer.server_port)
+        self.key = ('127.0.0.1', self.port, 'admin')
+
+    def tearDown(self):
+        TransferServices.tokenCache.pop(self.key, None)
+        TransferServices.closeConnections()
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def test_token_is_generated_once_until_it_expires(self):
+        token = TransferServices.getToken('127.0.0.1', self.port, 'admin', 'pass')
+        self.assertEqual(TransferServices.getToken('127.0.0.1', self.port, 'admin', 'pass'), token)
+        self.assertEqual(self.server['calls'], {'/generateToken': 1})
+
+        # Renewed when it is about to expire
+        TransferServices.tokenCache[self.key] = (token, time.time() + TransferServices.TOKEN_REFRESH_MARGIN - 1)
+        renewed = TransferServices.getToken('127.0.0.1', self.port, 'admin', 'pass')
+        self.assertNotEqual(renewed, token)
+        self.assertEqual(self.server['calls'], {'/generateToken': 2})
+
+    def test_rejected_token_is_forgotten_once(self):
+        token = TransferServices.getToken('127.0.0.1', self.port, 'admin', 'pass')
+        TransferServices.invalidateToken('127.0.0.1', self.port, 'admin', 'another')
+        self.assertEqual(TransferServices.getToken('127.0.0.1', self.port, 'admin', 'pass'), token)
+
+        TransferServices.invalidateToken('127.0.0.1', self.port, 'admin', token)
+        self.assertNotEqual(TransferServices.getToken('127.0.0.1', self.port, 'admin', 'pass'), token)
+
+
+class ServiceShardTest(unittest.TestCase):
+
+    def test_shards_split_the_services(self):
+        services = ['Folder%d/Service%d.MapServer' % (number % 7, number) for number in range(400)]
+        shards = [TransferServices.serviceShard(service, 4) for service in services]
+        self.assertEqual(sorted(set(shards)), [1, 2, 3, 4])
+        self.assertTrue(min([shards.count(shard) for shard in range(1, 5)]) > 50)
+
+    def test_shard_only_depends_on_the_name(self):
+        self.assertEqual(TransferServices.serviceShard('Water/Rivers.MapServer', 5), TransferServices.serviceShard('water/RIVERS.MapServer', 5))
+
+
+class PermissionChangesTest(unittest.TestCase):
+
+    def permissions(self, **roles):
+        return [{'principal': role, 'permission': {'isAllowed': isAllowed}} for role, isAllowed in sorted(roles.items())]
+
+    def test_changes_of_the_destination(self):
+        origin = self.permissions(editors=True, viewers=True, esriEveryone=False)
+        destination = self.permissions(editors=True, viewers=False, admins=True, guests=False)
+        self.assertEqual(TransferServices.permissionChanges(origin, destination), [('esriEveryone', False, True), ('viewers', True, True), ('admins', False, False)])
+
+    def test_same_permissions_need_no_change(self):
+        origin = self.permissions(editors=True, esriEveryone=False)
+        self.assertEqual(TransferServices.permissionChanges(origin, origin), [])
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = TransferServices.THROTTLE_SERVERS
+        TransferServices.THROTTLE_SERVERS = {'NAS1': (0.1, 2)}
+
+    def tearDown(self):
+        TransferServices.THROTTLE_SERVERS = self.servers
+        TransferServices.throttles.pop('nas1', None)
+        TransferServices.throttles.pop('nas2', None)
+
+    def test_only_the_shares_with_limits_are_throttled(self):
+        shareLimits = TransferServices.shareThrottles('\\\\nas1\\share\\a.dat', 'c:\\temp\\a.dat', '//nas2/share/a.dat')
+        self.assertEqual([throttle['server'] for throttle in shareLimits], ['nas1'])
+        self.assertTrue('slots' in shareLimits[0])
+
+    def test_bytes_wait_for_the_rate(self):
+        shareLimits = TransferServices.shareThrottles('\\\\nas1\\share\\a.dat')
+        start = time.time()
+        TransferServices.throttleBytes(shareLimits, 20 * 1024)
+        self.assertTrue(time.time() - start > 0.15)
+        self.assertEqual(shareLimits[0]['bytes'], 20 * 1024)
+        self.assertEqual(TransferServices.throttleBlockSize(shareLimits), 64 * 1024)
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(TransferServices.percentile(values, 0.5), 50)
+        self.assertEqual(TransferServices.percentile(values, 0.95), 95)
+        self.assertEqual(TransferServices.percentile(values, 1.0), 100)
+        self.assertEqual(TransferServices.percentile([7], 0.0), 7)
+
+
+class ToolSettingsTest(unittest.TestCase):
+
+    def test_empty_parameters_keep_the_constants(self):
+        self.assertEqual(TransferServices.readToolSettings([]), {'resume': TransferServices.RESUME, 'delta': TransferServices.DELTA_COPY,
+                                                                 'deferPermissions': TransferServices.DEFERRED_PERMISSIONS, 'destinations': []})
+
+    def test_parameters_of_the_tool(self):
+        settings = TransferServices.readToolSettings(['true', 'false', 'true', "server1 6080 admin 'a pass';server2 6443 admin2 b"])
+        self.assertEqual(settings, {'resume': True, 'delta': False, 'deferPermissions': True,
+                                    'destinations': [('server1', '6080', 'admin', 'a pass'), ('server2', '6443', 'admin2', 'b')]})
+        self.assertRaises(ValueError, TransferServices.readToolSettings, ['', '', '', 'server1 6080'])
+
+    def test_command_line(self):
+        parameters, catalog, settings = TransferServices.readServerArguments(['a', '6080', 'u', 'p', 'b', '6080', 'u', 'p', 'temp', 'backup', '--delta',
+                                                                              '--destination', 'c', '6443', 'u2', 'p2'])
+        self.assertEqual(len(parameters), 14)
+        self.assertEqual((settings['delta'], settings['resume'], settings['destinations']), (True, TransferServices.RESUME, [('c', '6443', 'u2', 'p2')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
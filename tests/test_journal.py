@@ -0,0 +1,124 @@
+''' Tests of the journal of the stages of each service and of the resume of an interrupted run.
+'''
+import os, json, time, unittest
+
+from support import TransferServices, mockserver, FolderTestCase, originServer, transfer, publishedServices
+
+
+def localSourceFolder(serverName, propInitialService, serviceName):
+
+    #The sources are in a local folder, not in the arcgisserver share of the origin server (as benchmark.py)
+    filePath = propInitialService["properties"]["filePath"]
+    return filePath[:filePath.find(serviceName) + len(serviceName)]
+
+
+class JournalTest(FolderTestCase):
+
+    def openRun(self, resume=False):
+        return {'journal': TransferServices.openJournal(self.folder + os.sep, resume)}
+
+    def test_records_are_read_back(self):
+        run = self.openRun()
+        TransferServices.journalRecord(run, 'F/a.MapServer', 'copied', {'mxdFile': 'a.mxd'})
+        TransferServices.journalRecord(run, 'F/a.MapServer', 'staged')
+        TransferServices.journalRecord(run, 'F/b.MapServer', 'properties')
+        run['journal']['file'].close()
+
+        resumed = self.openRun(resume=True)
+        resumed['journal']['file'].close()
+        self.assertEqual(TransferServices.journalStages(resumed, 'F/a.MapServer'), {'copied': {'mxdFile': 'a.mxd'}, 'staged': {}})
+        self.assertEqual(TransferServices.journalStages(resumed, 'F/b.MapServer'), {'properties': {}})
+        self.assertEqual(TransferServices.journalStages(resumed, 'F/c.MapServer'), {})
+
+    def test_line_cut_by_the_interruption_is_ignored(self):
+        run = self.openRun()
+        TransferServices.journalRecord(run, 'F/a.MapServer', 'copied')
+        run['journal']['file'].write('{"service": "F/a.MapServer", "stage": "dra')
+        run['journal']['file'].close()
+
+        resumed = self.openRun(resume=True)
+        TransferServices.journalRecord(resumed, 'F/a.MapServer', 'draft')
+        resumed['journal']['file'].close()
+        self.assertEqual(TransferServices.readJournal(self.folder + os.sep + TransferServices.JOURNAL_FILE), {'F/a.MapServer': {'copied': {}, 'draft': {}}})
+
+    def test_new_run_starts_an_empty_journal(self):
+        run = self.openRun()
+        TransferServices.journalRecord(run, 'F/a.MapServer', 'copied')
+        run['journal']['file'].close()
+
+        run = self.openRun()
+        run['journal']['file'].close()
+        self.assertEqual(TransferServices.readJournal(self.folder + os.sep + TransferServices.JOURNAL_FILE), {})
+
+
+class FindInterruptedRunTest(FolderTestCase):
+
+    def writeJournal(self, name, lines, modified):
+        path = self.writeFile(os.path.join(name, TransferServices.JOURNAL_FILE), ''.join([json.dumps(line) + '\n' for line in lines]))
+        os.utime(path, (modified, modified))
+
+    def test_last_unfinished_run_is_found(self):
+        now = time.time()
+        self.writeJournal('2024101_101010_from_to', [{'service': 'F/a.MapServer', 'stage': 'copied'}], now - 300)
+        self.writeJournal('2024102_101010_from_to', [{'service': 'F/a.MapServer', 'stage': 'copied'}], now - 200)
+        self.writeJournal('2024103_101010_from_to', [{'service': 'F/a.MapServer', 'stage': 'copied'}, {'stage': 'finished'}], now - 100)
+        self.writeJournal('2024104_101010_from_other', [{'service': 'F/a.MapServer', 'stage': 'copied'}], now)
+        self.assertEqual(TransferServices.findInterruptedRun(self.folder, 'from_to'), os.path.join(self.folder, '2024102_101010_from_to'))
+
+    def test_finished_runs_are_not_resumed(self):
+        self.writeJournal('from_to', [{'service': 'F/a.MapServer', 'stage': 'copied'}, {'stage': 'finished'}], time.time())
+        self.assertEqual(TransferServices.findInterruptedRun(self.folder, 'from_to'), None)
+
+
+class ResumeTest(FolderTestCase):
+
+    def setUp(self):
+        FolderTestCase.setUp(self)
+        self.serviceSourceFolder = TransferServices.serviceSourceFolder
+        TransferServices.serviceSourceFolder = localSourceFolder
+        self.servers = []
+
+    def tearDown(self):
+        TransferServices.serviceSourceFolder = self.serviceSourceFolder
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        FolderTestCase.tearDown(self)
+
+    def startServer(self, server):
+        self.servers.append(mockserver.startServer(server))
+        return self.servers[-1].server_port
+
+    def test_resumed_run_only_transfers_the_unfinished_services(self):
+        services = ['F/done', 'F/interrupted']
+        originPort = self.startServer(originServer(os.path.join(self.folder, 'origin'), services))
+        destination = mockserver.createServer('destination')
+        destinationPort = self.startServer(destination)
+        workspace = os.path.join(self.folder, 'workspace')
+        os.makedirs(workspace)
+
+        transfer(originPort, destinationPort, services, workspace, os.path.join(self.folder, 'backup'))
+        self.assertEqual(publishedServices(destination), ['F/done.MapServer', 'F/interrupted.MapServer'])
+
+        # Interrupt the run after the copy of the second service
+        journalFile = workspace + "\\" + TransferServices.JOURNAL_FILE
+        entries = [json.loads(line) for line in open(journalFile)]
+        kept = [entry for entry in entries if entry.get('service') == 'F/done.MapServer' or entry['stage'] in ('properties', 'copied')]
+        journalData = open(journalFile, 'w')
+        journalData.write(''.join([json.dumps(entry) + '\n' for entry in kept]))
+        journalData.close()
+
+        del destination['folders']['F']['interrupted.MapServer']
+        transfer(originPort, destinationPort, services, workspace, os.path.join(self.folder, 'backup'), resume=True)
+
+        self.assertEqual(publishedServices(destination), ['F/done.MapServer', 'F/interrupted.MapServer'])
+        resumed = [json.loads(line) for line in open(journalFile)][len(kept):]
+        self.assertEqual(resumed[-1]['stage'], 'finished')
+        # The finished service is not copied or published again, the other one goes on after its copy
+        self.assertEqual([entry['stage'] for entry in resumed if entry.get('service') == 'F/done.MapServer'], [])
+        stages = [entry['stage'] for entry in resumed if entry.get('service') == 'F/interrupted.MapServer']
+        self.assertTrue('uploaded' in stages and 'copied' not in stages)
+
+
+if __name__ == '__main__':
+    unittest.main()
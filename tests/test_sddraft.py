@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+''' Tests of the sddraft rewrite: readDraft and writeDraft write the draft as xml.dom.minidom does, and
+CreateServiceDefinitionDraft copies the properties of the origin service to the draft of the fake arcpy.
+'''
+import os, unittest
+import xml.dom.minidom as DOM
+
+from support import TransferServices, FolderTestCase
+
+ITEMINFO = ('<?xml version="1.0"?><ESRI_ItemInformation><snippet>Rivers &amp; lakes</snippet><description>D\xc3\xa9scription</description>'
+            '<licenseinfo>l</licenseinfo><accessinformation>Agency</accessinformation><xmin>1</xmin><ymin>2</ymin><xmax>3</xmax><ymax>4</ymax>'
+            '<tags>water</tags><summary>Rivers</summary></ESRI_ItemInformation>')
+
+
+class DraftRoundTripTest(FolderTestCase):
+
+    def assertRoundTrip(self, xml):
+        sddraft = self.writeFile('in.sddraft', xml)
+        nodes, index = TransferServices.readDraft(sddraft)
+        TransferServices.writeDraft(nodes, os.path.join(self.folder, 'out.sddraft'))
+        self.assertEqual(self.readFile('out.sddraft').decode('utf-8'), DOM.parseString(xml).toxml())
+
+    def test_draft_of_the_fake_arcpy(self):
+        from arcpy import mapping
+        self.assertRoundTrip(mapping.SDDRAFT.format(name='Rivers', folder='Water'))
+
+    def test_escapes_comments_cdata_and_instructions(self):
+        self.assertRoundTrip('<?xml version="1.0" encoding="utf-8"?><!-- top --><?pi some data?>'
+                             '<SVCManifest a="&amp;&quot;&lt;" b="1"><Name>n &amp; &lt;m&gt; "q"</Name><Empty/>'
+                             '<Tail>\xc3\xa9 text<![CDATA[x<y]]>t<!--c--></Tail></SVCManifest>')
+
+    def test_index_of_the_elements_to_modify(self):
+        sddraft = self.writeFile('in.sddraft', '<a><Props><x/></Props><b><Props/><TypeName>KmlServer</TypeName></b><XMin>0</XMin></a>')
+        nodes, index = TransferServices.readDraft(sddraft)
+        self.assertEqual(index['Props'][2], [['x', {}, []]])
+        self.assertEqual(TransferServices.draftText(index['XMin']), '0')
+        self.assertEqual([(TransferServices.draftText(typeName), parent[0]) for typeName, parent in index['TypeName']], [('KmlServer', 'b')])
+
+
+class CreateDraftTest(FolderTestCase):
+
+    def createDraft(self, dataObj, iteminfo=False):
+        scan = {'iteminfo': None}
+        if iteminfo:
+            self.writeFile('iteminfo.xml', ITEMINFO)
+            scan['iteminfo'] = 'iteminfo.xml'
+        outXml = TransferServices.CreateServiceDefinitionDraft(None, os.path.join(self.folder, 'Rivers.sddraft'), 'Rivers', None, 'Water', dataObj, self.folder, scan)
+        self.assertEqual(outXml, os.path.join(self.folder, 'Rivers_mod.sddraft'))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'Rivers.sddraft')))
+        return DOM.parse(outXml)
+
+    def propertyValues(self, document, tag):
+        values = {}
+        for propertySet in document.getElementsByTagName(tag)[0].getElementsByTagName('PropertySetProperty'):
+            values[propertySet.getElementsByTagName('Key')[0].firstChild.data] = propertySet.getElementsByTagName('Value')[0].firstChild.data
+        return values
+
+    def dataObj(self):
+        return {'properties': {'maxRecordCount': '2000', 'minScale': '50000', 'maxScale': '', 'isCached': 'true'},
+                'extensions': [{'typeName': 'KmlServer', 'enabled': 'true', 'capabilities': 'SingleImage,SeparateImages', 'properties': {'maxRecords': '20'}}],
+                'minInstancesPerNode': 2, 'maxInstancesPerNode': 6}
+
+    def test_properties_of_the_origin_service_are_copied(self):
+        document = self.createDraft(self.dataObj())
+
+        # An empty scale keeps the one of the draft
+        self.assertEqual(self.propertyValues(document, 'ConfigurationProperties'), {'maxRecordCount': '2000', 'minScale': '50000', 'maxScale': '0', 'isCached': 'true'})
+        extension = document.getElementsByTagName('SVCExtension')[0]
+        self.assertEqual(extension.getElementsByTagName('Enabled')[0].firstChild.data, 'true')
+        self.assertEqual(self.propertyValues(extension, 'Info'), {'WebCapabilities': 'SingleImage,SeparateImages'})
+        self.assertEqual(self.propertyValues(extension, 'Props'), {'maxRecords': '20'})
+        itemInfo = document.getElementsByTagName('ItemInfo')[0]
+        self.assertEqual(itemInfo.getElementsByTagName('MinScale')[0].firstChild.data, '50000')
+        self.assertEqual(itemInfo.getElementsByTagName('MaxScale')[0].firstChild.data, '0')
+
+    def test_item_description_is_copied(self):
+        document = self.createDraft(self.dataObj(), iteminfo=True)
+
+        self.assertEqual([document.getElementsByTagName(tag)[0].firstChild.data for tag in ('XMin', 'YMin', 'XMax', 'YMax')], ['1', '2', '3', '4'])
+        # The fake draft has no text in the item info to replace, as an empty ArcGIS draft
+        self.assertEqual(document.getElementsByTagName('Snippet')[0].firstChild, None)
+
+
+if __name__ == '__main__':
+    unittest.main()